@@ -1,6 +1,27 @@
+import os
+import sys
+import time
+import types
+import hashlib
 import inspect
+import subprocess
+import tempfile
 import numpy as np
-from pySAD.AD_Type import AD_Type
+from pySAD.AD_Type import AD_Type, AD, toADType
+
+# Names exported by pySAD (the modules imported here and the helpers of the
+# functions below are not)
+
+__all__ = \
+[
+    "AD_Tape", "AD_TapeCache", "AD_Instruction", "AD_InstructionArray",
+    "operationsList", "operationsNames", "operationsVersion", "unaryOperations", "binaryOperations",
+    "commutativeOperations", "ternaryOperations", "conditionalOperations", "complementOperations",
+    "partialDerivatives", "secondPartialDerivatives", "secondPartialsPattern",
+    "tapeFileHeader", "tapeFileVersion", "isBinaryTapeFile", "writeBinaryTape", "readBinaryTape",
+    "inputDependencies", "jacobianSparsity", "jacobianColoring", "hessianSparsity", "hessianColoring",
+    "outputCones", "outputConeMask", "inputDependents", "activeInstructions", "getActiveInputs", "functionHash"
+]
 
 operationsList = \
 {
@@ -29,76 +50,1035 @@ operationsList = \
     "IFLT":  22,
     "IFGE":  23,
     "IFGT":  24, 
-    "IFLE":  25
+    "IFLE":  25,
+    "SELECT":26,
+    "FMA":   27,
+    "SQUARE":28,
+    "RECIP": 29,
+    "SIGMOID":30,
+    "SWISH": 31
+}
+
+# SELECT is a branch-free conditional: y = (c>0) ? x1 : x2, where the ID of
+# the condition c is stored in the blockEnd field of the instruction. FMA
+# (fused multiply-add, y = x1*x2 + c) stores the ID of its addend c there
+# too. FMA, SQUARE (x1*x1), RECIP (1/x1), SIGMOID (1/(1+exp(-x1))) and SWISH
+# (x1/(1+exp(-x1))) are the fused instructions of optimize
+#
+# The NumPy versions of SIGMOID and SWISH below are private, so that the
+# AD-aware sigmoid and swish of AD_Type are the only ones exported by pySAD
+
+def _sigmoidUfunc(x, out=None, where=True):
+    with np.errstate(over="ignore"):
+        return np.divide(1.0, 1.0 + np.exp(-x), out=out, where=where)
+
+def _swishUfunc(x, out=None, where=True):
+    with np.errstate(over="ignore"):
+        return np.divide(x, 1.0 + np.exp(-x), out=out, where=where)
+
+# NumPy ufuncs used to evaluate instructions over a batch of points
+
+unaryOperations = \
+{
+    "NEG":  np.negative,
+    "ABS":  np.abs,
+    "EXP":  np.exp,
+    "LOG":  np.log,
+    "SQRT": np.sqrt,
+    "SIN":  np.sin,
+    "COS":  np.cos,
+    "TAN":  np.tan,
+    "SINH": np.sinh,
+    "COSH": np.cosh,
+    "TANH": np.tanh,
+    "SQUARE": np.square,
+    "RECIP": np.reciprocal,
+    "SIGMOID": _sigmoidUfunc,
+    "SWISH": _swishUfunc
+}
+
+binaryOperations = \
+{
+    "ADD": np.add,
+    "SUB": np.subtract,
+    "MUL": np.multiply,
+    "DIV": np.divide,
+    "POW": np.power,
+    "MAX": np.maximum,
+    "MIN": np.minimum
+}
+
+commutativeOperations = ["ADD", "MUL", "MAX", "MIN"]
+
+# Operations with a third operand, whose ID is stored in blockEnd
+
+ternaryOperations = ["SELECT", "FMA"]
+
+# Partial derivatives (dy/dx1, dy/dx2) of y = x1 (operation) x2, for scalars or arrays
+
+partialDerivatives = \
+{
+    "NEG":  lambda x1, x2, y: (-1.0, 0.0),
+    "ADD":  lambda x1, x2, y: (1.0, 1.0),
+    "SUB":  lambda x1, x2, y: (1.0, -1.0),
+    "MUL":  lambda x1, x2, y: (x2, x1),
+    "DIV":  lambda x1, x2, y: (1.0/x2, -y/x2),
+    "POW":  lambda x1, x2, y: (x2*y/x1, y*np.log(np.abs(x1))),
+    "ABS":  lambda x1, x2, y: (np.sign(x1) + (x1==0), 0.0),
+    "EXP":  lambda x1, x2, y: (y, 0.0),
+    "LOG":  lambda x1, x2, y: (1.0/x1, 0.0),
+    "SQRT": lambda x1, x2, y: (0.5/y, 0.0),
+    "MAX":  lambda x1, x2, y: (1.0*(x1>x2), 1.0*(x1<=x2)),
+    "MIN":  lambda x1, x2, y: (1.0*(x1<x2), 1.0*(x1>=x2)),
+    "SIN":  lambda x1, x2, y: (np.cos(x1), 0.0),
+    "COS":  lambda x1, x2, y: (-np.sin(x1), 0.0),
+    "TAN":  lambda x1, x2, y: (1.0 + y*y, 0.0),
+    "SINH": lambda x1, x2, y: (np.cosh(x1), 0.0),
+    "COSH": lambda x1, x2, y: (np.sinh(x1), 0.0),
+    "TANH": lambda x1, x2, y: (1.0 - y*y, 0.0),
+    "FMA":  lambda x1, x2, y: (x2, x1),
+    "SQUARE": lambda x1, x2, y: (2.0*x1, 0.0),
+    "RECIP": lambda x1, x2, y: (-y*y, 0.0),
+    "SIGMOID": lambda x1, x2, y: (y*(1.0 - y), 0.0),
+    "SWISH": lambda x1, x2, y: (_sigmoidUfunc(x1)*(1.0 + x1 - y), 0.0)
+}
+
+# The derivative of FMA with respect to its addend c is 1
+
+# Second partial derivatives (d2y/dx1^2, d2y/dx1dx2, d2y/dx2^2) of y = x1 (operation) x2
+# (zero for NEG, ADD, SUB, ABS, MAX, MIN and SELECT)
+
+secondPartialDerivatives = \
+{
+    "MUL":  lambda x1, x2, y: (0.0, 1.0, 0.0),
+    "DIV":  lambda x1, x2, y: (0.0, -1.0/(x2*x2), 2.0*y/(x2*x2)),
+    "POW":  lambda x1, x2, y: (x2*(x2-1.0)*y/(x1*x1), y/x1*(1.0 + x2*np.log(np.abs(x1))), y*np.log(np.abs(x1))**2),
+    "EXP":  lambda x1, x2, y: (y, 0.0, 0.0),
+    "LOG":  lambda x1, x2, y: (-1.0/(x1*x1), 0.0, 0.0),
+    "SQRT": lambda x1, x2, y: (-0.25/(y*y*y), 0.0, 0.0),
+    "SIN":  lambda x1, x2, y: (-y, 0.0, 0.0),
+    "COS":  lambda x1, x2, y: (-y, 0.0, 0.0),
+    "TAN":  lambda x1, x2, y: (2.0*y*(1.0 + y*y), 0.0, 0.0),
+    "SINH": lambda x1, x2, y: (y, 0.0, 0.0),
+    "COSH": lambda x1, x2, y: (y, 0.0, 0.0),
+    "TANH": lambda x1, x2, y: (-2.0*y*(1.0 - y*y), 0.0, 0.0),
+    "FMA":  lambda x1, x2, y: (0.0, 1.0, 0.0),
+    "SQUARE": lambda x1, x2, y: (2.0, 0.0, 0.0),
+    "RECIP": lambda x1, x2, y: (2.0*y*y*y, 0.0, 0.0),
+    "SIGMOID": lambda x1, x2, y: (y*(1.0 - y)*(1.0 - 2.0*y), 0.0, 0.0),
+    "SWISH": lambda x1, x2, y: (_sigmoidUfunc(x1)*(1.0 - _sigmoidUfunc(x1))*(2.0 + x1*(1.0 - 2.0*_sigmoidUfunc(x1))), 0.0, 0.0)
+}
+
+# Which of the second partial derivatives are nonzero (for the Hessian sparsity)
+
+secondPartialsPattern = \
+{
+    "MUL":  (False, True, False),
+    "FMA":  (False, True, False),
+    "DIV":  (False, True, True),
+    "POW":  (True, True, True)
+}
+secondPartialsPattern.update({name: (True, False, False) for name in
+    ["EXP", "LOG", "SQRT", "SIN", "COS", "TAN", "SINH", "COSH", "TANH", "SQUARE", "RECIP", "SIGMOID", "SWISH"]})
+
+conditionalOperations = \
+{
+    "IFEQ": np.equal,
+    "IFNE": np.not_equal,
+    "IFLT": np.less,
+    "IFGE": np.greater_equal,
+    "IFGT": np.greater,
+    "IFLE": np.less_equal
+}
+
+# Conditional recorded for the other branch of a conditional
+
+complementOperations = {"IFEQ": "IFNE", "IFNE": "IFEQ", "IFLT": "IFGE", "IFGE": "IFLT", "IFGT": "IFLE", "IFLE": "IFGT"}
+
+operationsNames = {value: key for key, value in operationsList.items()}
+
+# C expressions of the values and of the partial derivatives (d1, d2) of
+# y = x1 (operation) x2, used by the C code generator (see SAD.h)
+
+cOperations = \
+{
+    "NEG":  "-{x1}",
+    "ADD":  "{x1} + {x2}",
+    "SUB":  "{x1} - {x2}",
+    "MUL":  "{x1} * {x2}",
+    "DIV":  "{x1} / {x2}",
+    "POW":  "pow({x1}, {x2})",
+    "ABS":  "fabs({x1})",
+    "EXP":  "exp({x1})",
+    "LOG":  "log({x1})",
+    "SQRT": "sqrt({x1})",
+    "MAX":  "({x1}>{x2}) ? {x1} : {x2}",
+    "MIN":  "({x1}<{x2}) ? {x1} : {x2}",
+    "SIN":  "sin({x1})",
+    "COS":  "cos({x1})",
+    "TAN":  "tan({x1})",
+    "SINH": "sinh({x1})",
+    "COSH": "cosh({x1})",
+    "TANH": "tanh({x1})",
+    "SELECT": "({c}>0) ? {x1} : {x2}",
+    "FMA":  "{x1} * {x2} + {c}",
+    "SQUARE": "{x1} * {x1}",
+    "RECIP": "1.0 / {x1}",
+    "SIGMOID": "1.0 / (1.0 + exp(-{x1}))",
+    "SWISH": "{x1} / (1.0 + exp(-{x1}))"
 }
 
+cPartials = \
+{
+    "NEG":  ("-1.0", None),
+    "ADD":  ("1.0", "1.0"),
+    "SUB":  ("1.0", "-1.0"),
+    "MUL":  ("{x2}", "{x1}"),
+    "DIV":  ("1.0/{x2}", "-{y}/{x2}"),
+    "POW":  ("{x2}*{y}/{x1}", "{y}*log(fabs({x1}))"),
+    "ABS":  ("({x1}==0) ? 1.0 : {y}/{x1}", None),
+    "EXP":  ("{y}", None),
+    "LOG":  ("1.0/{x1}", None),
+    "SQRT": ("0.5/{y}", None),
+    "MAX":  ("({x1}>{x2}) ? 1.0 : 0.0", "({x1}>{x2}) ? 0.0 : 1.0"),
+    "MIN":  ("({x1}<{x2}) ? 1.0 : 0.0", "({x1}<{x2}) ? 0.0 : 1.0"),
+    "SIN":  ("cos({x1})", None),
+    "COS":  ("-sin({x1})", None),
+    "TAN":  ("1.0 + {y}*{y}", None),
+    "SINH": ("cosh({x1})", None),
+    "COSH": ("sinh({x1})", None),
+    "TANH": ("1.0 - {y}*{y}", None),
+    "SELECT": ("({c}>0) ? 1.0 : 0.0", "({c}>0) ? 0.0 : 1.0"),
+    "FMA":  ("{x2}", "{x1}"),
+    "SQUARE": ("2.0*{x1}", None),
+    "RECIP": ("-{y}*{y}", None),
+    "SIGMOID": ("{y}*(1.0 - {y})", None),
+    "SWISH": ("(1.0 + {x1} - {y})/(1.0 + exp(-{x1}))", None)
+}
+
+cConditions = {"IFEQ": "==", "IFNE": "!=", "IFLT": "<", "IFGE": ">=", "IFGT": ">", "IFLE": "<="}
+
+#------------------------------------------------------------------------------
+# Binary tape file format: a 64 byte header followed by the instruction arrays
+# stored one after the other (value, blockEnd, operand1, operand2, operation),
+# so that every array can be memory-mapped in place. The endianness marker is
+# written in native byte order and is used to reject files written on a
+# machine with a different byte order. The operations version changes
+# whenever operationsList is modified
+#------------------------------------------------------------------------------
+
+tapeFileMagic      = b"SADTAPE"
+tapeFileVersion    = 1
+operationsVersion  = 3
+tapeFileEndianness = 0x01020304
+
+tapeFileHeader = np.dtype(
+[
+    ("magic",             "S8"),
+    ("endianness",       "u4"),
+    ("version",          "i4"),
+    ("operationsVersion", "i4"),
+    ("nInputs",          "i4"),
+    ("nOutputs",         "i4"),
+    ("reserved",         "i4"),
+    ("tapeSize",         "i8"),
+    ("padding",         "S24")
+])
+
+tapeFileArrays = [("value", np.float64), ("blockEnd", np.int32), ("operand1", np.int32), ("operand2", np.int32), ("operation", np.int32)]
+
+def isBinaryTapeFile(filename):
+    with open(filename, "rb") as f:
+        return f.read(8).rstrip(b"\0")==tapeFileMagic
+
+def writeBinaryTape(filename, nInputs, nOutputs, arrays):
+
+    header = np.zeros(1, dtype=tapeFileHeader)
+    header["magic"]             = tapeFileMagic
+    header["endianness"]        = tapeFileEndianness
+    header["version"]           = tapeFileVersion
+    header["operationsVersion"] = operationsVersion
+    header["nInputs"]           = nInputs
+    header["nOutputs"]          = nOutputs
+    header["tapeSize"]          = len(arrays["value"])
+    with open(filename, "wb") as f:
+        header.tofile(f)
+        for name, dtype in tapeFileArrays:
+            np.ascontiguousarray(arrays[name], dtype=dtype).tofile(f)
+
+def readBinaryTape(filename, mode="c"):
+
+    # Returns nInputs, nOutputs and a dict of memory-mapped instruction arrays
+    # (mode="c" maps the file copy-on-write, so that values can be overwritten)
+
+    header = np.fromfile(filename, dtype=tapeFileHeader, count=1)
+    if len(header)==0 or header[0]["magic"]!=tapeFileMagic:
+        raise ValueError("%s is not a binary tape file"%filename)
+    header = header[0]
+    if header["endianness"]!=tapeFileEndianness:
+        raise ValueError("%s was written with a different byte order"%filename)
+    if header["version"]!=tapeFileVersion or header["operationsVersion"]!=operationsVersion:
+        raise ValueError("%s has an unsupported format (version %d, operations version %d)"
+                         %(filename, header["version"], header["operationsVersion"]))
+
+    tapeSize = int(header["tapeSize"])
+    instructionSize = sum(np.dtype(dtype).itemsize for name, dtype in tapeFileArrays)
+    if tapeSize<0 or os.path.getsize(filename)<tapeFileHeader.itemsize + tapeSize*instructionSize:
+        raise ValueError("%s is truncated or corrupt (%d instructions)"%(filename, tapeSize))
+
+    offset = tapeFileHeader.itemsize
+    arrays = {}
+    for name, dtype in tapeFileArrays:
+        if tapeSize>0:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=(tapeSize,))
+        else:
+            arrays[name] = np.empty(0, dtype=dtype)
+        offset += tapeSize*np.dtype(dtype).itemsize
+    return int(header["nInputs"]), int(header["nOutputs"]), arrays
+
+#------------------------------------------------------------------------------
+# Jacobian sparsity: the inputs every output can depend on (on any branch of
+# the conditionals), and colorings of the columns/rows of the jacobian such
+# that columns/rows of the same color have no nonzero in common. The patterns
+# are given in CSR format (indptr, indices)
+#------------------------------------------------------------------------------
+
+def getOutputEnds(nInputs, nOutputs, arrays):
+
+    # The outputs are the nOutputs instructions before the end of a
+    # conditional block without nested conditionals (or of the tape):
+    # returns these ends for all branches
+
+    blockEnd = arrays["blockEnd"].tolist()
+    conditionals = [operationsList[name] for name in conditionalOperations]
+    ids = np.nonzero(np.isin(arrays["operation"], conditionals))[0].tolist()
+    if len(ids)==0:
+        return [len(blockEnd)]
+    return sorted(set(blockEnd[c] for k, c in enumerate(ids) if k+1==len(ids) or ids[k+1]>blockEnd[c]))
+
+def inputDependencies(nInputs, arrays):
+
+    # Propagates the sets of inputs every instruction depends on (empty for
+    # the constants and the conditionals)
+
+    operand1, operand2 = arrays["operand1"].tolist(), arrays["operand2"].tolist()
+    operation, blockEnd = arrays["operation"].tolist(), arrays["blockEnd"].tolist()
+    skipped = [operationsList[name] for name in conditionalOperations] + [operationsList["IFEND"]]
+    FMA = operationsList["FMA"]
+    empty = frozenset()
+    deps = [frozenset([i]) for i in range(nInputs)]
+    for i in range(nInputs, len(operation)):
+        op1, op2 = operand1[i], operand2[i]
+        if op1==-1 or operation[i] in skipped:
+            deps.append(empty)
+        elif op2==-1 or len(deps[op2])==0:
+            deps.append(deps[op1])
+        else:
+            deps.append(deps[op1] | deps[op2])
+        if operation[i]==FMA:
+            deps[i] = deps[i] | deps[blockEnd[i]]
+    return deps
+
+def jacobianSparsity(nInputs, nOutputs, arrays):
+
+    deps = inputDependencies(nInputs, arrays)
+
+    ends = getOutputEnds(nInputs, nOutputs, arrays)
+    indptr = [0]
+    indices = []
+    for k in range(nOutputs):
+        columns = set()
+        for end in ends:
+            columns |= deps[end-nOutputs+k]
+        indices.extend(sorted(columns))
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int32), np.array(indices, dtype=np.int32)
+
+def transposePattern(indptr, indices, nColumns):
+
+    counts = np.bincount(indices, minlength=nColumns)
+    rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+    order = np.argsort(indices, kind="stable")
+    transposedIndptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+    return transposedIndptr, rows[order].astype(np.int32)
+
+def colorColumns(indptr, indices, nColumns):
+
+    # Greedy coloring: every column gets the smallest color not used by a
+    # column sharing a row with it. Returns the colors and their number
+
+    columnsPtr, columnsRows = transposePattern(indptr, indices, nColumns)
+    indptr, indices = indptr.tolist(), indices.tolist()
+    columnsPtr, columnsRows = columnsPtr.tolist(), columnsRows.tolist()
+    colors = [-1]*nColumns
+    for j in range(nColumns):
+        forbidden = set()
+        for row in columnsRows[columnsPtr[j]:columnsPtr[j+1]]:
+            forbidden.update(colors[k] for k in indices[indptr[row]:indptr[row+1]])
+        color = 0
+        while color in forbidden:
+            color += 1
+        colors[j] = color
+    return np.array(colors, dtype=np.int32), max(colors)+1 if nColumns>0 else 0
+
+def jacobianColoring(nInputs, nOutputs, arrays):
+
+    # Returns the sparsity pattern with the column coloring (used by the
+    # forward mode) and the row coloring (used by the reverse mode)
+
+    indptr, indices = jacobianSparsity(nInputs, nOutputs, arrays)
+    columnColors, nColumnColors = colorColumns(indptr, indices, nInputs)
+    rowColors, nRowColors = colorColumns(*transposePattern(indptr, indices, nInputs), nOutputs)
+    return {"indptr": indptr, "indices": indices, "columnColors": columnColors, "nColumnColors": nColumnColors,
+            "rowColors": rowColors, "nRowColors": nRowColors}
+
+def hessianSparsity(nInputs, nOutputs, arrays):
+
+    # Sparsity pattern of the Hessian of a weighted sum of the outputs: every
+    # instruction with nonzero second partials (on a path to the outputs) makes
+    # the inputs its operands depend on interact
+
+    operand1, operand2 = arrays["operand1"].tolist(), arrays["operand2"].tolist()
+    operation, blockEnd = arrays["operation"].tolist(), arrays["blockEnd"].tolist()
+    skipped = [operationsList[name] for name in conditionalOperations] + [operationsList["IFEND"]]
+    FMA = operationsList["FMA"]
+    empty = frozenset()
+    deps = inputDependencies(nInputs, arrays)
+
+    live = [False]*len(operation)
+    for end in getOutputEnds(nInputs, nOutputs, arrays):
+        for k in range(end-nOutputs, end):
+            live[k] = True
+
+    products = set()
+    for i in range(len(operation)-1, nInputs-1, -1):
+        if not live[i] or operand1[i]==-1 or operation[i] in skipped:
+            continue
+        op1, op2 = operand1[i], operand2[i]
+        live[op1] = True
+        if op2!=-1:
+            live[op2] = True
+        if operation[i]==FMA:
+            live[blockEnd[i]] = True
+        name = operationsNames[operation[i]]
+        if name in secondPartialsPattern:
+            d11, d12, d22 = secondPartialsPattern[name]
+            x1, x2 = deps[op1], deps[op2] if op2!=-1 else empty
+            if d11: products.add((x1, x1))
+            if d12: products.add((x1, x2))
+            if d22: products.add((x2, x2))
+
+    neighbors = [set() for i in range(nInputs)]
+    for x1, x2 in products:
+        for j in x1:
+            neighbors[j] |= x2
+        for j in x2:
+            neighbors[j] |= x1
+
+    indptr = [0]
+    indices = []
+    for j in range(nInputs):
+        indices.extend(sorted(neighbors[j]))
+        indptr.append(len(indices))
+    return np.array(indptr, dtype=np.int32), np.array(indices, dtype=np.int32)
+
+def hessianColoring(nInputs, nOutputs, arrays):
+
+    # Returns the Hessian sparsity pattern with a coloring of its columns, so
+    # that one Hessian-vector product per color gives all the nonzeros
+
+    indptr, indices = hessianSparsity(nInputs, nOutputs, arrays)
+    colors, nColors = colorColumns(indptr, indices, nInputs)
+    return {"indptr": indptr, "indices": indices, "colors": colors, "nColors": nColors}
+
+#------------------------------------------------------------------------------
+# Output cones: the instructions every output depends on (on any branch of the
+# conditionals), so that a subset of the outputs can be evaluated skipping
+# all the other instructions. The conditionals and the instructions they
+# depend on (the control cone) are always evaluated, since they decide which
+# branch the outputs are taken from
+#------------------------------------------------------------------------------
+
+def getCone(starts, operand1, operand2, operand3, visited):
+
+    # Instructions reachable from starts through the operands (which are
+    # added to visited)
+    cone = []
+    stack = [i for i in starts if i not in visited]
+    visited.update(stack)
+    while len(stack)>0:
+        i = stack.pop()
+        cone.append(i)
+        for j in (operand1[i], operand2[i], operand3[i]):
+            if j!=-1 and j not in visited:
+                visited.add(j)
+                stack.append(j)
+    return cone
+
+def outputCones(nInputs, nOutputs, arrays):
+
+    # Returns the cones of the outputs in CSR format (indptr, indices) and the
+    # control cone (the conditionals, the IFENDs and their dependencies)
+
+    operand1, operand2 = arrays["operand1"].tolist(), arrays["operand2"].tolist()
+    operation, blockEnd = arrays["operation"].tolist(), arrays["blockEnd"].tolist()
+    ternary = [operationsList[name] for name in ternaryOperations]
+    operand3 = [blockEnd[i] if operation[i] in ternary else -1 for i in range(len(operation))]
+    conditionals = [operationsList[name] for name in conditionalOperations] + [operationsList["IFEND"]]
+
+    control = getCone([i for i, op in enumerate(operation) if op in conditionals], operand1, operand2, operand3, set())
+    ends = getOutputEnds(nInputs, nOutputs, arrays)
+    indptr = [0]
+    indices = []
+    for k in range(nOutputs):
+        indices.extend(sorted(getCone([end-nOutputs+k for end in ends], operand1, operand2, operand3, set())))
+        indptr.append(len(indices))
+    return {"indptr": np.array(indptr, dtype=np.int32), "indices": np.array(indices, dtype=np.int32),
+            "control": np.array(sorted(control), dtype=np.int32)}
+
+def outputConeMask(tapeSize, outputs, cones):
+
+    # Mask of the instructions to evaluate for the given outputs
+    indptr, indices = cones["indptr"], cones["indices"]
+    mask = np.zeros(tapeSize, dtype=bool)
+    mask[cones["control"]] = True
+    for k in np.atleast_1d(outputs):
+        mask[indices[indptr[k]:indptr[k+1]]] = True
+    return mask
+
+#------------------------------------------------------------------------------
+# Incremental evaluation: the instructions depending on every input (on any
+# branch, including the conditionals), so that only these are re-evaluated
+# when some of the inputs change. The index is given in CSR format: the
+# instructions depending on input j are indices[indptr[j]:indptr[j+1]]
+#------------------------------------------------------------------------------
+
+def inputDependents(nInputs, nOutputs, arrays):
+
+    operand1, operand2 = arrays["operand1"].tolist(), arrays["operand2"].tolist()
+    operation, blockEnd = arrays["operation"].tolist(), arrays["blockEnd"].tolist()
+    ternary = [operationsList[name] for name in ternaryOperations]
+    users = [[] for i in range(len(operation))]
+    for i in range(nInputs, len(operation)):
+        for j in (operand1[i], operand2[i], blockEnd[i] if operation[i] in ternary else -1):
+            if j!=-1:
+                users[j].append(i)
+
+    indptr = [0]
+    indices = []
+    for j in range(nInputs):
+        visited = set()
+        stack = [j]
+        while len(stack)>0:
+            for k in users[stack.pop()]:
+                if k not in visited:
+                    visited.add(k)
+                    stack.append(k)
+        indices.extend(sorted(visited))
+        indptr.append(len(indices))
+    return {"indptr": np.array(indptr, dtype=np.int32), "indices": np.array(indices, dtype=np.int32)}
+
+def instructionValue(name, i, value, operand1, operand2, blockEnd):
+
+    # Value of the arithmetic instruction i
+    if name in unaryOperations:
+        return unaryOperations[name](value[operand1[i]])
+    if name in binaryOperations:
+        return binaryOperations[name](value[operand1[i]], value[operand2[i]])
+    if name=="SELECT":
+        return value[operand1[i]] if value[blockEnd[i]]>0 else value[operand2[i]]
+    return value[operand1[i]]*value[operand2[i]] + value[blockEnd[i]]
+
+#------------------------------------------------------------------------------
+# Active inputs: the arguments compiled as passive (see AD_Tape.compile) are
+# inputs of the tape set at every evaluation, but the jacobians are computed
+# with respect to the other (active) inputs only. The derivatives are only
+# propagated through the instructions depending on an active input
+#------------------------------------------------------------------------------
+
+def getActiveInputs(function, passive):
+
+    # Mask of the inputs of the tape of the function that are not in the
+    # passive arguments, None if all of them are active
+    spec = inspect.getfullargspec(function)
+    for name in passive:
+        if name not in spec.args:
+            raise ValueError("passive argument %s is not an argument of %s"%(name, function.__name__))
+    if len(passive)==0:
+        return None
+    return np.concatenate([np.full(int(np.prod(default)), name not in passive, dtype=bool)
+                           for name, default in zip(spec.args, spec.defaults)])
+
+def activeInstructions(nInputs, activeInputs, arrays):
+
+    # Mask of the instructions depending on an active input through their
+    # differentiable operands (not the condition of SELECT nor the
+    # conditionals, whose derivatives are zero)
+    operand1, operand2 = arrays["operand1"].tolist(), arrays["operand2"].tolist()
+    operation, blockEnd = arrays["operation"].tolist(), arrays["blockEnd"].tolist()
+    FMA = operationsList["FMA"]
+    conditionals = set(operationsList[name] for name in conditionalOperations)
+
+    active = [False]*len(operation)
+    active[:nInputs] = [True]*nInputs if activeInputs is None else np.asarray(activeInputs, dtype=bool).tolist()
+    for i in range(nInputs, len(operation)):
+        if operation[i] in conditionals:
+            continue
+        op1, op2 = operand1[i], operand2[i]
+        active[i] = (op1!=-1 and active[op1]) or (op2!=-1 and active[op2]) or (operation[i]==FMA and active[blockEnd[i]])
+    return np.array(active, dtype=bool)
+
+#------------------------------------------------------------------------------
+# Class AD_Instruction: view of a single entry of an AD_InstructionArray
+#------------------------------------------------------------------------------
+
 class AD_Instruction:
 
-    def __init__(self, operand1, operand2, operation, value):
+    def __init__(self, instructions, index):
+
+        self.instructions = instructions
+        self.index        = index
+
+    @property
+    def blockEnd(self):
+        return int(self.instructions.blockEnd[self.index])
+
+    @blockEnd.setter
+    def blockEnd(self, newValue):
+        self.instructions.blockEnd[self.index] = newValue
+
+    @property
+    def operand1(self):
+        return int(self.instructions.operand1[self.index])
+
+    @operand1.setter
+    def operand1(self, newValue):
+        self.instructions.operand1[self.index] = newValue
+
+    @property
+    def operand2(self):
+        return int(self.instructions.operand2[self.index])
+
+    @operand2.setter
+    def operand2(self, newValue):
+        self.instructions.operand2[self.index] = newValue
+
+    # The operation is stored as an opcode but exposed by its name
+
+    @property
+    def operation(self):
+        return operationsNames[int(self.instructions.operation[self.index])]
+
+    @operation.setter
+    def operation(self, newValue):
+        self.instructions.operation[self.index] = operationsList[newValue]
+
+    @property
+    def value(self):
+        return self.instructions.value[self.index]
+
+    @value.setter
+    def value(self, newValue):
+        self.instructions.value[self.index] = newValue
+
+#------------------------------------------------------------------------------
+# Class AD_InstructionArray: struct-of-arrays storage of the tape instructions
+# (int32 blockEnd, operand1, operand2 and operation, float64 value), grown
+# geometrically so that appends are amortized O(1)
+#------------------------------------------------------------------------------
+
+class AD_InstructionArray:
+
+    fields = \
+    [
+        ("blockEnd",  np.int32),
+        ("operand1",  np.int32),
+        ("operand2",  np.int32),
+        ("operation", np.int32),
+        ("value",   np.float64)
+    ]
+
+    def __init__(self, capacity=1024, buffers=None):
+
+        # Existing arrays of equal length can be adopted as the buffers
+        if buffers is not None:
+            self.size    = len(buffers["value"])
+            self.buffers = buffers
+            return
+
+        self.size    = 0
+        self.buffers = {}
+        for name, dtype in self.fields:
+            self.buffers[name] = np.empty(capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i<0: i += self.size
+        if i<0 or i>=self.size:
+            raise IndexError("instruction index out of range")
+        return AD_Instruction(self, i)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield AD_Instruction(self, i)
+
+    def reserve(self, capacity):
+
+        if capacity<=len(self.buffers["value"]):
+            return
+        capacity = max(capacity, 2*len(self.buffers["value"]))
+        for name, dtype in self.fields:
+            buffer = np.empty(capacity, dtype=dtype)
+            buffer[:self.size] = self.buffers[name][:self.size]
+            self.buffers[name] = buffer
+
+    def append(self, operand1, operand2, operation, value):
+
+        if self.size==len(self.buffers["value"]):
+            self.reserve(self.size+1)
+        i = self.size
+        self.buffers["blockEnd"][i]  = -1
+        self.buffers["operand1"][i]  = operand1
+        self.buffers["operand2"][i]  = operand2
+        self.buffers["operation"][i] = operation
+        self.buffers["value"][i]     = value
+        self.size += 1
+
+    def extend(self, operand1, operand2, operation, value, blockEnd=-1):
+
+        n = len(value)
+        self.reserve(self.size+n)
+        i, j = self.size, self.size+n
+        self.buffers["blockEnd"][i:j]  = blockEnd
+        self.buffers["operand1"][i:j]  = operand1
+        self.buffers["operand2"][i:j]  = operand2
+        self.buffers["operation"][i:j] = operation
+        self.buffers["value"][i:j]     = value
+        self.size += n
+
+    # Views of the filled part of the buffers (invalidated when the buffers grow)
+
+    def getArrays(self):
+        return {name: self.buffers[name][:self.size] for name, dtype in self.fields}
+
+    @property
+    def blockEnd(self):
+        return self.buffers["blockEnd"][:self.size]
+
+    @property
+    def operand1(self):
+        return self.buffers["operand1"][:self.size]
+
+    @property
+    def operand2(self):
+        return self.buffers["operand2"][:self.size]
+
+    @property
+    def operation(self):
+        return self.buffers["operation"][:self.size]
+
+    @property
+    def value(self):
+        return self.buffers["value"][:self.size]
 
-        self.blockEnd  = -1
-        self.operand1  = operand1
-        self.operand2  = operand2
-        self.operation = operation
-        self.value     = value
-        
 class AD_Tape:
 
-    def __init__(self):
+    def __init__(self, collectStats=False):
 
         self.nInputs               = 0
         self.nOutputs              = 0
         self.idsOfConditionals     = []
-        self.instructions          = []
+        self.instructions          = AD_InstructionArray()
         
         self.conditionalValues     = []
         self.conditionalCounter    = 0
 
-        self.idsOfNonZeroConstants = [{}]
-        self.children              = [{}]
+        # Hash-consing table used to reuse previously recorded instructions:
+        # maps a key (see getKey) to the tape ID of the instruction. The keys
+        # added inside every open conditional block are kept in a stack of
+        # scopes, so that they can be forgotten when the block is left
+        self.hashCons              = {}
+        self.hashConsScopes        = [[]]
 
-    def getChildrenStructure(self):
+        # Tracing statistics and state (see compile): the number of times the
+        # function was traced, the conditionals whose outcome was already
+        # known on the traced path, and the log of the tape IDs returned
+        # while tracing, which is replayed for the part of a trace that is
+        # identical to the previous one
+        self.nTraces               = 0
+        self.nMemoizedConditionals = 0
+        self.knownConditions       = {}
+        self.replayLog             = None
+        self.replayMarks           = []
+        self.replayPosition        = 0
 
-        rtn = {}
-        for key in operationsList.keys():
-            rtn[key] = {}
-        return rtn
+        # State of evaluateIncremental
+        self.incrementalState      = None
+
+        # Mask of the inputs the jacobians are computed with respect to (see
+        # compile), None if all the inputs are active
+        self.activeInputs          = None
+
+        # Opt-in recording statistics (see getStats): None unless collectStats
+        self.stats = None
+        if collectStats:
+            self.stats = {"lookups": 0, "hits": 0, "replayed": 0, "peakTapeLength": 0,
+                          "times": {"inspect": 0.0, "trace": 0.0, "retrace": 0.0, "total": 0.0}}
+
+    def getKey(self, operand1, operand2, operation, value):
+
+        # Zero constants (which include the inputs) and conditionals are never shared
+        if operation=="CONST":
+            return (operation, value) if value!=0.0 else None
+        if operation in conditionalOperations:
+            return None
+        # Commutative operations are stored with ordered operands
+        if operation in commutativeOperations and operand2<operand1:
+            return (operation, operand2, operand1)
+        return (operation, operand1, operand2)
+
+    def pushScope(self):
+        self.hashConsScopes.append([])
+
+    def popScope(self):
+        hashCons = self.hashCons
+        for key in self.hashConsScopes.pop():
+            del hashCons[key]
+
+    def resetScope(self):
+        self.popScope()
+        self.pushScope()
+
+    def findOrAddInstruction(self, operand1, operand2, operation, value):
+
+        if self.replayLog is not None:
+            return self.replay(lambda: self.findOrAddInstruction(operand1, operand2, operation, value))
+
+        key = self.getKey(operand1, operand2, operation, value)
+        if key is not None:
+            tapeID = self.hashCons.get(key)
+            if self.stats is not None:
+                self.countLookups(1, tapeID is not None)
+            if tapeID is not None:
+                return tapeID
+        tapeID = len(self.instructions)
+        self.addInstruction(operand1, operand2, operation, value, key)
+        return tapeID
+
+    def replay(self, record):
+
+        # Returns the next tape ID(s) of the log, or records and logs them
+        # once the replayed part of the trace is over
+        log = self.replayLog
+        if self.replayPosition<len(log):
+            tapeID = log[self.replayPosition]
+            if self.stats is not None:
+                self.stats["replayed"] += 1
+        else:
+            self.replayLog = None
+            tapeID = record()
+            self.replayLog = log
+            log.append(tapeID.copy() if isinstance(tapeID, np.ndarray) else tapeID)
+        self.replayPosition += 1
+        return tapeID.copy() if isinstance(tapeID, np.ndarray) else tapeID
+
+    def findOrAddInstructions(self, operand1, operand2, operation, value=None, blockEnd=None, lookup=True):
+
+        # Vectorized version of findOrAddInstruction, for arrays of operands
+        # (operand1 and operand2 are None for constants, whose values are given,
+        # and blockEnd holds the conditions of SELECT instructions). With
+        # lookup=False new instructions are always added.
+        # Returns the array of tape IDs
+
+        if self.replayLog is not None:
+            return self.replay(lambda: self.findOrAddInstructions(operand1, operand2, operation, value, blockEnd, lookup))
+
+        n = len(value) if operand1 is None else len(operand1)
+        if operand1 is None:
+            operand1 = np.full(n, -1, dtype=np.int64)
+            operand2 = operand1
+        if value is None:
+            value = np.zeros(n)
+
+        if not lookup:
+            keys = [None]*n
+        elif operation=="CONST":
+            keys = [(operation, v) if v!=0.0 else None for v in value.tolist()]
+        elif operation in conditionalOperations:
+            keys = [None]*n
+        elif operation=="SELECT":
+            keys = zip([operation]*n, operand1.tolist(), operand2.tolist(), blockEnd.tolist())
+        elif operation=="FMA":
+            keys = zip([operation]*n, np.minimum(operand1, operand2).tolist(), np.maximum(operand1, operand2).tolist(),
+                       blockEnd.tolist())
+        elif operation in commutativeOperations:
+            keys = zip([operation]*n, np.minimum(operand1, operand2).tolist(), np.maximum(operand1, operand2).tolist())
+        else:
+            keys = zip([operation]*n, operand1.tolist(), operand2.tolist())
+
+        # Look up every entry, also among the entries added by this call
+        hashCons = self.hashCons
+        scope = self.hashConsScopes[-1]
+        nextID = len(self.instructions)
+        tapeIDs = []
+        added = []
+        for i, key in enumerate(keys):
+            tapeID = hashCons.get(key)
+            if tapeID is None:
+                tapeID = nextID
+                nextID += 1
+                added.append(i)
+                if key is not None:
+                    hashCons[key] = tapeID
+                    scope.append(key)
+            tapeIDs.append(tapeID)
 
-    def addInstruction(self, operand1, operand2, operation, value):
+        if self.stats is not None:
+            nLookups = sum(key is not None for key in keys) if isinstance(keys, list) else n
+            self.countLookups(nLookups, n-len(added))
 
-        if operation=="CONST" and value!=0.0:
-            self.idsOfNonZeroConstants[-1][value] = len(self.instructions)
+        if len(added)>0:
+            added = np.array(added)
+            self.instructions.extend(operand1[added], operand2[added], operationsList[operation], value[added],
+                                     blockEnd[added] if blockEnd is not None else -1)
+        return np.array(tapeIDs, dtype=np.int64)
 
-        if operation not in ["CONST", "IFEQ", "IFNE", "IFLT", "IFLE", "IFGT", "IFGE"]:
-            if operand1 not in self.children[-1].keys():
-                self.children[-1][operand1] = self.getChildrenStructure()
-            self.children[-1][operand1][operation][operand2] = len(self.instructions)
+    def countLookups(self, nLookups, nHits):
+        self.stats["lookups"] += nLookups
+        self.stats["hits"]    += int(nHits)
+
+    def addInstruction(self, operand1, operand2, operation, value, key=None):
+
+        if key is None:
+            key = self.getKey(operand1, operand2, operation, value)
+        if key is not None:
+            self.hashCons[key] = len(self.instructions)
+            self.hashConsScopes[-1].append(key)
         
-        if operation in ["IFEQ", "IFNE", "IFLT", "IFLE", "IFGT", "IFGE"]:
+        if operation in conditionalOperations:
             self.idsOfConditionals.append(len(self.instructions))
 
-        self.instructions.append(AD_Instruction(operand1, operand2, operation, value))
+        self.instructions.append(operand1, operand2, operationsList[operation], value)
+
+    def conditionKey(self, operand1, operand2, operation):
+
+        # Conditionals are identified by a canonical comparison (a<b or a==b,
+        # constants by their value) and the sense in which it is taken
+        t = self.instructions
+        def operand(i):
+            if i>=self.nInputs and t.operation[i]==operationsList["CONST"]:
+                return ("CONST", float(t.value[i]))
+            return i
+        x1, x2 = operand(operand1), operand(operand2)
+        if operation in ["IFEQ", "IFNE"]:
+            return ("EQ",) + tuple(sorted([x1, x2], key=repr)), operation=="IFEQ"
+        if operation in ["IFLT", "IFGE"]:
+            return ("LT", x1, x2), operation=="IFLT"
+        return ("LT", x2, x1), operation=="IFGT"
+
+    def recordConditional(self, operand1, operand2, operation):
+
+        # Called for every comparison while tracing, returns the branch to
+        # trace. The first time a conditional is met its True branch is
+        # traced, and after the whole block has been traced (see compile) the
+        # function is traced again with the conditional False, recording the
+        # complementary conditional. A comparison whose outcome is already
+        # known on the traced path (the same or the complementary comparison
+        # was made before) is not recorded at all
+
+        key, sense = self.conditionKey(operand1, operand2, operation)
+        known = self.knownConditions.get(key)
+        if known is not None:
+            self.nMemoizedConditionals += 1
+            return known==sense
+
+        counter = self.conditionalCounter
+        if counter>=len(self.conditionalValues):
+            # New conditional: open a scope for its block in the hash-consing table
+            self.addInstruction(operand1, operand2, operation, 0.0)
+            self.conditionalValues.append(True)
+            self.pushScope()
+            rtn = True
+        elif counter==len(self.conditionalValues)-1 and self.conditionalValues[-1]==False:
+            # Last registered conditional, now False: its True block is over,
+            # so start a fresh scope for the False block
+            self.addInstruction(operand1, operand2, complementOperations[operation], 0.0)
+            self.resetScope()
+            rtn = False
+        else:
+            # Registered conditional: the same block continues
+            rtn = self.conditionalValues[counter]
+
+        # The part of the next trace up to this conditional can be replayed
+        if counter<len(self.replayMarks):
+            self.replayMarks[counter] = self.replayPosition
+        else:
+            self.replayMarks.append(self.replayPosition)
+
+        self.conditionalCounter += 1
+        self.knownConditions[key] = (rtn==sense)
+        return rtn
+
+    def trace(self, function, argDict):
+
+        # Traces the function once, replaying the log of the previous trace up
+        # to the last registered conditional (the one whose branch changes)
+        if len(self.conditionalValues)>0:
+            del self.replayLog[self.replayMarks[len(self.conditionalValues)-1]:]
+        self.replayPosition = 0
+        self.conditionalCounter = 0
+        self.knownConditions = {}
+        self.nTraces += 1
+        start = time.perf_counter()
+        outputs = self.copyOutputs(function(**argDict))
+        if self.stats is not None:
+            self.stats["times"]["trace" if self.nTraces==1 else "retrace"] += time.perf_counter()-start
+            self.stats["peakTapeLength"] = max(self.stats["peakTapeLength"], len(self.instructions))
+        return outputs
+
+    def copyOutputs(self, outputs):
 
-    def initFunctionArgs(self, function):
+        # The outputs are copied (output*1.0) to the end of the tape, where the
+        # evaluators expect them, as new instructions: looked up in the
+        # hash-consing table, the copy of an output equal to another output
+        # (or to an instruction of the function) would be found elsewhere
+        outputs = [AD(self, output).getIDs() for output in outputs]
+        one = int(self.findOrAddInstructions(None, None, "CONST", value=np.ones(1))[0])
+        copies = []
+        for tapeIDs in outputs:
+            copy = self.findOrAddInstructions(tapeIDs.ravel(), np.full(tapeIDs.size, one, dtype=np.int64), "MUL", lookup=False)
+            copies.append(toADType(self, copy.reshape(tapeIDs.shape)))
+        return copies
+
+    def initFunctionArgs(self, function, passive=()):
 
         args = inspect.getfullargspec(function).args
         defaults = inspect.getfullargspec(function).defaults
+        self.activeInputs = getActiveInputs(function, passive)
         argDict = {}
         for i in range(len(args)):
             argDict[args[i]] = AD_Type(self, shape=defaults[i])
             self.nInputs += int(np.prod(defaults[i]))
         return argDict
 
-    def compile(self, function, kwargs={}):
+    def compile(self, function, kwargs={}, passive=()):
+
+        # The arguments named in passive are inputs of the tape, but the
+        # jacobians are not computed with respect to them (see activeInputs)
 
-        argDict = self.initFunctionArgs(function)
+        start = time.perf_counter()
+        argDict = self.initFunctionArgs(function, passive)
+        if self.stats is not None:
+            self.stats["times"]["inspect"] += time.perf_counter()-start
         for key in kwargs.keys():
             if key not in argDict.keys():
                 argDict[key] = kwargs[key]
 
-        self.conditionalCounter = 0
-        outputs = function(**argDict)
-        outputs = [output*1.0 for output in outputs]
+        self.replayLog = []
+        self.replayMarks = []
+        outputs = self.trace(function, argDict)
         
         for output in outputs:
             self.nOutputs += int(np.prod(output.shape))
@@ -106,83 +1086,1027 @@ class AD_Tape:
         while len(self.conditionalValues)>0:
             
             self.conditionalValues[-1] = False
-            self.instructions[self.idsOfConditionals[-1]].blockEnd = len(self.instructions)
+            self.instructions.blockEnd[self.idsOfConditionals[-1]] = len(self.instructions)
             self.addInstruction(-1, -1, "IFEND", 0.0)
-            self.instructions[-1].blockEnd = self.idsOfConditionals[-1]
+            self.instructions.blockEnd[-1] = self.idsOfConditionals[-1]
             self.idsOfConditionals = self.idsOfConditionals[:-1]
             
-            self.conditionalCounter = 0
-            outputs = function(**argDict)
-            outputs = [output*1.0 for output in outputs]
+            outputs = self.trace(function, argDict)
 
             tapeLength = len(self.instructions)
             
             while self.conditionalValues[-1]==False:
-                self.instructions[self.idsOfConditionals[-1]].blockEnd = tapeLength
+                self.instructions.blockEnd[self.idsOfConditionals[-1]] = tapeLength
                 self.addInstruction(-1, -1, "IFEND", 0.0)
-                self.instructions[-1].blockEnd = self.idsOfConditionals[-1]
+                self.instructions.blockEnd[-1] = self.idsOfConditionals[-1]
                 self.conditionalValues = self.conditionalValues[:-1]
                 self.idsOfConditionals = self.idsOfConditionals[:-1]
-                self.idsOfNonZeroConstants = self.idsOfNonZeroConstants[:-1]
-                self.children = self.children[:-1]
+                self.popScope()
                 if len(self.conditionalValues)==0:
                     break
 
+        self.replayLog = None
+        if self.stats is not None:
+            self.stats["times"]["total"] += time.perf_counter()-start
+
+    def getStats(self):
+
+        # Recording statistics of a tape created with collectStats=True: the
+        # number of instructions per operation, the hash-consing lookups and
+        # their hit rate, the number of traces (one per conditional branch
+        # after the first) and the time spent in each phase of compile, in
+        # seconds ("trace" is the first trace, "retrace" all the others)
+        if self.stats is None:
+            raise ValueError("The tape was not created with collectStats=True")
+
+        counts = np.bincount(self.instructions.operation, minlength=len(operationsList))
+        names = {code: name for name, code in operationsList.items()}
+        stats = self.stats
+        return {"instructions": {names[code]: int(n) for code, n in enumerate(counts) if n>0},
+                "tapeLength": len(self.instructions),
+                "peakTapeLength": max(stats["peakTapeLength"], len(self.instructions)),
+                "lookups": stats["lookups"],
+                "hits": stats["hits"],
+                "hitRate": stats["hits"]/stats["lookups"] if stats["lookups"]>0 else 0.0,
+                "replayed": stats["replayed"],
+                "traces": self.nTraces,
+                "retraces": max(self.nTraces-1, 0),
+                "memoizedConditionals": self.nMemoizedConditionals,
+                "times": dict(stats["times"])}
+
     def write(self, filename, readable=False):
 
+        t = self.instructions
         with open(filename, "w") as f:
 
-            f.write("%d %d %d\n"%(self.nInputs, self.nOutputs, len(self.instructions)))
-            for i in range(len(self.instructions)):
-                t = self.instructions[i]
+            f.write("%d %d %d\n"%(self.nInputs, self.nOutputs, len(t)))
+            rows = zip(t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist(), t.operation.tolist(), t.value.tolist())
+            for blockEnd, operand1, operand2, operation, value in rows:
                 if readable:
-                    f.write("%9d %9d %9d %5s %.15le\n"%(t.blockEnd, t.operand1, t.operand2, t.operation, t.value))
+                    f.write("%9d %9d %9d %5s %.15le\n"%(blockEnd, operand1, operand2, operationsNames[operation], value))
                 else:
-                    f.write("%9d %9d %9d %9d %.15le\n"%(t.blockEnd, t.operand1, t.operand2, operationsList[t.operation], t.value))
+                    f.write("%9d %9d %9d %9d %.15le\n"%(blockEnd, operand1, operand2, operation, value))
+
+    def writeBinary(self, filename):
+
+        writeBinaryTape(filename, self.nInputs, self.nOutputs, self.instructions.getArrays())
+
+    def readBinary(self, filename):
+
+        # The instructions are memory-mapped (copy-on-write), so loading takes
+        # constant time irrespective of the size of the tape. All the inputs
+        # of a tape read from a file are active
+        self.nInputs, self.nOutputs, arrays = readBinaryTape(filename)
+        self.instructions = AD_InstructionArray(buffers=arrays)
+        self.activeInputs = None
+
+    def generateC(self, filename, libName=None, compiler="cc", flags="-O3 -fPIC -shared"):
+
+        # Writes a C source evaluating the tape as straight-line code (one
+        # statement per instruction, the conditionals as branches) followed,
+        # at the end of every branch, by the reverse sweep over the
+        # instructions evaluated on that branch. The source exports
+        #   int SAD_kernelInputs, SAD_kernelOutputs;
+        #   void SAD_evaluateKernel(int nPoints, const double *inputs, double *outputs, double *jacobian);
+        # with the layout of evaluateTapeBatch in SAD.h (jacobian may be NULL).
+        # If libName is given, the source is compiled into a shared library
+        # that AD_EvalTape can load (kernel=libName)
+
+        t = self.instructions
+        nInputs, nOutputs, tapeSize = self.nInputs, self.nOutputs, len(t)
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        names = [operationsNames[op] for op in t.operation.tolist()]
+        value = t.value.tolist()
+
+        def literal(x):
+            if np.isnan(x):
+                return "NAN"
+            if np.isinf(x):
+                return "HUGE_VAL" if x>0 else "(-HUGE_VAL)"
+            return repr(x) if x>=0 else "(%r)"%x
+
+        # The values of the inputs and of the arithmetic instructions are held
+        # in v[ID] (and their adjoints in a[ID]), the other values are inlined.
+        # The arrays are allocated once per call of SAD_evaluateKernel, which
+        # keeps the compilation time of large tapes linear
+        isVariable = [i<nInputs or names[i] in cOperations for i in range(tapeSize)]
+
+        def operand(j):
+            return "v[%d]"%j if isVariable[j] else literal(value[j])
+
+        # The statements are grouped into functions of at most blockSize
+        # statements, so that the compilation time of large tapes stays linear
+        blockSize = 64
+        blocks = []
+        def addBlocks(statements, parameters, arguments):
+            calls = []
+            for beg in range(0, len(statements), blockSize):
+                blocks.append("static SAD_NOINLINE void block%d(%s)\n{\n%s\n}\n\n"
+                              %(len(blocks), parameters, "\n".join(statements[beg:beg+blockSize])))
+                calls.append("block%d(%s);"%(len(blocks)-1, arguments))
+            return calls
+
+        # Every branch (instructions from start to end, with the path of the
+        # instructions evaluated before it) is written after a label S<n>
+        body = []
+        branches = [(0, nInputs, tapeSize, None)]
+        nLabels = 1
+        nPartials = 0
+        while len(branches)>0:
+            label, i, end, parent = branches.pop()
+            body.append("S%d:;"%label)
+            node = ([], parent)
+            statements = []
+            while i<end:
+                name = names[i]
+                if name in cOperations:
+                    x2 = operand(operand2[i]) if operand2[i]!=-1 else ""
+                    c = operand(blockEnd[i]) if name in ternaryOperations else ""
+                    statements.append("  v[%d] = %s;"%(i, cOperations[name].format(x1=operand(operand1[i]), x2=x2, c=c)))
+                    node[0].append(i)
+                elif name in cConditions:
+                    body.extend("  "+call for call in addBlocks(statements, "double *v", "v"))
+                    body.append("  if(%s %s %s) goto S%d; else goto S%d;"%(operand(operand1[i]), cConditions[name],
+                                operand(operand2[i]), nLabels, nLabels+1))
+                    branches.append((nLabels+1, blockEnd[i]+1, end, node))
+                    branches.append((nLabels, i+1, blockEnd[i], node))
+                    nLabels += 2
+                    break
+                i += 1
+            else:
+                body.extend("  "+call for call in addBlocks(statements, "double *v", "v"))
+                segments = []
+                while node is not None:
+                    segments.append(node[0])
+                    node = node[1]
+                path = [i for segment in reversed(segments) for i in segment]
+                outputIDs = range(end-nOutputs, end)
+                for k, j in enumerate(outputIDs):
+                    body.append("  y[%d] = %s;"%(k, operand(j)))
+                body.append("  if(J==NULL) return;")
+
+                # The partial derivatives are computed once (in p) and shared
+                # by the sweeps of all the outputs
+                partials = []
+                sweep = []
+                for i in reversed(path):
+                    x1 = operand(operand1[i])
+                    x2 = operand(operand2[i]) if operand2[i]!=-1 else ""
+                    for op, d in zip((operand1[i], operand2[i]), cPartials[names[i]]):
+                        if d is None or not isVariable[op]:
+                            continue
+                        d = d.format(x1=x1, x2=x2, y="v[%d]"%i, c=operand(blockEnd[i]) if names[i]=="SELECT" else "")
+                        if "v[" in d:
+                            partials.append("  p[%d] = %s;"%(nPartials, d))
+                            d = "p[%d]"%nPartials
+                            nPartials += 1
+                        sweep.append("  a[%d] += %s*a[%d];"%(op, d, i))
+                    if names[i]=="FMA" and isVariable[blockEnd[i]]:
+                        sweep.append("  a[%d] += a[%d];"%(blockEnd[i], i))
+                body.extend("  "+call for call in addBlocks(partials, "const double *restrict v, double *restrict p", "v, p"))
+
+                body.append("  for(int k=0; k<%d; k++)"%nOutputs)
+                body.append("  {")
+                body.append("    memset(a, 0, %d*sizeof(double));"%end)
+                body.extend("    a[%d] += (k==%d);"%(j, k) for k, j in enumerate(outputIDs) if isVariable[j])
+                body.extend("    "+call for call in addBlocks(sweep, "double *restrict a, const double *restrict p", "a, p"))
+                body.append("    memcpy(J + k*%d, a, %d*sizeof(double));"%(nInputs, nInputs))
+                body.append("  }")
+                body.append("  return;")
+
+        with open(filename, "w") as f:
+            f.write("#include <math.h>\n#include <stdlib.h>\n#include <string.h>\n\n")
+            f.write("#ifdef __GNUC__\n#define SAD_NOINLINE __attribute__((noinline))\n#else\n#define SAD_NOINLINE\n#endif\n\n")
+            f.write("int SAD_kernelInputs  = %d;\nint SAD_kernelOutputs = %d;\n\n"%(nInputs, nOutputs))
+
+            f.write("".join(blocks))
+            f.write("static void evaluatePoint(const double *x, double *y, double *J, double *v, double *a, double *p)\n{\n")
+            f.write("  memcpy(v, x, %d*sizeof(double));\n"%nInputs)
+            f.write("\n".join(body))
+            f.write("\n}\n\n")
+            f.write("void SAD_evaluateKernel(int nPoints, const double *inputs, double *outputs, double *jacobian)\n{\n")
+            f.write("  double *v = (double*)malloc(%d*sizeof(double));\n"%max(tapeSize, 1))
+            f.write("  double *a = (double*)malloc(%d*sizeof(double));\n"%max(tapeSize, 1))
+            f.write("  double *p = (double*)malloc(%d*sizeof(double));\n"%max(nPartials, 1))
+            f.write("  for(int point=0; point<nPoints; point++)\n  {\n")
+            f.write("    evaluatePoint(inputs + (size_t)point*%d, outputs + (size_t)point*%d,\n"%(nInputs, nOutputs))
+            f.write("                  (jacobian!=NULL) ? jacobian + (size_t)point*%d : NULL, v, a, p);\n"%(nOutputs*nInputs))
+            f.write("  }\n  free(v);\n  free(a);\n  free(p);\n}\n")
+
+        if libName is not None:
+            subprocess.run([compiler] + flags.split() + [filename, "-o", libName, "-lm"], check=True)
+
+    def optimize(self):
+
+        # Optimizes the compiled tape in place: folds constant subexpressions,
+        # forwards multiplications and divisions by 1.0, fuses common patterns
+        # into single instructions, drops the trailing output copies where
+        # possible and removes the instructions that cannot reach an output.
+        # Returns the tape sizes before and after
+
+        t = self.instructions
+        nInputs, nOutputs, tapeSize = self.nInputs, self.nOutputs, len(t)
+        blockEnd = t.blockEnd.tolist()
+        operand1, operand2 = t.operand1.tolist(), t.operand2.tolist()
+        operation, value = t.operation.tolist(), t.value.tolist()
+
+        CONST, MUL, DIV = operationsList["CONST"], operationsList["MUL"], operationsList["DIV"]
+        IFEND, SELECT = operationsList["IFEND"], operationsList["SELECT"]
+        ADD, NEG, EXP, FMA = operationsList["ADD"], operationsList["NEG"], operationsList["EXP"], operationsList["FMA"]
+        conditionals = [operationsList[name] for name in conditionalOperations]
+        ternary = [operationsList[name] for name in ternaryOperations]
+
+        # Forward pass: constant folding and forwarding of the identities.
+        # alias[i] is the instruction used in place of instruction i
+        alias = list(range(tapeSize))
+        isConstant = [op==CONST for op in operation]
+        isConstant[:nInputs] = [False]*nInputs
+        nFolded = 0
+        nForwarded = 0
+        with np.errstate(all="ignore"):
+            for i in range(nInputs, tapeSize):
+                op = operation[i]
+                if op==CONST or op==IFEND:
+                    continue
+                op1 = operand1[i] = alias[operand1[i]]
+                op2 = operand2[i] = alias[operand2[i]] if operand2[i]!=-1 else -1
+                if op in conditionals:
+                    continue
+                if op==SELECT:
+                    # A select with a constant condition (or equal operands) is forwarded
+                    condition = blockEnd[i] = alias[blockEnd[i]]
+                    if isConstant[condition] or op1==op2:
+                        alias[i] = op1 if op1==op2 or value[condition]>0 else op2
+                        nForwarded += 1
+                    continue
+                if op==FMA:
+                    addend = blockEnd[i] = alias[blockEnd[i]]
+                    if isConstant[op1] and isConstant[op2] and isConstant[addend]:
+                        value[i] = value[op1]*value[op2] + value[addend]
+                        operation[i], operand1[i], operand2[i], blockEnd[i] = CONST, -1, -1, -1
+                        isConstant[i] = True
+                        nFolded += 1
+                    continue
+                name = operationsNames[op]
+                if isConstant[op1] and (op2==-1 or isConstant[op2]):
+                    if op2==-1:
+                        value[i] = float(unaryOperations[name](np.float64(value[op1])))
+                    else:
+                        value[i] = float(binaryOperations[name](np.float64(value[op1]), np.float64(value[op2])))
+                    operation[i], operand1[i], operand2[i] = CONST, -1, -1
+                    isConstant[i] = True
+                    nFolded += 1
+                elif (op==MUL or op==DIV) and isConstant[op2] and value[op2]==1.0:
+                    alias[i] = op1
+                    nForwarded += 1
+                elif op==MUL and isConstant[op1] and value[op1]==1.0:
+                    alias[i] = op2
+                    nForwarded += 1
+
+        isConditional = [op in conditionals for op in operation]
+        outputEnds = getOutputEnds(nInputs, nOutputs, t.getArrays())
+
+        # Peephole pass: fuses x*y+z into FMA, x*x into SQUARE, 1/x into RECIP,
+        # 1/(1+exp(-x)) into SIGMOID and x/(1+exp(-x)) or x*sigmoid(x) into
+        # SWISH. The fused intermediate instructions must have no other use
+        # (they are then removed as dead code)
+        uses = [0]*tapeSize
+        for i in range(nInputs, tapeSize):
+            if alias[i]==i and operation[i]!=CONST and operation[i]!=IFEND:
+                for j in [operand1[i], operand2[i]] + ([blockEnd[i]] if operation[i] in ternary else []):
+                    if j!=-1: uses[j] += 1
+        for end in outputEnds:
+            for k in range(end-nOutputs, end):
+                uses[alias[k]] += 1
+
+        def isOne(j):
+            return isConstant[j] and value[j]==1.0
+
+        def onePlusExpNeg(j):
+            # x if instruction j is 1+exp(-x), -1 otherwise
+            if operation[j]!=ADD or uses[j]!=1:
+                return -1
+            e = operand2[j] if isOne(operand1[j]) else operand1[j] if isOne(operand2[j]) else -1
+            if e==-1 or operation[e]!=EXP or uses[e]!=1 or operation[operand1[e]]!=NEG or uses[operand1[e]]!=1:
+                return -1
+            return operand1[operand1[e]]
+
+        fused = {}
+        for i in range(nInputs, tapeSize):
+            op, op1, op2 = operation[i], operand1[i], operand2[i]
+            if alias[i]!=i:
+                continue
+            if op==DIV:
+                x = onePlusExpNeg(op2)
+                if x!=-1 and (isOne(op1) or op1==x):
+                    fused[i] = ("SIGMOID" if isOne(op1) else "SWISH", x, -1, -1)
+                elif isOne(op1):
+                    fused[i] = ("RECIP", op2, -1, -1)
+            elif op==MUL:
+                if op1==op2:
+                    fused[i] = ("SQUARE", op1, -1, -1)
+                for x, y in [(op1, op2), (op2, op1)]:
+                    if operationsNames[operation[y]]=="SIGMOID" and operand1[y]==x and uses[y]==1:
+                        fused[i] = ("SWISH", x, -1, -1)
+            elif op==ADD:
+                for m, c in [(op1, op2), (op2, op1)]:
+                    if uses[m]==1 and operation[m]==MUL:
+                        fused[i] = ("FMA", operand1[m], operand2[m], c)
+                    elif uses[m]==1 and operationsNames[operation[m]]=="SQUARE":
+                        fused[i] = ("FMA", operand1[m], operand1[m], c)
+                    if i in fused:
+                        break
+            if i in fused:
+                name, operand1[i], operand2[i], blockEnd[i] = fused[i]
+                operation[i] = operationsList[name]
+
+        # An output region made of copies of the instructions immediately
+        # preceding it is dropped, and these instructions become the outputs
+        keep = [True]*tapeSize
+        live = [False]*tapeSize
+        for end in outputEnds:
+            start = end - nOutputs
+            sources = [alias[i] for i in range(start, end)]
+            isCopy = start-nOutputs>=nInputs and all(sources[k]==start-nOutputs+k for k in range(nOutputs))
+            isCopy = isCopy and not any(isConditional[i] or operation[i]==IFEND for i in range(start-nOutputs, start))
+            for k in range(nOutputs):
+                if isCopy:
+                    keep[start+k] = False
+                    live[sources[k]] = True
+                else:
+                    live[start+k] = True
+
+        # Backward pass: dead-code elimination. The inputs and the
+        # conditional structure are always kept
+        for i in range(tapeSize):
+            if i<nInputs or isConditional[i] or operation[i]==IFEND:
+                live[i] = True
+        for i in range(tapeSize-1, nInputs-1, -1):
+            if live[i] and keep[i] and operation[i]!=IFEND:
+                if operand1[i]!=-1: live[operand1[i]] = True
+                if operand2[i]!=-1: live[operand2[i]] = True
+                if operation[i] in ternary: live[blockEnd[i]] = True
+
+        # Compaction and renumbering of the operands and the block links
+        live = np.array(live) & np.array(keep)
+        newID = np.cumsum(live) - 1
+        ids = np.nonzero(live)[0]
+        operand1, operand2 = np.array(operand1)[ids], np.array(operand2)[ids]
+        blockEnd = np.array(blockEnd)[ids]
+        arrays = {}
+        arrays["operand1"]  = np.where(operand1!=-1, newID[operand1], -1).astype(np.int32)
+        arrays["operand2"]  = np.where(operand2!=-1, newID[operand2], -1).astype(np.int32)
+        arrays["blockEnd"]  = np.where(blockEnd!=-1, newID[blockEnd], -1).astype(np.int32)
+        arrays["operation"] = np.array(operation, dtype=np.int32)[ids]
+        arrays["value"]     = np.array(value, dtype=np.float64)[ids]
+        self.instructions = AD_InstructionArray(buffers=arrays)
+
+        # The tape IDs have changed, so nothing recorded so far can be reused
+        self.hashCons         = {}
+        self.hashConsScopes   = [[]]
+        self.incrementalState = None
+
+        return {"before": tapeSize, "after": len(ids), "folded": nFolded,
+                "forwarded": nForwarded, "fused": len(fused), "removed": tapeSize-len(ids)}
+
+    def evaluatePath(self, inputs, mask=None):
+
+        # Evaluates the tape at a point (the values are stored in
+        # instructions.value) and returns the IDs of the arithmetic
+        # instructions on the evaluated path, and the effective tape size.
+        # Only the instructions of the mask are evaluated, if given (see
+        # outputConeMask)
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd, t.operand1, t.operand2
+        operation, value = t.operation, t.value
+        mask = mask.tolist() if mask is not None else None
+
+        path = []
+        effSize = len(t)
+        value[:self.nInputs] = inputs
+        i = self.nInputs
+        while i<effSize:
+            if mask is not None and not mask[i]:
+                i += 1
+                continue
+            name = operationsNames[operation[i]]
+            if name in unaryOperations:
+                value[i] = unaryOperations[name](value[operand1[i]])
+                path.append(i)
+            elif name in binaryOperations:
+                value[i] = binaryOperations[name](value[operand1[i]], value[operand2[i]])
+                path.append(i)
+            elif name=="SELECT":
+                value[i] = value[operand1[i]] if value[blockEnd[i]]>0 else value[operand2[i]]
+                path.append(i)
+            elif name=="FMA":
+                value[i] = value[operand1[i]]*value[operand2[i]] + value[blockEnd[i]]
+                path.append(i)
+            elif name in conditionalOperations:
+                if conditionalOperations[name](value[operand1[i]], value[operand2[i]]):
+                    effSize = blockEnd[i]
+                else:
+                    i = blockEnd[i]
+            i += 1
+        return path, effSize
 
     def evaluate(self, inputs):
 
-        effSize = len(self.instructions)
-        for i in range(self.nInputs):
-            self.instructions[i].value = inputs[i]
-        for i in range(self.nInputs,effSize):
-            y = self.instructions[i]
-            x1 = self.instructions[y.operand1].value
-            x2 = self.instructions[y.operand2].value
-            if y.operation=="IFEQ":
-                if(x1==x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="IFNE":
-                if(x1!=x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="IFLT":
-                if(x1< x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="IFGE":
-                if(x1>=x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="IFGT":
-                if(x1> x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="IFLE":
-                if(x1<=x2): effSize=y.blockEnd
-                else: i=y.blockEnd;
-            if y.operation=="NEG":   y.value = -x1
-            if y.operation=="ADD":   y.value = x1+x2
-            if y.operation=="SUB":   y.value = x1-x2
-            if y.operation=="MUL":   y.value = x1*x2
-            if y.operation=="DIV":   y.value = x1/x2
-            if y.operation=="POW":   y.value = x1**x2
-            if y.operation=="ABS":   y.value = np.abs(x1)
-            if y.operation=="EXP":   y.value = np.exp(x1)
-            if y.operation=="LOG":   y.value = np.log(x1)
-            if y.operation=="SQRT":  y.value = np.sqrt(x1)
-            if y.operation=="MAX":   y.value = np.maximum(x1,x2)
-            if y.operation=="MIN":   y.value = np.minimum(x1,x2)
-            if y.operation=="SIN":   y.value = np.sin(x1)
-            if y.operation=="COS":   y.value = np.cos(x1)
-            if y.operation=="TAN":   y.value = np.tan(x1)
-            if y.operation=="SINH":  y.value = np.sinh(x1)
-            if y.operation=="COSH":  y.value = np.cosh(x1)
-            if y.operation=="TANH":  y.value = np.tanh(x1)
-        return [self.instructions[i].value for i in range(effSize-self.nOutputs,effSize)]
+        path, effSize = self.evaluatePath(inputs)
+        value = self.instructions.value
+        return [value[i] for i in range(effSize-self.nOutputs,effSize)]
+
+    def propagateTangents(self, path, tangent):
+
+        # Forward sweep over an evaluated path: tangent[i] holds the tangents
+        # of instruction i for all directions (the rows of the inputs are set)
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        operation, value = t.operation.tolist(), t.value
+        for i in path:
+            name = operationsNames[operation[i]]
+            op1, op2 = operand1[i], operand2[i]
+            if name=="SELECT":
+                d1 = 1.0*(value[blockEnd[i]]>0)
+                d2 = 1.0 - d1
+            else:
+                d1, d2 = partialDerivatives[name](value[op1], value[op2] if op2!=-1 else 0.0, value[i])
+            if op2!=-1:
+                np.add(d1*tangent[op1], d2*tangent[op2], out=tangent[i])
+            else:
+                np.multiply(d1, tangent[op1], out=tangent[i])
+            if name=="FMA":
+                tangent[i] += tangent[blockEnd[i]]
+
+    def propagateAdjoints(self, path, adjoint):
+
+        # Reverse sweep over an evaluated path: adjoint[i] holds the adjoints
+        # of instruction i for all the seeded outputs
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        operation, value = t.operation.tolist(), t.value
+        for i in reversed(path):
+            name = operationsNames[operation[i]]
+            op1, op2 = operand1[i], operand2[i]
+            if name=="SELECT":
+                d1 = 1.0*(value[blockEnd[i]]>0)
+                d2 = 1.0 - d1
+            else:
+                d1, d2 = partialDerivatives[name](value[op1], value[op2] if op2!=-1 else 0.0, value[i])
+            adjoint[op1] += d1*adjoint[i]
+            if op2!=-1:
+                adjoint[op2] += d2*adjoint[i]
+            if name=="FMA":
+                adjoint[blockEnd[i]] += adjoint[i]
+
+    def propagateSecondOrderAdjoints(self, path, tangent, adjoint, adjointTangent):
+
+        # Forward-over-reverse sweep over an evaluated path, after
+        # propagateTangents: adjoint[i] holds the adjoint of instruction i and
+        # adjointTangent[i] its derivatives along all the directions of tangent
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        operation, value = t.operation.tolist(), t.value
+        for i in reversed(path):
+            name = operationsNames[operation[i]]
+            op1, op2 = operand1[i], operand2[i]
+            x1, x2 = value[op1], value[op2] if op2!=-1 else 0.0
+            if name=="SELECT":
+                d1 = 1.0*(value[blockEnd[i]]>0)
+                d2 = 1.0 - d1
+            else:
+                d1, d2 = partialDerivatives[name](x1, x2, value[i])
+            adjoint[op1] += d1*adjoint[i]
+            adjointTangent[op1] += d1*adjointTangent[i]
+            if op2!=-1:
+                adjoint[op2] += d2*adjoint[i]
+                adjointTangent[op2] += d2*adjointTangent[i]
+            if name=="FMA":
+                adjoint[blockEnd[i]] += adjoint[i]
+                adjointTangent[blockEnd[i]] += adjointTangent[i]
+            if name in secondPartialDerivatives and adjoint[i]!=0.0:
+                d11, d12, d22 = secondPartialDerivatives[name](x1, x2, value[i])
+                x1d, x2d = tangent[op1], tangent[op2] if op2!=-1 else 0.0
+                adjointTangent[op1] += adjoint[i]*(d11*x1d + d12*x2d)
+                if op2!=-1:
+                    adjointTangent[op2] += adjoint[i]*(d12*x1d + d22*x2d)
+
+    def evaluateHessianVector(self, inputs, vectors, weights=None):
+
+        # Forward-over-reverse mode: returns the outputs, the gradient and the
+        # products of the Hessian with the given vectors, (nInputs, nVectors),
+        # of the sum of the outputs weighted by weights (all ones by default).
+        # All the vectors share a single forward and reverse sweep
+
+        vectors = np.asarray(vectors, dtype=np.float64)
+        weights = np.ones(self.nOutputs) if weights is None else np.asarray(weights, dtype=np.float64)
+        path, effSize = self.evaluatePath(inputs)
+        outputIDs = np.arange(effSize-self.nOutputs, effSize)
+        tapeSize = len(self.instructions)
+
+        tangent = np.zeros((tapeSize, vectors.reshape(self.nInputs, -1).shape[1]))
+        tangent[:self.nInputs] = vectors.reshape(self.nInputs, -1)
+        self.propagateTangents(path, tangent)
+        adjoint = np.zeros(tapeSize)
+        adjoint[outputIDs] = weights
+        adjointTangent = np.zeros_like(tangent)
+        self.propagateSecondOrderAdjoints(path, tangent, adjoint, adjointTangent)
+
+        hessianVector = adjointTangent[:self.nInputs].reshape(vectors.shape)
+        return self.instructions.value[outputIDs].copy(), adjoint[:self.nInputs].copy(), hessianVector
+
+    def evaluateHessian(self, inputs, weights=None, chunkWidth=64):
+
+        # Returns the outputs, the gradient and the dense (nInputs, nInputs)
+        # Hessian of the weighted sum of the outputs, with one
+        # forward-over-reverse sweep per chunk of chunkWidth inputs
+
+        hessian = np.zeros((self.nInputs, self.nInputs))
+        for beg in range(0, max(self.nInputs, 1), chunkWidth):
+            end = min(beg+chunkWidth, self.nInputs)
+            vectors = np.zeros((self.nInputs, end-beg))
+            vectors[beg:end] = np.eye(end-beg)
+            outputs, gradient, hessian[:, beg:end] = self.evaluateHessianVector(inputs, vectors, weights)
+        return outputs, gradient, hessian
+
+    def hessianColoring(self):
+        return hessianColoring(self.nInputs, self.nOutputs, self.instructions.getArrays())
+
+    def evaluateSparseHessian(self, inputs, weights=None, coloring=None):
+
+        # Returns the outputs, the gradient and the Hessian of the weighted sum
+        # of the outputs in CSR format (data, indices, indptr), with one
+        # Hessian-vector product per color of the coloring (see
+        # hessianColoring, computed here if not given)
+
+        if coloring is None:
+            coloring = self.hessianColoring()
+        indptr, indices, colors = coloring["indptr"], coloring["indices"], coloring["colors"]
+        vectors = np.zeros((self.nInputs, coloring["nColors"]))
+        vectors[np.arange(self.nInputs), colors] = 1.0
+        outputs, gradient, hessianVectors = self.evaluateHessianVector(inputs, vectors, weights)
+        rows = np.repeat(np.arange(self.nInputs), np.diff(indptr))
+        return outputs, gradient, (hessianVectors[rows, colors[indices]], indices, indptr)
+
+    def evaluateTangents(self, inputs, directions):
+
+        # Forward mode: returns the outputs and the derivatives of the outputs
+        # along the given directions, (nOutputs, nDirections)
+
+        directions = np.asarray(directions, dtype=np.float64).reshape(self.nInputs, -1)
+        path, effSize = self.evaluatePath(inputs)
+        tangent = np.zeros((len(self.instructions), directions.shape[1]))
+        tangent[:self.nInputs] = directions
+        self.propagateTangents(path, tangent)
+        outputIDs = np.arange(effSize-self.nOutputs, effSize)
+        return self.instructions.value[outputIDs].copy(), tangent[outputIDs]
+
+    def activeInputIDs(self):
+        if self.activeInputs is None:
+            return np.arange(self.nInputs)
+        return np.flatnonzero(self.activeInputs)
+
+    def activeInstructions(self):
+        return activeInstructions(self.nInputs, self.activeInputs, self.instructions.getArrays())
+
+    def activePath(self, path):
+
+        # The instructions of an evaluated path with nonzero derivatives
+        if self.activeInputs is None:
+            return path
+        active = self.activeInstructions().tolist()
+        return [i for i in path if active[i]]
+
+    def evaluateJacobian(self, inputs, mode="auto", chunkWidth=64):
+
+        # Returns the outputs and the (nOutputs, nActive) jacobian with
+        # respect to the active inputs (all of them unless some arguments were
+        # compiled as passive), computed with forward sweeps over chunks of
+        # chunkWidth active inputs or reverse sweeps over chunks of chunkWidth
+        # outputs. With mode="auto" the forward mode is used if the tape has
+        # no more active inputs than outputs
+
+        activeIDs = self.activeInputIDs()
+        nActive = len(activeIDs)
+        if mode=="auto":
+            mode = "forward" if nActive<=self.nOutputs else "reverse"
+
+        path, effSize = self.evaluatePath(inputs)
+        path = self.activePath(path)
+        outputIDs = np.arange(effSize-self.nOutputs, effSize)
+        outputs = self.instructions.value[outputIDs].copy()
+        jacobian = np.zeros((self.nOutputs, nActive))
+        tapeSize = len(self.instructions)
+
+        if mode=="forward":
+            for beg in range(0, nActive, chunkWidth):
+                end = min(beg+chunkWidth, nActive)
+                tangent = np.zeros((tapeSize, end-beg))
+                tangent[activeIDs[beg:end], np.arange(end-beg)] = 1.0
+                self.propagateTangents(path, tangent)
+                jacobian[:, beg:end] = tangent[outputIDs]
+        elif mode=="reverse":
+            for beg in range(0, self.nOutputs, chunkWidth):
+                end = min(beg+chunkWidth, self.nOutputs)
+                adjoint = np.zeros((tapeSize, end-beg))
+                adjoint[outputIDs[beg:end], np.arange(end-beg)] = 1.0
+                self.propagateAdjoints(path, adjoint)
+                jacobian[beg:end] = adjoint[activeIDs].T
+        else:
+            raise ValueError("unknown jacobian mode %s"%mode)
+
+        return outputs, jacobian
+
+    def jacobianColoring(self):
+        return jacobianColoring(self.nInputs, self.nOutputs, self.instructions.getArrays())
+
+    def evaluateSparseJacobian(self, inputs, coloring=None, mode="auto"):
+
+        # Returns the outputs and the jacobian in CSR format (data, indices,
+        # indptr), computed with one sweep per color of the coloring (see
+        # jacobianColoring, computed here if not given): forward sweeps seeded
+        # with the sums of the columns of each color, or reverse sweeps seeded
+        # with the sums of the rows of each color. With mode="auto" the mode
+        # needing the fewest sweeps is used
+
+        if coloring is None:
+            coloring = self.jacobianColoring()
+        if mode=="auto":
+            mode = "forward" if coloring["nColumnColors"]<=coloring["nRowColors"] else "reverse"
+
+        indptr, indices = coloring["indptr"], coloring["indices"]
+        rows = np.repeat(np.arange(self.nOutputs), np.diff(indptr))
+        path, effSize = self.evaluatePath(inputs)
+        outputIDs = np.arange(effSize-self.nOutputs, effSize)
+        outputs = self.instructions.value[outputIDs].copy()
+        tapeSize = len(self.instructions)
+
+        if mode=="forward":
+            colors = coloring["columnColors"]
+            tangent = np.zeros((tapeSize, coloring["nColumnColors"]))
+            tangent[np.arange(self.nInputs), colors] = 1.0
+            self.propagateTangents(path, tangent)
+            data = tangent[outputIDs[rows], colors[indices]]
+        elif mode=="reverse":
+            colors = coloring["rowColors"]
+            adjoint = np.zeros((tapeSize, coloring["nRowColors"]))
+            adjoint[outputIDs, colors] = 1.0
+            self.propagateAdjoints(path, adjoint)
+            data = adjoint[indices, colors[rows]]
+        else:
+            raise ValueError("unknown jacobian mode %s"%mode)
+
+        return outputs, (data, indices, indptr)
+
+    def outputCones(self):
+        return outputCones(self.nInputs, self.nOutputs, self.instructions.getArrays())
+
+    def outputConeMask(self, outputs, cones=None):
+        if cones is None:
+            cones = self.outputCones()
+        return outputConeMask(len(self.instructions), outputs, cones)
+
+    def evaluateSubset(self, inputs, outputs, cones=None):
+
+        # Returns the values of the given outputs (a list of output indices),
+        # evaluating only the instructions of their cones (see outputCones,
+        # computed here if not given)
+
+        path, effSize = self.evaluatePath(inputs, self.outputConeMask(outputs, cones))
+        value = self.instructions.value
+        return [value[effSize-self.nOutputs+k] for k in outputs]
+
+    def evaluateSubsetJacobian(self, inputs, outputs, cones=None, chunkWidth=64):
+
+        # Returns the values and the (len(outputs), nActive) jacobian rows of
+        # the given outputs with respect to the active inputs, with reverse
+        # sweeps over the instructions of their cones only
+
+        outputs = np.asarray(outputs, dtype=np.int64)
+        path, effSize = self.evaluatePath(inputs, self.outputConeMask(outputs, cones))
+        path = self.activePath(path)
+        activeIDs = self.activeInputIDs()
+        outputIDs = effSize - self.nOutputs + outputs
+        jacobian = np.zeros((len(outputs), len(activeIDs)))
+        tapeSize = len(self.instructions)
+        for beg in range(0, len(outputs), chunkWidth):
+            end = min(beg+chunkWidth, len(outputs))
+            adjoint = np.zeros((tapeSize, end-beg))
+            adjoint[outputIDs[beg:end], np.arange(end-beg)] = 1.0
+            self.propagateAdjoints(path, adjoint)
+            jacobian[beg:end] = adjoint[activeIDs].T
+        return self.instructions.value[outputIDs].copy(), jacobian
+
+    def inputDependents(self):
+        return inputDependents(self.nInputs, self.nOutputs, self.instructions.getArrays())
+
+    def evaluateIncremental(self, inputs, dependents=None):
+
+        # Stateful evaluation: returns the outputs like evaluate, but only
+        # re-evaluates the instructions of the last evaluated path depending
+        # on the inputs that changed since the previous call (see
+        # inputDependents, computed on the first call if not given). If the
+        # outcome of a conditional changes, the whole tape is evaluated again.
+        # The state has its own values, so other evaluations do not affect it.
+        # incrementalState["nEvaluated"] holds the number of instructions
+        # evaluated by the last call
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        operation = t.operation.tolist()
+        inputs = np.array(inputs, dtype=np.float64).ravel()
+
+        state = self.incrementalState
+        if state is None:
+            state = self.incrementalState = {"dependents": dependents if dependents is not None else self.inputDependents(),
+                                             "value": t.value.copy(), "inputs": None, "nEvaluated": 0, "nFullEvaluations": 0}
+        value = state["value"]
+
+        isValid = state["inputs"] is not None
+        if isValid:
+            changed = np.nonzero(inputs!=state["inputs"])[0]
+            indptr, indices = state["dependents"]["indptr"], state["dependents"]["indices"]
+            dirty = np.unique(np.concatenate([indices[indptr[j]:indptr[j+1]] for j in changed] + [np.zeros(0, dtype=np.int32)]))
+            dirty = dirty[state["onPath"][dirty]]
+            value[changed] = inputs[changed]
+            for i in dirty.tolist():
+                name = operationsNames[operation[i]]
+                if name in conditionalOperations:
+                    if bool(conditionalOperations[name](value[operand1[i]], value[operand2[i]]))!=state["outcome"][i]:
+                        isValid = False
+                        break
+                else:
+                    value[i] = instructionValue(name, i, value, operand1, operand2, blockEnd)
+            state["nEvaluated"] = len(dirty)
+
+        if not isValid:
+            # Full evaluation, recording the path and the outcomes of the conditionals
+            value[:self.nInputs] = inputs
+            onPath = np.zeros(len(t), dtype=bool)
+            outcome = {}
+            effSize = len(t)
+            i = self.nInputs
+            while i<effSize:
+                onPath[i] = True
+                name = operationsNames[operation[i]]
+                if name in conditionalOperations:
+                    outcome[i] = bool(conditionalOperations[name](value[operand1[i]], value[operand2[i]]))
+                    if outcome[i]:
+                        effSize = blockEnd[i]
+                    else:
+                        i = blockEnd[i]
+                elif name!="CONST" and name!="IFEND":
+                    value[i] = instructionValue(name, i, value, operand1, operand2, blockEnd)
+                i += 1
+            state.update({"onPath": onPath, "outcome": outcome, "effSize": effSize, "nEvaluated": int(onPath.sum())})
+            state["nFullEvaluations"] += 1
+
+        state["inputs"] = inputs
+        effSize = state["effSize"]
+        return [value[i] for i in range(effSize-self.nOutputs, effSize)]
+
+    def evaluateBatch(self, inputs, chunkSize=65536):
+
+        # inputs: (nPoints, nInputs) array, returns (nPoints, nOutputs) array
+        # Points are evaluated in chunks to bound the size of the workspace
+
+        inputs = np.atleast_2d(np.asarray(inputs, dtype=np.float64))
+        nPoints = inputs.shape[0]
+        outputs = np.empty((nPoints, self.nOutputs))
+        for beg in range(0, nPoints, chunkSize):
+            end = min(beg+chunkSize, nPoints)
+            outputs[beg:end] = self.evaluateChunk(inputs[beg:end])
+        return outputs
+
+    def evaluateChunk(self, inputs):
+
+        nPoints = inputs.shape[0]
+        tapeSize = len(self.instructions)
+
+        # One row of values per instruction, one column per point
+        values = np.empty((tapeSize, nPoints))
+        values[:self.nInputs] = inputs.T
+
+        # Every point stops at the end of the innermost true conditional block,
+        # and skips the blocks of false conditionals. The points currently on
+        # the tape are tracked with a mask, which is updated at the indices
+        # (events) where points leave or re-enter the tape
+        effSize = np.full(nPoints, tapeSize)
+        active = np.ones(nPoints, dtype=bool)
+        allActive = True
+        events = {}
+
+        t = self.instructions
+        blockEnd, operand1, operand2 = t.blockEnd.tolist(), t.operand1.tolist(), t.operand2.tolist()
+        operation, value = t.operation.tolist(), t.value.tolist()
+
+        for i in range(self.nInputs, tapeSize):
+
+            if i in events:
+                for mask, state in events.pop(i):
+                    active[mask] = state
+                allActive = bool(active.all())
+                if not active.any() and len(events)==0:
+                    break
+
+            name = operationsNames[operation[i]]
+            where = True if allActive else active
+
+            # Only the points on the tape are computed (the values of the
+            # others are not initialized)
+            if name=="CONST":
+                np.copyto(values[i], value[i], where=where)
+            elif name in unaryOperations:
+                unaryOperations[name](values[operand1[i]], out=values[i], where=where)
+            elif name in binaryOperations:
+                binaryOperations[name](values[operand1[i]], values[operand2[i]], out=values[i], where=where)
+            elif name=="SELECT":
+                np.copyto(values[i], np.where(values[blockEnd[i]]>0, values[operand1[i]], values[operand2[i]]), where=where)
+            elif name=="FMA":
+                np.multiply(values[operand1[i]], values[operand2[i]], out=values[i], where=where)
+                np.add(values[i], values[blockEnd[i]], out=values[i], where=where)
+            elif name in conditionalOperations:
+                isTrue = conditionalOperations[name](values[operand1[i]], values[operand2[i]])
+                isTrue &= active
+                isFalse = active & ~isTrue
+                effSize[isTrue] = blockEnd[i]
+                events.setdefault(blockEnd[i], []).append((isTrue, False))
+                events.setdefault(blockEnd[i]+1, []).append((isFalse, True))
+                active &= isTrue
+                allActive = bool(active.all())
+
+        outputIDs = effSize[:,None] - self.nOutputs + np.arange(self.nOutputs)[None,:]
+        return values[outputIDs, np.arange(nPoints)[:,None]]
+
+#------------------------------------------------------------------------------
+# Class AD_TapeCache: on-disk cache of compiled tapes. A tape is identified by
+# a hash of the function (its bytecode, constants, defaults and closure, and
+# recursively the functions and values of the globals it refers to) and of
+# the kwargs. The tapes are stored as binary tape files (see writeBinary),
+# optionally with the library generated by generateC, and the least recently
+# used entries are removed when the cache exceeds maxSize bytes
+#------------------------------------------------------------------------------
+
+def hashObject(obj, h, seen):
+
+    if isinstance(obj, types.FunctionType):
+        h.update(("function %s.%s"%(obj.__module__, obj.__qualname__)).encode())
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        hashCode(obj.__code__, obj.__globals__, h, seen)
+        hashObject(obj.__defaults__, h, seen)
+        hashObject(obj.__kwdefaults__, h, seen)
+        for cell in obj.__closure__ or ():
+            try:
+                hashObject(cell.cell_contents, h, seen)
+            except ValueError:
+                h.update(b"empty cell")
+    elif isinstance(obj, types.CodeType):
+        hashCode(obj, {}, h, seen)
+    elif isinstance(obj, np.ndarray):
+        h.update(("array %s %s"%(obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(("%s %d"%(type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            hashObject(item, h, seen)
+    elif isinstance(obj, dict):
+        h.update(("dict %d"%len(obj)).encode())
+        for key in sorted(obj.keys(), key=repr):
+            hashObject(key, h, seen)
+            hashObject(obj[key], h, seen)
+    elif isinstance(obj, types.ModuleType):
+        h.update(("module %s"%obj.__name__).encode())
+    elif isinstance(obj, (type, types.BuiltinFunctionType)):
+        h.update(("%s %s.%s"%(type(obj).__name__, getattr(obj, "__module__", ""), obj.__qualname__)).encode())
+    else:
+        h.update(("%s %r"%(type(obj).__name__, obj)).encode())
+
+def hashCode(code, namespace, h, seen):
+
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            hashCode(const, namespace, h, seen)
+        else:
+            hashObject(const, h, seen)
+    for name in code.co_names:
+        if name in namespace:
+            hashObject(namespace[name], h, seen)
+
+def functionHash(function, kwargs={}, *extra):
+
+    h = hashlib.sha256()
+    h.update(("%s %d %d"%(sys.version, tapeFileVersion, operationsVersion)).encode())
+    hashObject(function, h, set())
+    hashObject(kwargs, h, set())
+    hashObject(extra, h, set())
+    return h.hexdigest()
+
+class AD_TapeCache:
+
+    def __init__(self, directory, maxSize=1<<30):
+
+        self.directory = os.path.expanduser(directory)
+        self.maxSize   = maxSize
+        self.hits      = 0
+        self.misses    = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def compile(self, function, kwargs={}, optimize=False, kernel=False, passive=()):
+
+        # Returns the compiled (and optimized if optimize is True) tape of the
+        # function, read from the cache if possible. With kernel=True the
+        # library generated by generateC is cached as well, and its file name
+        # is stored in tape.kernelName (see AD_EvalTape(kernel=...))
+
+        key = functionHash(function, kwargs, optimize)
+        tapeName = os.path.join(self.directory, key + ".sad")
+        kernelName = os.path.join(self.directory, key + ".so")
+
+        # Another process may evict an entry between the lookup and the read,
+        # which is then handled as a miss
+        try:
+            tape = AD_Tape()
+            tape.readBinary(tapeName)
+            tape.activeInputs = getActiveInputs(function, passive)
+            os.utime(tapeName)
+            self.hits += 1
+        except FileNotFoundError:
+            tape = AD_Tape()
+            tape.compile(function, kwargs, passive)
+            if optimize:
+                tape.optimize()
+            self.store(tapeName, tape.writeBinary)
+            self.misses += 1
+
+        if kernel:
+            try:
+                os.utime(kernelName)
+            except FileNotFoundError:
+                def writeKernel(filename):
+                    tape.generateC(filename + ".c", libName=filename)
+                    os.remove(filename + ".c")
+                self.store(kernelName, writeKernel)
+            tape.kernelName = kernelName
+
+        self.evict(keep=[tapeName, kernelName])
+        return tape
+
+    def temporaryName(self, filename):
+
+        # A new file, unique across processes and threads
+        handle, temporary = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(filename) + ".", dir=self.directory)
+        os.close(handle)
+        return temporary
+
+    def store(self, filename, write):
+
+        # Written under a temporary name and renamed, so that concurrent
+        # processes never see a partial file
+        temporary = self.temporaryName(filename)
+        try:
+            write(temporary)
+            os.replace(temporary, filename)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def evict(self, keep=()):
+
+        # Removes the least recently used entries until the cache fits in
+        # maxSize, except those in keep (the entries just used, which may
+        # alone exceed maxSize)
+        keep = set(os.path.basename(name) for name in keep)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".sad") or name.endswith(".so"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime, entrySize, name in entries:
+            if size<=self.maxSize:
+                break
+            if name in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".sad") or name.endswith(".so"):
+                os.remove(os.path.join(self.directory, name))
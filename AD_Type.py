@@ -21,22 +21,14 @@ def AD(tape, var):
 
     if isinstance(var, array_t):
         
-        varR = var.ravel()
-
-        # Numeric data inside array
+        # Numeric data inside array: record all the constants at once and
+        # assign the array of their tape IDs to AD_Type
         
-        if isinstance(varR[0], scalar_t):
-
-            # Copy contents to AD_Scalar type array and assign to AD_Type
-            
-            rtn = np.empty_like(var, dtype=AD_Scalar)
-            rtnR = rtn.ravel()
+        if var.dtype.kind in "iuf":
 
-            for i in range(varR.size):
-                
-                rtnR[i] = AD_Scalar(tape, value=float(varR[i]))
-            
-            return AD_Type(tape, data=rtn)
+            values = var.astype(np.float64).ravel()
+            tapeIDs = tape.findOrAddInstructions(None, None, "CONST", values)
+            return AD_Type(tape, data=tapeIDs.reshape(var.shape))
     
     # Do nothing if none of the above holds
 
@@ -49,47 +41,21 @@ def AD(tape, var):
 
 class AD_Scalar:
 
-    def __init__(self, tape, operand1=-1, operand2=-1, operation="CONST", value=0.0):
+    def __init__(self, tape, operand1=-1, operand2=-1, operation="CONST", value=0.0, tapeID=-1):
 
         # Initialize tape
         self.tape   = tape
 
-        # Initialize ID (assume for now that a new entry will be added)
-        self.tapeID = len(tape.instructions)
+        # Refer to an instruction already on the tape (e.g. an entry of an array)
+        if tapeID>=0:
+            self.tapeID = tapeID
+            return
 
-        # If an arithmetic operation is added
-        if operation not in ["CONST", "IFEQ", "IFNE", "IFLT", "IFLE", "IFGT", "IFGE"]:
-            
-            # Iterate over the histories for all conditional blocks
-            for childDict in tape.children:
-
-                # Check if an entry is present with the current operands and operation
-                # If found, change the ID
-                if operand1 in childDict.keys():
-                    if operand2 in childDict[operand1][operation].keys():
-                        self.tapeID = childDict[operand1][operation][operand2]
-                        return
-            
-            # Do the same thing with operand2 and operand1 exchanged for commutative
-            # operators, if an entry is not found previously
-            if operation in ["ADD", "MUL", "MAX", "MIN"]:
-                for childDict in tape.children:
-                    if operand2 in childDict.keys():
-                        if operand1 in childDict[operand2][operation].keys():
-                            self.tapeID = childDict[operand2][operation][operand1]
-                            return
-
-        # If a constant is entered, check if the same value already exists
-        # over all conditional blocks, if yes, change the ID
-        if operation=="CONST" and value!=0.0:
-            for idDict in tape.idsOfNonZeroConstants:
-                if value in idDict.keys():
-                    self.tapeID = idDict[value]
-                    return
-
-        # In case, an arithmetic operation or constant is not found in history
-        # add a new one to the tape (Logical operators are always added)
-        tape.addInstruction(operand1, operand2, operation, value)
+        # Reuse a previously recorded instruction with the same operation and
+        # operands (or the same non-zero constant) in any open conditional
+        # block, otherwise add a new one to the tape (Logical operators are
+        # always added)
+        self.tapeID = tape.findOrAddInstruction(operand1, operand2, operation, value)
 
     # Add operators (reverse operators needed when the second operator is an array)
 
@@ -123,133 +89,26 @@ class AD_Scalar:
     def __rpow__(self, other):
         return other**self
 
+    # Comparisons record a conditional on the tape and return the branch to
+    # trace (see AD_Tape.recordConditional)
+
     def __eq__(self, other):
-        # Check if this conditional is unregistered
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            # Add this conditional
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFEQ")
-            # Add the value for this conditional as True in the tape
-            self.tape.conditionalValues.append(True)
-            # Create entries for this new conditional block in children and non-zero constants
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            # Increment the total number of conditionals encountered in this realization
-            self.tape.conditionalCounter += 1
-            return True
-        # Check if this is the last registered conditional (Must be False, look in AD_Tape and more conditionals may be
-        # present in the tape)
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            # Add this conditional
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFNE")
-            # The conditional block for this conditional with value True is over, so create fresh entries for the block
-            # with False value
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            # Increment the total number of conditionals encountered in this realization
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            # If registered and not the last registered one, DO NOT ADD THE CONDITIONAL (same conditional block continues)
-            # Other operations are not duplicated as previous entries are found
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            # Increment the total number of conditionals encountered in this realization
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFEQ")
 
     def __ne__(self, other):
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFNE")
-            self.tape.conditionalValues.append(True)
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            self.tape.conditionalCounter += 1
-            return True
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFEQ")
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFNE")
 
     def __lt__(self, other):
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFLT")
-            self.tape.conditionalValues.append(True)
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            self.tape.conditionalCounter += 1
-            return True
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFGE")
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFLT")
 
     def __ge__(self, other):
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFGE")
-            self.tape.conditionalValues.append(True)
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            self.tape.conditionalCounter += 1
-            return True
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFLT")
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFGE")
 
     def __gt__(self, other):
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFGT")
-            self.tape.conditionalValues.append(True)
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            self.tape.conditionalCounter += 1
-            return True
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFLE")
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFGT")
 
     def __le__(self, other):
-        if self.tape.conditionalCounter>=len(self.tape.conditionalValues):
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFLE")
-            self.tape.conditionalValues.append(True)
-            self.tape.children.append({})
-            self.tape.idsOfNonZeroConstants.append({})
-            self.tape.conditionalCounter += 1
-            return True
-        elif self.tape.conditionalCounter==len(self.tape.conditionalValues)-1 and self.tape.conditionalValues[-1]==False:
-            rtn = AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="IFGT")
-            self.tape.children[-1] = {}
-            self.tape.idsOfNonZeroConstants[-1] = {}
-            self.tape.conditionalCounter += 1
-            return False
-        else:
-            rtn = self.tape.conditionalValues[self.tape.conditionalCounter]
-            self.tape.conditionalCounter += 1
-            return rtn
+        return self.tape.recordConditional(self.tapeID, other.tapeID, "IFLE")
 
     def maxComparedTo(self, other):
         return AD_Scalar(self.tape, operand1=self.tapeID, operand2=other.tapeID, operation="MAX")
@@ -292,10 +151,15 @@ class AD_Scalar:
 
 #------------------------------------------------------------------------------
 # Class AD_Type: can contain either a scalar or an array
+# (arrays are stored as numpy integer arrays of tape IDs, so that operations on
+# them are recorded on the tape all at once)
 #------------------------------------------------------------------------------
 
 class AD_Type:
 
+    # Make numpy defer to the reverse operators of AD_Type
+    __array_ufunc__ = None
+
     def __init__(self, tape, shape=[], data=None):
 
         if data is not None:
@@ -312,10 +176,8 @@ class AD_Type:
             #[m,n,...] means array
             else:
                 
-                self.data = np.empty(shape, dtype=AD_Scalar)
-                dataR = self.data.ravel()
-                for i in range(dataR.size):
-                    dataR[i] = AD_Scalar(tape)
+                values = np.zeros(int(np.prod(shape)))
+                self.data = tape.findOrAddInstructions(None, None, "CONST", values).reshape(shape)
 
         self.isArray = isinstance(self.data, (np.ndarray))
         if self.isArray:
@@ -324,6 +186,13 @@ class AD_Type:
             self.shape = []
         self.tape = tape
 
+    def getIDs(self):
+        # Array of tape IDs (0-d for a scalar)
+        if self.isArray:
+            return self.data
+        else:
+            return np.array(self.data.tapeID, dtype=np.int64)
+
     def resize(self, newshape):
         if self.isArray:
             newshape = list(newshape)
@@ -343,238 +212,341 @@ class AD_Type:
             return self
 
     def __getitem__(self, key):
-        return AD_Type(self.tape, data=self.data[key])
+        data = self.data[key]
+        if isinstance(data, np.ndarray):
+            return AD_Type(self.tape, data=data)
+        else:
+            return AD_Type(self.tape, data=AD_Scalar(self.tape, tapeID=int(data)))
 
     def __setitem__(self, key, newValue):
-        self.data[key] = newValue.data
+        newValue = AD(self.tape, newValue)
+        self.data[key] = newValue.getIDs()
 
     def __neg__(self):
-        return AD_Type(self.tape, data=-self.data)
+        return unaryOperation(self, "NEG")
 
     # Reverse operations are needed if the left quantity is not of AD_Type
 
     def __add__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==False and other.isArray==True:
-            return AD_Type(self.tape, data=other.data.__radd__(self.data))
-        else:
-            return AD_Type(self.tape, data=self.data+other.data)
+        return binaryOperation(self, AD(self.tape, other), "ADD")
 
     def __sub__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==False and other.isArray==True:
-            return AD_Type(self.tape, data=other.data.__rsub__(self.data))
-        else:
-            return AD_Type(self.tape, data=self.data-other.data)
+        return binaryOperation(self, AD(self.tape, other), "SUB")
 
     def __mul__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==False and other.isArray==True:
-            return AD_Type(self.tape, data=other.data.__rmul__(self.data))
-        else:
-            return AD_Type(self.tape, data=self.data*other.data)
+        return binaryOperation(self, AD(self.tape, other), "MUL")
 
     def __truediv__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==False and other.isArray==True:
-            return AD_Type(self.tape, data=other.data.__rtruediv__(self.data))
-        else:
-            return AD_Type(self.tape, data=self.data/other.data)
+        return binaryOperation(self, AD(self.tape, other), "DIV")
 
     def __pow__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==False and other.isArray==True:
-            return AD_Type(self.tape, data=other.data.__rpow__(self.data))
-        else:
-            return AD_Type(self.tape, data=self.data**other.data)
+        return binaryOperation(self, AD(self.tape, other), "POW")
 
     def __radd__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==True and other.isArray==False:
-            return AD_Type(self.tape, data=self.data.__radd__(other.data))
-        else:
-            return AD_Type(self.tape, data=other.data+self.data)
+        return binaryOperation(AD(self.tape, other), self, "ADD")
 
     def __rsub__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==True and other.isArray==False:
-            return AD_Type(self.tape, data=self.data.__rsub__(other.data))
-        else:
-            return AD_Type(self.tape, data=other.data-self.data)
+        return binaryOperation(AD(self.tape, other), self, "SUB")
 
     def __rmul__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==True and other.isArray==False:
-            return AD_Type(self.tape, data=self.data.__rmul__(other.data))
-        else:
-            return AD_Type(self.tape, data=other.data*self.data)
+        return binaryOperation(AD(self.tape, other), self, "MUL")
 
     def __rtruediv__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==True and other.isArray==False:
-            return AD_Type(self.tape, data=self.data.__rtruediv__(other.data))
-        else:
-            return AD_Type(self.tape, data=other.data/self.data)
+        return binaryOperation(AD(self.tape, other), self, "DIV")
 
     def __rpow__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray==True and other.isArray==False:
-            return AD_Type(self.tape, data=self.data.__rpow__(other.data))
-        else:
-            return AD_Type(self.tape, data=other.data**self.data)
+        return binaryOperation(AD(self.tape, other), self, "POW")
+
+    # Comparisons return an AD_Condition, which records a conditional on the
+    # tape when used in an if statement, or a SELECT instruction in where
 
     def __eq__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
-            print("Error: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return self.data==other.data
+        return AD_Condition(self, AD(self.tape, other), "IFEQ")
 
     def __ne__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
-            print("Error: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return self.data!=other.data
+        return AD_Condition(self, AD(self.tape, other), "IFNE")
 
     def __lt__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
-            print("Error: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return self.data<other.data
+        return AD_Condition(self, AD(self.tape, other), "IFLT")
 
     def __ge__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
-            print("Error: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return self.data>=other.data
+        return AD_Condition(self, AD(self.tape, other), "IFGE")
 
     def __gt__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
-            print("Error: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return self.data>other.data
+        return AD_Condition(self, AD(self.tape, other), "IFGT")
 
     def __le__(self, other):
-        other = AD(self.tape, other)
-        if self.isArray or other.isArray:
+        return AD_Condition(self, AD(self.tape, other), "IFLE")
+
+#------------------------------------------------------------------------------
+# Class AD_Condition: result of a comparison of AD_Type quantities
+#------------------------------------------------------------------------------
+
+class AD_Condition:
+
+    def __init__(self, x, y, operation):
+
+        self.x         = x
+        self.y         = y
+        self.operation = operation
+        self.tape      = x.tape
+
+    def __bool__(self):
+        # Branch on the condition: records a conditional on the tape (only scalars)
+        if self.x.isArray or self.y.isArray:
             print("Error: Comparing arrays!")
             sys.exit(0)
-        else:
-            return self.data<=other.data
+        return self.tape.recordConditional(self.x.data.tapeID, self.y.data.tapeID, self.operation)
+
+    def getSelector(self):
+        # Returns c and whether the condition holds for c>0 (True) or for c<=0 (False)
+        x, y = self.x, self.y
+        if self.operation in ["IFEQ", "IFNE"]:
+            return unaryOperation(binaryOperation(x, y, "SUB"), "ABS"), self.operation=="IFNE"
+        if self.operation in ["IFGT", "IFLE"]:
+            return binaryOperation(x, y, "SUB"), self.operation=="IFGT"
+        return binaryOperation(y, x, "SUB"), self.operation=="IFLT"
+
+#------------------------------------------------------------------------------
+# Recording of operations on AD_Type (arrays are recorded in bulk, with the
+# operands of every entry obtained by broadcasting the arrays of tape IDs)
+#------------------------------------------------------------------------------
+
+def unaryOperation(x, operation):
+    if x.isArray:
+        operand1 = x.data.ravel()
+        tapeIDs = x.tape.findOrAddInstructions(operand1, np.full_like(operand1, -1), operation)
+        return AD_Type(x.tape, data=tapeIDs.reshape(x.shape))
+    else:
+        return AD_Type(x.tape, data=AD_Scalar(x.tape, operand1=x.data.tapeID, operation=operation))
+
+def binaryOperation(x, y, operation):
+    if x.isArray or y.isArray:
+        operand1, operand2 = np.broadcast_arrays(x.getIDs(), y.getIDs())
+        tapeIDs = x.tape.findOrAddInstructions(operand1.ravel(), operand2.ravel(), operation)
+        return AD_Type(x.tape, data=tapeIDs.reshape(operand1.shape))
+    else:
+        return AD_Type(x.tape, data=AD_Scalar(x.tape, operand1=x.data.tapeID, operand2=y.data.tapeID, operation=operation))
+
+def recordOperation(tape, operand1, operand2, operation):
+    # Same as binaryOperation, for arrays of tape IDs
+    operand1, operand2 = np.broadcast_arrays(operand1, operand2)
+    return tape.findOrAddInstructions(operand1.ravel(), operand2.ravel(), operation).reshape(operand1.shape)
+
+def reduceLastAxis(tape, tapeIDs, operation):
+    # Reduction over the last axis of an array of tape IDs, recorded as a
+    # balanced tree of ADD or MUL instructions: the pairs of neighbouring
+    # entries are combined level by level, so that the result depends on the
+    # entries through log2(n) instead of n-1 instructions
+    while tapeIDs.shape[-1]>1:
+        n = tapeIDs.shape[-1]
+        pairs = recordOperation(tape, tapeIDs[..., 0:n-1:2], tapeIDs[..., 1:n:2], operation)
+        tapeIDs = np.concatenate([pairs, tapeIDs[..., n-1:]], axis=-1) if n%2==1 else pairs
+    return tapeIDs[..., 0]
+
+def sumLastAxis(tape, tapeIDs):
+    # Sum over the last axis of an array of tape IDs
+    return reduceLastAxis(tape, tapeIDs, "ADD")
+
+def reduction(x, axis, operation, identity):
+    # Reduces an AD_Type over the given axis (or tuple of axes, all if None)
+    tapeIDs = x.getIDs()
+    axes = tuple(range(tapeIDs.ndim)) if axis is None else tuple(np.atleast_1d(axis))
+    tapeIDs = np.moveaxis(tapeIDs, axes, tuple(range(-len(axes), 0)))
+    shape = tapeIDs.shape[:tapeIDs.ndim-len(axes)]
+    if tapeIDs.size==0:
+        return AD(x.tape, np.full(shape, identity)) if len(shape)>0 else AD(x.tape, identity)
+    return toADType(x.tape, reduceLastAxis(x.tape, tapeIDs.reshape(shape + (-1,)), operation))
+
+def toADType(tape, tapeIDs):
+    if tapeIDs.ndim==0:
+        return AD_Type(tape, data=AD_Scalar(tape, tapeID=int(tapeIDs)))
+    else:
+        return AD_Type(tape, data=tapeIDs)
+
+def toADTypes(x, y):
+    if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
+    if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
+    return x, y
 
 def abs(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.abs(x.data))
+        return unaryOperation(x, "ABS")
     else:
         return np.abs(x)
 
 def exp(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.exp(x.data))
+        return unaryOperation(x, "EXP")
     else:
         return np.exp(x)
 
 def log(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.log(x.data))
+        return unaryOperation(x, "LOG")
     else:
         return np.log(x)
 
 def sqrt(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.sqrt(x.data))
+        return unaryOperation(x, "SQRT")
     else:
         return np.sqrt(x)
 
 def maximum(x, y):
     if isinstance(x, (AD_Type)) or isinstance(y, (AD_Type)):
-        if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
-        if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
-        if x.isArray or y.isArray:
-            print("Error: max: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return AD_Type(x.tape, data=x.data.maxComparedTo(y.data))
+        x, y = toADTypes(x, y)
+        return binaryOperation(x, y, "MAX")
     else:
         return np.maximum(x,y)
 
 def minimum(x, y):
     if isinstance(x, (AD_Type)) or isinstance(y, (AD_Type)):
-        if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
-        if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
-        if x.isArray or y.isArray:
-            print("Error: min: Comparing arrays!")
-            sys.exit(0)
-        else:
-            return AD_Type(x.tape, data=x.data.minComparedTo(y.data))
+        x, y = toADTypes(x, y)
+        return binaryOperation(x, y, "MIN")
     else:
         return np.minimum(x,y)
 
+def where(condition, x, y):
+    # Branch-free selection: x where the condition holds, y elsewhere
+    # (elementwise for arrays), recorded as SUB (and ABS) and SELECT instructions
+    if isinstance(condition, AD_Condition):
+        tape = condition.tape
+        x, y = AD(tape, x), AD(tape, y)
+        selector, isPositive = condition.getSelector()
+        if not isPositive:
+            x, y = y, x
+        selector, operand1, operand2 = np.broadcast_arrays(selector.getIDs(), x.getIDs(), y.getIDs())
+        tapeIDs = tape.findOrAddInstructions(operand1.ravel(), operand2.ravel(), "SELECT", blockEnd=selector.ravel())
+        return toADType(tape, tapeIDs.reshape(operand1.shape))
+    else:
+        return np.where(condition, x, y)
+
 def sin(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.sin(x.data))
+        return unaryOperation(x, "SIN")
     else:
         return np.sin(x)
 
 def cos(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.cos(x.data))
+        return unaryOperation(x, "COS")
     else:
         return np.cos(x)
 
 def tan(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.tan(x.data))
+        return unaryOperation(x, "TAN")
     else:
         return np.tan(x)
 
 def sinh(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.sinh(x.data))
+        return unaryOperation(x, "SINH")
     else:
         return np.sinh(x)
 
 def cosh(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.cosh(x.data))
+        return unaryOperation(x, "COSH")
     else:
         return np.cosh(x)
 
 def tanh(x):
     if isinstance(x, (AD_Type)):
-        return AD_Type(x.tape, data=np.tanh(x.data))
+        return unaryOperation(x, "TANH")
     else:
         return np.tanh(x)
 
+def sigmoid(x):
+    if isinstance(x, (AD_Type)):
+        return unaryOperation(x, "SIGMOID")
+    else:
+        return 1.0/(1.0 + np.exp(-x))
+
+def swish(x):
+    # x*sigmoid(x), also known as SiLU
+    if isinstance(x, (AD_Type)):
+        return unaryOperation(x, "SWISH")
+    else:
+        return x/(1.0 + np.exp(-x))
+
+# Reductions are recorded as balanced trees (see reduceLastAxis)
+
+def sum(x, axis=None):
+    if isinstance(x, (AD_Type)):
+        return reduction(x, axis, "ADD", 0.0)
+    else:
+        return np.sum(x, axis=axis)
+
+def prod(x, axis=None):
+    if isinstance(x, (AD_Type)):
+        return reduction(x, axis, "MUL", 1.0)
+    else:
+        return np.prod(x, axis=axis)
+
+def mean(x, axis=None):
+    if isinstance(x, (AD_Type)):
+        shape = np.shape(x.getIDs())
+        n = int(np.prod(shape)) if axis is None else int(np.prod([shape[i] for i in np.atleast_1d(axis)]))
+        return reduction(x, axis, "ADD", 0.0)*(1.0/n)
+    else:
+        return np.mean(x, axis=axis)
+
+def norm(x, axis=None):
+    # Euclidean norm (of the flattened array if axis is None)
+    if isinstance(x, (AD_Type)):
+        return sqrt(reduction(x*x, axis, "ADD", 0.0))
+    else:
+        return np.linalg.norm(x, axis=axis) if axis is not None else np.linalg.norm(np.ravel(x))
+
+# Contractions are recorded as one bulk multiplication of all the pairs of
+# entries followed by a bulk addition per term of the sums
+
 def dot(x, y):
     if isinstance(x, (AD_Type)) or isinstance(y, (AD_Type)):
-        if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
-        if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
-        return AD_Type(x.tape, data=np.dot(x.data, y.data))
+        x, y = toADTypes(x, y)
+        a, b = x.getIDs(), y.getIDs()
+        if a.ndim==0 or b.ndim==0:
+            return binaryOperation(x, y, "MUL")
+        if b.ndim==1:
+            products = recordOperation(x.tape, a, b, "MUL")
+        else:
+            b = np.moveaxis(b, -2, -1)
+            a = a.reshape(a.shape[:-1] + (1,)*(b.ndim-1) + a.shape[-1:])
+            products = recordOperation(x.tape, a, b, "MUL")
+        return toADType(x.tape, sumLastAxis(x.tape, products))
     else:
-        return np.dot(x)
+        return np.dot(x, y)
 
 def cross(x, y):
     if isinstance(x, (AD_Type)) or isinstance(y, (AD_Type)):
-        if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
-        if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
-        return AD_Type(x.tape, data=np.cross(x.data, y.data))
+        x, y = toADTypes(x, y)
+        a, b = x.getIDs(), y.getIDs()
+        if a.shape[-1]==2 and b.shape[-1]==2:
+            i, j = [0], [1]
+            rtn = recordOperation(x.tape, recordOperation(x.tape, a[..., i], b[..., j], "MUL"),
+                                  recordOperation(x.tape, a[..., j], b[..., i], "MUL"), "SUB")
+            return toADType(x.tape, rtn[..., 0])
+        i, j = [1, 2, 0], [2, 0, 1]
+        rtn = recordOperation(x.tape, recordOperation(x.tape, a[..., i], b[..., j], "MUL"),
+                              recordOperation(x.tape, a[..., j], b[..., i], "MUL"), "SUB")
+        return AD_Type(x.tape, data=rtn)
     else:
         return np.cross(x,y)
 
 def matmul(x, y):
     if isinstance(x, (AD_Type)) or isinstance(y, (AD_Type)):
-        if isinstance(x, (AD_Type))==False: x = AD(y.tape, x)
-        if isinstance(y, (AD_Type))==False: y = AD(x.tape, y)
-        return AD_Type(x.tape, data=np.matmul(x.data, y.data))
+        x, y = toADTypes(x, y)
+        a, b = x.getIDs(), y.getIDs()
+        aIsVector, bIsVector = (a.ndim==1), (b.ndim==1)
+        if aIsVector: a = a[None, :]
+        if bIsVector: b = b[:, None]
+        # products[..., i, j, k] = a[..., i, k] * b[..., k, j]
+        products = recordOperation(x.tape, a[..., :, None, :], np.moveaxis(b, -2, -1)[..., None, :, :], "MUL")
+        rtn = sumLastAxis(x.tape, products)
+        if bIsVector: rtn = rtn[..., 0]
+        if aIsVector: rtn = rtn[..., 0, :] if not bIsVector else rtn[..., 0]
+        return toADType(x.tape, rtn)
     else:
         return np.matmul(x,y)
@@ -0,0 +1,16 @@
+#include "SAD.h"
+
+// Generic library of the tape evaluator: SAD.h holds the whole evaluator, so
+// this file only makes its functions available in a shared library that works
+// with any tape, without a hand-written wrapper per tape. Any tape file read
+// with readTapeFromFile (or bound from python) is evaluated at a batch of
+// points with
+//
+//   void evaluateTapeBatch(SAD_Tape *tape, int nPoints, double *inputs, double *outputs, double *jacobian,
+//                          int nThreads, int chunkWidth, int mode);
+//
+// inputs[nPoints][nInputs] -> outputs[nPoints][nOutputs] and (unless NULL)
+// jacobian[nPoints][nOutputs][nInputs]. AD_EvalTape builds this library with
+// buildLibrary (see SAD.py) when no libName is given:
+//
+//   cc -O3 -fPIC -shared SAD.c -o libSAD.so -lm -lpthread
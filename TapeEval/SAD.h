@@ -6,6 +6,22 @@
 #include "string.h"
 #include "stdlib.h"
 #include "stdio.h"
+#include "time.h"
+#include "limits.h"
+
+#ifdef _WIN32
+#define SAD_NO_MMAP
+#define SAD_NO_THREADS
+#else
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#endif
+
+#ifndef SAD_NO_THREADS
+#include <pthread.h>
+#endif
 
 #ifdef __cplusplus
 extern "C"
@@ -39,18 +55,18 @@ extern "C"
     IFLT,
     IFGE,
     IFGT,
-    IFLE
+    IFLE,
+    SELECT,
+    FMA,
+    SQUARE,
+    RECIP,
+    SIGMOID,
+    SWISH
   };
 
-  typedef struct
-  {
-    int blockEnd;
-    int operand1;
-    int operand2;
-    int operation;
-    double value;
-    double deriv;
-  } SAD_Instruction;
+  // The tape is stored as a struct of arrays: one array per field of the
+  // instructions. The "value" array holds the constants on input and the
+  // evaluated values afterwards, and "deriv" holds the adjoints
 
   typedef struct
   {
@@ -59,57 +75,294 @@ extern "C"
     int nInputs;
     int nOutputs;
     double *jacobian;
-    SAD_Instruction *instructions;
+    int *blockEnd;
+    int *operand1;
+    int *operand2;
+    int *operation;
+    double *value;
+    double *deriv;
+    void *mapping;
+    size_t mappingSize;
   } SAD_Tape;
 
-  void readTapeFromFile(SAD_Tape *tape, char *filename)
+  // Binary tape file (see AD_Tape.writeBinary): a 64 byte header followed by
+  // the value, blockEnd, operand1, operand2 and operation arrays
+
+  #define SAD_TAPE_FILE_MAGIC "SADTAPE"
+  #define SAD_TAPE_FILE_VERSION 1
+  #define SAD_OPERATIONS_VERSION 3
+  #define SAD_TAPE_FILE_ENDIANNESS 0x01020304u
+
+  typedef struct
   {
-    FILE *fp = fopen(filename, "r");
-    int rtn;
-    rtn = fscanf(fp, "%d", &(tape->nInputs));
-    rtn = fscanf(fp, "%d", &(tape->nOutputs));
-    rtn = fscanf(fp, "%d", &(tape->tapeSize));
-    //printf("%d %d %d\n", tape->nInputs, tape->nOutputs, tape->tapeSize);
+    char magic[8];
+    unsigned int endianness;
+    int version;
+    int operationsVersion;
+    int nInputs;
+    int nOutputs;
+    int reserved;
+    long long tapeSize;
+    char padding[24];
+  } SAD_TapeFileHeader;
+
+  // Results of the tape file readers
+
+  enum tapeFileErrorsEnum
+  {
+    TAPE_FILE_OK,
+    TAPE_FILE_CANNOT_OPEN,
+    TAPE_FILE_INVALID,
+    TAPE_FILE_UNSUPPORTED
+  };
+
+  void allocateTape(SAD_Tape *tape)
+  {
+    tape->effectiveTapeSize = tape->tapeSize;
+    tape->jacobian  = (double*)calloc((tape->nOutputs)*(tape->nInputs), sizeof(double));
+    tape->blockEnd  = (int*)calloc(tape->tapeSize, sizeof(int));
+    tape->operand1  = (int*)calloc(tape->tapeSize, sizeof(int));
+    tape->operand2  = (int*)calloc(tape->tapeSize, sizeof(int));
+    tape->operation = (int*)calloc(tape->tapeSize, sizeof(int));
+    tape->value     = (double*)calloc(tape->tapeSize, sizeof(double));
+    tape->deriv     = (double*)calloc(tape->tapeSize, sizeof(double));
+    tape->mapping   = NULL;
+    tape->mappingSize = 0;
+  }
+
+  int isBinaryTapeFile(char *filename)
+  {
+    char magic[8] = {0};
+    FILE *fp = fopen(filename, "rb");
+    if(fp==NULL) return 0;
+    size_t rtn = fread(magic, 1, 8, fp);
+    fclose(fp);
+    return rtn==8 && strcmp(magic, SAD_TAPE_FILE_MAGIC)==0;
+  }
+
+  void unmapTapeFile(void *mapping, size_t size)
+  {
+#ifdef SAD_NO_MMAP
+    free(mapping);
+#else
+    munmap(mapping, size);
+#endif
+  }
+
+  void deleteTape(SAD_Tape tape)
+  {
+    free(tape.jacobian);
+    free(tape.deriv);
+    if(tape.mapping!=NULL)
+    {
+      unmapTapeFile(tape.mapping, tape.mappingSize);
+      return;
+    }
+    free(tape.blockEnd);
+    free(tape.operand1);
+    free(tape.operand2);
+    free(tape.operation);
+    free(tape.value);
+  }
+
+  // A binary tape file must hold its magic, a supported version and the
+  // arrays of tapeSize instructions after the header
+
+  int checkTapeFileHeader(const SAD_TapeFileHeader *header, size_t size)
+  {
+    if(size<sizeof(SAD_TapeFileHeader) || memcmp(header->magic, SAD_TAPE_FILE_MAGIC, sizeof(header->magic))!=0)
+    {
+      return TAPE_FILE_INVALID;
+    }
+    if(header->endianness!=SAD_TAPE_FILE_ENDIANNESS ||
+       header->version!=SAD_TAPE_FILE_VERSION ||
+       header->operationsVersion!=SAD_OPERATIONS_VERSION)
+    {
+      return TAPE_FILE_UNSUPPORTED;
+    }
+    long long n = header->tapeSize;
+    if(n<0 || n>INT_MAX || header->nInputs<0 || header->nOutputs<0 || header->nInputs>n || header->nOutputs>n)
+    {
+      return TAPE_FILE_INVALID;
+    }
+    if((size-sizeof(SAD_TapeFileHeader))/(sizeof(double)+4*sizeof(int))<(size_t)n)
+    {
+      return TAPE_FILE_INVALID;
+    }
+    return TAPE_FILE_OK;
+  }
+
+  // The instruction arrays point directly into a private (copy-on-write)
+  // mapping of the file, so that loading takes constant time. Returns
+  // TAPE_FILE_OK, or an error leaving the tape unchanged
+
+  int readTapeFromBinaryFile(SAD_Tape *tape, char *filename)
+  {
+    size_t size;
+    char *mapping;
+
+#ifdef SAD_NO_MMAP
+    FILE *fp = fopen(filename, "rb");
+    if(fp==NULL) return TAPE_FILE_CANNOT_OPEN;
+    fseek(fp, 0, SEEK_END);
+    long end = ftell(fp);
+    fseek(fp, 0, SEEK_SET);
+    if(end<0)
+    {
+      fclose(fp);
+      return TAPE_FILE_CANNOT_OPEN;
+    }
+    size = (size_t)end;
+    mapping = (char*)malloc(size+1);
+    size_t rtn = fread(mapping, 1, size, fp);
+    fclose(fp);
+    if(rtn!=size)
+    {
+      free(mapping);
+      return TAPE_FILE_CANNOT_OPEN;
+    }
+#else
+    struct stat st;
+    int fd = open(filename, O_RDONLY);
+    if(fd<0) return TAPE_FILE_CANNOT_OPEN;
+    if(fstat(fd, &st)!=0)
+    {
+      close(fd);
+      return TAPE_FILE_CANNOT_OPEN;
+    }
+    size = (size_t)st.st_size;
+    if(size<sizeof(SAD_TapeFileHeader))
+    {
+      close(fd);
+      return TAPE_FILE_INVALID;
+    }
+    mapping = (char*)mmap(NULL, size, PROT_READ|PROT_WRITE, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(mapping==MAP_FAILED) return TAPE_FILE_CANNOT_OPEN;
+#endif
+
+    SAD_TapeFileHeader *header = (SAD_TapeFileHeader*)mapping;
+    int error = checkTapeFileHeader(header, size);
+    if(error!=TAPE_FILE_OK)
+    {
+      unmapTapeFile(mapping, size);
+      return error;
+    }
+
+    tape->nInputs  = header->nInputs;
+    tape->nOutputs = header->nOutputs;
+    tape->tapeSize = (int)header->tapeSize;
     tape->effectiveTapeSize = tape->tapeSize;
+
+    size_t n = (size_t)tape->tapeSize;
+    char *data = mapping + sizeof(SAD_TapeFileHeader);
+    tape->value     = (double*)data; data += n*sizeof(double);
+    tape->blockEnd  = (int*)data;    data += n*sizeof(int);
+    tape->operand1  = (int*)data;    data += n*sizeof(int);
+    tape->operand2  = (int*)data;    data += n*sizeof(int);
+    tape->operation = (int*)data;
+
     tape->jacobian = (double*)calloc((tape->nOutputs)*(tape->nInputs), sizeof(double));
-    tape->instructions = (SAD_Instruction*)calloc(tape->tapeSize, sizeof(SAD_Instruction));
+    tape->deriv    = (double*)calloc(tape->tapeSize, sizeof(double));
+    tape->mapping  = mapping;
+    tape->mappingSize = size;
+    return TAPE_FILE_OK;
+  }
+
+  // Reads a binary or a text tape file (see AD_Tape.write; the readable
+  // format, with the names of the operations, is not supported). Returns
+  // TAPE_FILE_OK, or an error leaving the tape without instructions
+
+  int readTapeFromFile(SAD_Tape *tape, char *filename)
+  {
+    if(isBinaryTapeFile(filename))
+    {
+      return readTapeFromBinaryFile(tape, filename);
+    }
+
+    FILE *fp = fopen(filename, "r");
+    if(fp==NULL) return TAPE_FILE_CANNOT_OPEN;
+    if(fscanf(fp, "%d %d %d", &(tape->nInputs), &(tape->nOutputs), &(tape->tapeSize))!=3 ||
+       tape->tapeSize<0 || tape->nInputs<0 || tape->nOutputs<0 ||
+       tape->nInputs>tape->tapeSize || tape->nOutputs>tape->tapeSize)
+    {
+      fclose(fp);
+      tape->tapeSize = 0;
+      return TAPE_FILE_INVALID;
+    }
+    //printf("%d %d %d\n", tape->nInputs, tape->nOutputs, tape->tapeSize);
+    allocateTape(tape);
     for(int i=0; i<tape->tapeSize; i++)
     {
-      rtn = fscanf(fp, "%d",  &(tape->instructions[i].blockEnd));
-      rtn = fscanf(fp, "%d",  &(tape->instructions[i].operand1));
-      rtn = fscanf(fp, "%d",  &(tape->instructions[i].operand2));
-      rtn = fscanf(fp, "%d",  &(tape->instructions[i].operation));
-      rtn = fscanf(fp, "%le", &(tape->instructions[i].value));
-      /*
-      printf("%d %d %d %d %le\n",
-              tape->instructions[i].blockEnd,
-              tape->instructions[i].operand1,
-              tape->instructions[i].operand2,
-              tape->instructions[i].operation,
-              tape->instructions[i].value);
-      // */
+      if(fscanf(fp, "%d %d %d %d %le", &(tape->blockEnd[i]), &(tape->operand1[i]), &(tape->operand2[i]),
+                &(tape->operation[i]), &(tape->value[i]))!=5)
+      {
+        fclose(fp);
+        deleteTape(*tape);
+        tape->tapeSize = 0;
+        return TAPE_FILE_INVALID;
+      }
     }
     fclose(fp);
+    return TAPE_FILE_OK;
   }
 
-  void deleteTape(SAD_Tape tape)
+  // A workspace holds the values and adjoints of one evaluation of a tape,
+  // so that the tape itself is only read during an evaluation and can be
+  // shared between threads. The tape's own value and deriv arrays act as
+  // the workspace of the single point API (setTapeInput, evaluateOutputs,
+  // getTapeOutput, ...)
+
+  //
+  // The adjoints are stored in blocks of derivWidth values per instruction
+  // (deriv[i*derivWidth+k]), so that a single reverse sweep can compute up
+  // to derivWidth rows of the jacobian
+
+  #define SAD_DEFAULT_CHUNK_WIDTH 8
+
+  typedef struct
   {
-    free(tape.jacobian);
-    free(tape.instructions);
+    int effectiveTapeSize;
+    int derivWidth;
+    double *value;
+    double *deriv;
+  } SAD_Workspace;
+
+  SAD_Workspace createWorkspace(const SAD_Tape *tape, int derivWidth)
+  {
+    SAD_Workspace work;
+    work.effectiveTapeSize = tape->tapeSize;
+    work.derivWidth = derivWidth;
+    work.value = (double*)malloc(tape->tapeSize*sizeof(double));
+    work.deriv = (double*)calloc((size_t)tape->tapeSize*derivWidth, sizeof(double));
+    memcpy(work.value, tape->value, tape->tapeSize*sizeof(double));
+    return work;
+  }
+
+  void deleteWorkspace(SAD_Workspace work)
+  {
+    free(work.value);
+    free(work.deriv);
+  }
+
+  SAD_Workspace getTapeWorkspace(SAD_Tape *tape)
+  {
+    SAD_Workspace work;
+    work.effectiveTapeSize = tape->effectiveTapeSize;
+    work.derivWidth = 1;
+    work.value = tape->value;
+    work.deriv = tape->deriv;
+    return work;
   }
 
-  int isConditionalStatement(SAD_Instruction *instructions, int i)
+  int isConditionalStatement(const SAD_Tape *tape, int i)
   {
-    return ((instructions[i].operation>IFEND) ? 1 : 0);
+    return ((tape->operation[i]>IFEND && tape->operation[i]<=IFLE) ? 1 : 0);
   }
 
-  int conditionalIsTrue(SAD_Instruction *instructions, int i)
+  int compareValues(int operation, double x1, double x2)
   {
-    int op1 = instructions[i].operand1;
-    int op2 = instructions[i].operand2;
-    double x1 = instructions[op1].value;
-    double x2 = instructions[op2].value;
-    switch(instructions[i].operation)
+    switch(operation)
     {
       case IFEQ: return x1==x2; break;
       case IFNE: return x1!=x2; break;
@@ -121,14 +374,18 @@ extern "C"
     }
   }
 
-  void calculateValue(SAD_Instruction *instructions, int i)
+  int conditionalIsTrue(const SAD_Tape *tape, const double *value, int i)
+  {
+    return compareValues(tape->operation[i], value[tape->operand1[i]], value[tape->operand2[i]]);
+  }
+
+  // Value of y = x1 (operation) x2, c being the condition of a SELECT or the
+  // addend of an FMA (both stored in blockEnd, see getThirdOperand)
+
+  double operationValue(int operation, double x1, double x2, double c)
   {
     double y = 0.0;
-    int op1 = instructions[i].operand1;
-    int op2 = instructions[i].operand2;
-    double x1 = instructions[op1].value;
-    double x2 = instructions[op2].value;
-    switch(instructions[i].operation)
+    switch(operation)
     {
         case NEG:  y = -x1; break;
         case ADD:  y = x1 + x2; break;
@@ -148,113 +405,1734 @@ extern "C"
         case SINH: y = sinh(x1); break;
         case COSH: y = cosh(x1); break;
         case TANH: y = tanh(x1); break;
+        case SELECT: y = (c>0) ? x1 : x2; break;
+        case FMA:  y = x1 * x2 + c; break;
+        case SQUARE: y = x1 * x1; break;
+        case RECIP: y = 1.0 / x1; break;
+        case SIGMOID: y = 1.0 / (1.0 + exp(-x1)); break;
+        case SWISH: y = x1 / (1.0 + exp(-x1)); break;
     }
-    if(instructions[i].operand1!=-1)
-      instructions[i].value = y;
+    return y;
+  }
+
+  // Third operand of instruction i (stored in blockEnd): the condition of a
+  // SELECT or the addend of an FMA, -1 for the other instructions
+
+  int getThirdOperand(const SAD_Tape *tape, int i)
+  {
+    return (tape->operation[i]==SELECT || tape->operation[i]==FMA) ? tape->blockEnd[i] : -1;
+  }
+
+  // The addend of an FMA instruction (-1 for the other instructions), whose
+  // partial derivative is 1
+
+  int getAddend(const SAD_Tape *tape, int i)
+  {
+    return (tape->operation[i]==FMA) ? tape->blockEnd[i] : -1;
+  }
+
+  void calculateValue(const SAD_Tape *tape, double *value, int i)
+  {
+    int op1 = tape->operand1[i];
+    int op2 = tape->operand2[i];
+    int op3 = getThirdOperand(tape, i);
+    if(op1==-1) return;
+    double x2 = (op2!=-1) ? value[op2] : 0.0;
+    double c = (op3!=-1) ? value[op3] : 0.0;
+    value[i] = operationValue(tape->operation[i], value[op1], x2, c);
   }
     
-  void calculateSensitivity(SAD_Instruction *instructions, int i)
+  // Partial derivatives d1=dy/dx1 and d2=dy/dx2 of y = x1 (operation) x2
+
+  void calculatePartials(int operation, double x1, double x2, double y, double *d1, double *d2)
+  {
+    *d1 = 0.0;
+    *d2 = 0.0;
+    switch(operation)
+    {
+      case NEG:  *d1 = -1.0; break;
+      case ADD:  *d1 = 1.0; *d2 = 1.0; break;
+      case SUB:  *d1 = 1.0; *d2 = -1.0; break;
+      case MUL:  *d1 = x2; *d2 = x1; break;
+      case DIV:  *d1 = 1.0/x2; *d2 = -y/x2; break;
+      case POW:  *d1 = x2*y/x1; *d2 = y*log(fabs(x1)); break;
+      case EXP:  *d1 = y; break;
+      case LOG:  *d1 = 1.0/x1; break;
+      case SQRT: *d1 = 0.5/y; break;
+      case MAX:  *d1 = (x1>x2) ? 1.0 : 0.0; *d2 = (x1>x2) ? 0.0 : 1.0; break;
+      case MIN:  *d1 = (x1<x2) ? 1.0 : 0.0; *d2 = (x1<x2) ? 0.0 : 1.0; break;
+      case ABS:  *d1 = (x1==0) ? 1.0 : y/x1; break;
+      case SIN:  *d1 = cos(x1); break;
+      case COS:  *d1 = -sin(x1); break;
+      case TAN:  *d1 = 1.0 + y*y; break;
+      case SINH: *d1 = cosh(x1); break;
+      case COSH: *d1 = sinh(x1); break;
+      case TANH: *d1 = 1.0 - y*y; break;
+      case FMA:  *d1 = x2; *d2 = x1; break;
+      case SQUARE: *d1 = 2.0*x1; break;
+      case RECIP: *d1 = -y*y; break;
+      case SIGMOID: *d1 = y*(1.0 - y); break;
+      case SWISH: *d1 = (1.0 + x1 - y)/(1.0 + exp(-x1)); break;
+    }
+  }
+
+  // Second partial derivatives d11=d2y/dx1^2, d12=d2y/dx1dx2 and
+  // d22=d2y/dx2^2 of y = x1 (operation) x2 (zero for the piecewise linear
+  // operations and SELECT)
+
+  void calculateSecondPartials(int operation, double x1, double x2, double y, double *d11, double *d12, double *d22)
+  {
+    *d11 = 0.0;
+    *d12 = 0.0;
+    *d22 = 0.0;
+    switch(operation)
+    {
+      case MUL:  *d12 = 1.0; break;
+      case DIV:  *d12 = -1.0/(x2*x2); *d22 = 2.0*y/(x2*x2); break;
+      case POW:  *d11 = x2*(x2-1.0)*y/(x1*x1); *d12 = y/x1*(1.0 + x2*log(fabs(x1)));
+                 *d22 = y*log(fabs(x1))*log(fabs(x1)); break;
+      case EXP:  *d11 = y; break;
+      case LOG:  *d11 = -1.0/(x1*x1); break;
+      case SQRT: *d11 = -0.25/(y*y*y); break;
+      case SIN:  *d11 = -y; break;
+      case COS:  *d11 = -y; break;
+      case TAN:  *d11 = 2.0*y*(1.0 + y*y); break;
+      case SINH: *d11 = y; break;
+      case COSH: *d11 = y; break;
+      case TANH: *d11 = -2.0*y*(1.0 - y*y); break;
+      case FMA:  *d12 = 1.0; break;
+      case SQUARE: *d11 = 2.0; break;
+      case RECIP: *d11 = 2.0*y*y*y; break;
+      case SIGMOID: *d11 = y*(1.0 - y)*(1.0 - 2.0*y); break;
+      case SWISH:
+      {
+        double s = 1.0/(1.0 + exp(-x1));
+        *d11 = s*(1.0 - s)*(2.0 + x1*(1.0 - 2.0*s));
+        break;
+      }
+    }
+  }
+
+  // Partials of instruction i: SELECT depends on its condition (stored in
+  // blockEnd), which calculatePartials does not see
+
+  void calculateInstructionPartials(const SAD_Tape *tape, const double *value, int i, double *d1, double *d2)
+  {
+    int op2 = tape->operand2[i];
+    if(tape->operation[i]==SELECT)
+    {
+      *d1 = (value[tape->blockEnd[i]]>0) ? 1.0 : 0.0;
+      *d2 = 1.0 - *d1;
+    }
+    else
+    {
+      calculatePartials(tape->operation[i], value[tape->operand1[i]], (op2!=-1) ? value[op2] : 0.0, value[i], d1, d2);
+    }
+  }
+
+  // Propagates a block of width adjoints (deriv[i*width+k]) of instruction i
+  // to its operands
+
+  void calculateSensitivity(const SAD_Tape *tape, const double *value, double *deriv, int i, int width)
   {
-    int op1 = instructions[i].operand1;
-    int op2 = instructions[i].operand2;
+    int op1 = tape->operand1[i];
+    int op2 = tape->operand2[i];
     if(op1!=-1)
     {
       double d1, d2;
-      double y = instructions[i].value;
-      double x1 = instructions[op1].value;
-      double x2 = 0.0;
-      if(op2!=-1) x2 = instructions[op2].value;
-      switch(instructions[i].operation)
-      {
-        case NEG:  d1 = -1.0; break;
-        case ADD:  d1 = 1.0; d2 = 1.0; break;
-        case SUB:  d1 = 1.0; d2 = -1.0; break;
-        case MUL:  d1 = x2; d2 = x1; break;
-        case DIV:  d1 = 1.0/x2; d2 = -y/x2; break;
-        case POW:  d1 = x2*y/x1; d2 = y*log(fabs(x1)); break;
-        case EXP:  d1 = y; break;
-        case LOG:  d1 = 1.0/x1; break;
-        case SQRT: d1 = 0.5/y; break;
-        case MAX:  d1 = (x1>x2) ? 1.0 : 0.0; d2 = (x1>x2) ? 0.0 : 1.0; break;
-        case MIN:  d1 = (x1<x2) ? 1.0 : 0.0; d2 = (x1<x2) ? 0.0 : 1.0; break;
-        case ABS:  d1 = (x1==0) ? 1.0 : y/x1; break;
-        case SIN:  d1 = cos(x1); break;
-        case COS:  d1 = -sin(x1); break;
-        case TAN:  d1 = 1.0 + y*y; break;
-        case SINH: d1 = cosh(x1); break;
-        case COSH: d1 = sinh(x1); break;
-        case TANH: d1 = 1.0 - y*y; break;
-      }
-      instructions[op1].deriv += d1 * instructions[i].deriv;
-      if(op2!=-1) instructions[op2].deriv += d2 * instructions[i].deriv;
+      calculateInstructionPartials(tape, value, i, &d1, &d2);
+      const double *yb = deriv + (size_t)i*width;
+      double *x1b = deriv + (size_t)op1*width;
+      for(int k=0; k<width; k++) x1b[k] += d1 * yb[k];
+      if(op2!=-1)
+      {
+        double *x2b = deriv + (size_t)op2*width;
+        for(int k=0; k<width; k++) x2b[k] += d2 * yb[k];
+      }
+      int op3 = getAddend(tape, i);
+      if(op3!=-1)
+      {
+        double *x3b = deriv + (size_t)op3*width;
+        for(int k=0; k<width; k++) x3b[k] += yb[k];
+      }
     }
   }
 
-  void setTapeInput(SAD_Tape tape, int iInput, double val)
+  // The outputs of a tape are the nOutputs instructions just before the end
+  // of the innermost true conditional block (or of the tape)
+
+  int getOutputID(const SAD_Tape *tape, const SAD_Workspace *work, int iOutput)
   {
-    assert(iInput<tape.nInputs);
-    tape.instructions[iInput].value = val;
+    return work->effectiveTapeSize - tape->nOutputs + iOutput;
   }
 
-  double getTapeOutput(SAD_Tape tape, int iOutput)
+  void evaluateWorkspaceOutputs(const SAD_Tape *tape, SAD_Workspace *work)
   {
-    assert(iOutput<tape.nOutputs);
-    return tape.instructions[tape.effectiveTapeSize-tape.nOutputs+iOutput-1].value;
+    work->effectiveTapeSize = tape->tapeSize;
+
+    for(int i=tape->nInputs; i<work->effectiveTapeSize; i++)
+    {
+      if(isConditionalStatement(tape, i))
+      {
+        if(conditionalIsTrue(tape, work->value, i))
+        {
+          work->effectiveTapeSize = tape->blockEnd[i];
+        }
+        else
+        {
+          i = tape->blockEnd[i];
+        }
+      }
+      else
+      {
+        calculateValue(tape, work->value, i);
+      }
+    }
   }
 
-  double getTapeJacobian(SAD_Tape tape, int iOutput, int iInput)
+  int getChunkWidth(const SAD_Tape *tape, int chunkWidth)
   {
-    assert(iInput<tape.nInputs && iOutput<tape.nOutputs);
-    return tape.jacobian[iOutput*(tape.nInputs) + iInput];
+    if(chunkWidth<=0) chunkWidth = SAD_DEFAULT_CHUNK_WIDTH;
+    if(chunkWidth>tape->nOutputs) chunkWidth = tape->nOutputs;
+    return (chunkWidth<1) ? 1 : chunkWidth;
   }
 
-  void evaluateOutputs(SAD_Tape *tape)
+  // Vector-mode reverse sweep filling jacobian[nOutputs][nInputs]: the
+  // outputs are processed in chunks of chunkWidth (SAD_DEFAULT_CHUNK_WIDTH if
+  // chunkWidth<=0), each chunk with a single reverse sweep carrying one
+  // adjoint per output of the chunk. Larger chunks need fewer sweeps but
+  // nInstructions*chunkWidth adjoints. If the workspace cannot hold chunks of
+  // this width, the adjoints are allocated for the duration of the call
+  // (evaluateWorkspaceOutputs must have been called before)
+
+  void evaluateWorkspaceJacobian(const SAD_Tape *tape, SAD_Workspace *work, double *jacobian, int chunkWidth)
   {
-    tape->effectiveTapeSize = tape->tapeSize;
+    int width = getChunkWidth(tape, chunkWidth);
+    double *deriv = work->deriv;
+    if(width>work->derivWidth) deriv = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+
+    for(int beg=0; beg<tape->nOutputs; beg+=width)
+    {
+      int n = (beg+width<=tape->nOutputs) ? width : tape->nOutputs-beg;
+      int lastID = getOutputID(tape, work, beg+n-1);
+
+      memset(deriv, 0, (size_t)(lastID+1)*width*sizeof(double));
+      for(int k=0; k<n; k++) deriv[(size_t)getOutputID(tape, work, beg+k)*width+k] = 1.0;
+
+      for(int i=lastID; i>=tape->nInputs; i--)
+      {
+        if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+        calculateSensitivity(tape, work->value, deriv, i, width);
+      }
+
+      for(int k=0; k<n; k++)
+      {
+        for(int iInput=0; iInput<tape->nInputs; iInput++)
+        {
+          jacobian[(beg+k)*(tape->nInputs)+iInput] = deriv[(size_t)iInput*width+k];
+        }
+      }
+    }
+
+    if(deriv!=work->deriv) free(deriv);
+  }
 
-    for(int i=tape->nInputs; i<tape->effectiveTapeSize; i++)
+  // Forward (tangent) sweep fused with the evaluation of the values: the
+  // tangents of the inputs along nDirections directions are given in
+  // seeds[nInputs][nDirections], and tangent[i*nDirections+k] receives the
+  // tangent of instruction i along direction k. If mask is not NULL, the
+  // tangents of the unmarked instructions are not computed (they must be
+  // zero on input, see getActiveMask)
+
+  void evaluateWorkspaceMaskedTangents(const SAD_Tape *tape, SAD_Workspace *work, const double *seeds, double *tangent,
+                                       int nDirections, const int *mask)
+  {
+    double *value = work->value;
+    work->effectiveTapeSize = tape->tapeSize;
+
+    memcpy(tangent, seeds, (size_t)tape->nInputs*nDirections*sizeof(double));
+    for(int i=tape->nInputs; i<work->effectiveTapeSize; i++)
     {
-      if(isConditionalStatement(tape->instructions, i))
+      if(isConditionalStatement(tape, i))
       {
-        if(conditionalIsTrue(tape->instructions, i))
+        if(conditionalIsTrue(tape, value, i))
         {
-          tape->effectiveTapeSize = tape->instructions[i].blockEnd;
+          work->effectiveTapeSize = tape->blockEnd[i];
         }
         else
         {
-          i = tape->instructions[i].blockEnd;
+          i = tape->blockEnd[i];
         }
+        continue;
+      }
+      if(mask!=NULL && !mask[i])
+      {
+        calculateValue(tape, value, i);
+        continue;
+      }
+
+      double *yd = tangent + (size_t)i*nDirections;
+      int op1 = tape->operand1[i];
+      int op2 = tape->operand2[i];
+      if(op1==-1)
+      {
+        for(int k=0; k<nDirections; k++) yd[k] = 0.0;
+        continue;
+      }
+
+      double d1, d2;
+      calculateValue(tape, value, i);
+      calculateInstructionPartials(tape, value, i, &d1, &d2);
+      const double *x1d = tangent + (size_t)op1*nDirections;
+      if(op2!=-1)
+      {
+        const double *x2d = tangent + (size_t)op2*nDirections;
+        for(int k=0; k<nDirections; k++) yd[k] = d1*x1d[k] + d2*x2d[k];
       }
       else
       {
-        calculateValue(tape->instructions, i);
+        for(int k=0; k<nDirections; k++) yd[k] = d1*x1d[k];
+      }
+      int op3 = getAddend(tape, i);
+      if(op3!=-1)
+      {
+        const double *x3d = tangent + (size_t)op3*nDirections;
+        for(int k=0; k<nDirections; k++) yd[k] += x3d[k];
       }
     }
   }
 
-  void evaluateTapeOutputsAndJacobian(SAD_Tape *tape)
+  void evaluateWorkspaceTangents(const SAD_Tape *tape, SAD_Workspace *work, const double *seeds, double *tangent, int nDirections)
+  {
+    evaluateWorkspaceMaskedTangents(tape, work, seeds, tangent, nDirections, NULL);
+  }
+
+  // Forward mode jacobian: one forward sweep per chunk of chunkWidth inputs
+  // (the values are evaluated as well, so evaluateWorkspaceOutputs need not
+  // be called before)
+
+  void evaluateWorkspaceJacobianForward(const SAD_Tape *tape, SAD_Workspace *work, double *jacobian, int chunkWidth)
   {
-    int outputID;
-    evaluateOutputs(tape);
+    int nInputs = tape->nInputs;
+    int width = (chunkWidth<=0) ? SAD_DEFAULT_CHUNK_WIDTH : chunkWidth;
+    if(width>nInputs) width = (nInputs<1) ? 1 : nInputs;
 
-    for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+    double *tangent = work->deriv;
+    if(width>work->derivWidth) tangent = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+    double *seeds = (double*)malloc((size_t)nInputs*width*sizeof(double));
+
+    if(nInputs==0) evaluateWorkspaceOutputs(tape, work);
+    for(int beg=0; beg<nInputs; beg+=width)
+    {
+      int n = (beg+width<=nInputs) ? width : nInputs-beg;
+      memset(seeds, 0, (size_t)nInputs*width*sizeof(double));
+      for(int k=0; k<n; k++) seeds[(size_t)(beg+k)*width+k] = 1.0;
+
+      evaluateWorkspaceTangents(tape, work, seeds, tangent, width);
+
+      for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+      {
+        const double *yd = tangent + (size_t)getOutputID(tape, work, iOutput)*width;
+        for(int k=0; k<n; k++) jacobian[iOutput*nInputs+beg+k] = yd[k];
+      }
+    }
+
+    free(seeds);
+    if(tangent!=work->deriv) free(tangent);
+  }
+
+  // Evaluates the outputs and the jacobian with the forward or the reverse
+  // mode. JACOBIAN_AUTO uses the forward mode if the tape has no more inputs
+  // than outputs, since the number of sweeps then is the smallest
+
+  enum jacobianModesEnum
+  {
+    JACOBIAN_AUTO,
+    JACOBIAN_REVERSE,
+    JACOBIAN_FORWARD
+  };
+
+  void evaluateWorkspaceOutputsAndJacobian(const SAD_Tape *tape, SAD_Workspace *work, double *jacobian, int chunkWidth, int mode)
+  {
+    if(mode==JACOBIAN_AUTO) mode = (tape->nInputs<=tape->nOutputs) ? JACOBIAN_FORWARD : JACOBIAN_REVERSE;
+
+    if(mode==JACOBIAN_FORWARD)
+    {
+      evaluateWorkspaceJacobianForward(tape, work, jacobian, chunkWidth);
+    }
+    else
+    {
+      evaluateWorkspaceOutputs(tape, work);
+      evaluateWorkspaceJacobian(tape, work, jacobian, chunkWidth);
+    }
+  }
+
+  // Sparse jacobian with the sparsity pattern indptr[nOutputs+1], indices[nnz]
+  // (CSR) and a coloring of its columns (colors[nInputs], JACOBIAN_FORWARD)
+  // or of its rows (colors[nOutputs], JACOBIAN_REVERSE) with nColors colors,
+  // see jacobianColoring in AD_Tape.py. A single sweep with one derivative
+  // per color computes all the nonzeros, which are written to data[nnz].
+  // The values are evaluated as well
+
+  void evaluateWorkspaceSparseJacobian(const SAD_Tape *tape, SAD_Workspace *work, const int *indptr, const int *indices,
+                                       const int *colors, int nColors, int mode, double *data)
+  {
+    int width = (nColors<1) ? 1 : nColors;
+    double *deriv = work->deriv;
+    if(width>work->derivWidth) deriv = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+
+    if(mode==JACOBIAN_FORWARD)
+    {
+      double *seeds = (double*)calloc((size_t)tape->nInputs*width, sizeof(double));
+      for(int iInput=0; iInput<tape->nInputs; iInput++) seeds[(size_t)iInput*width+colors[iInput]] = 1.0;
+      evaluateWorkspaceTangents(tape, work, seeds, deriv, width);
+      free(seeds);
+
+      for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+      {
+        const double *yd = deriv + (size_t)getOutputID(tape, work, iOutput)*width;
+        for(int k=indptr[iOutput]; k<indptr[iOutput+1]; k++) data[k] = yd[colors[indices[k]]];
+      }
+    }
+    else
     {
-      outputID = tape->effectiveTapeSize - tape->nOutputs + iOutput - 1;
+      evaluateWorkspaceOutputs(tape, work);
+      int lastID = getOutputID(tape, work, tape->nOutputs-1);
+      memset(deriv, 0, (size_t)(lastID+1)*width*sizeof(double));
+      for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+      {
+        deriv[(size_t)getOutputID(tape, work, iOutput)*width+colors[iOutput]] = 1.0;
+      }
 
-      for(int i=tape->nInputs; i<outputID; i++) tape->instructions[i].deriv = 0.0;
-      tape->instructions[outputID].deriv = 1.0;
+      for(int i=lastID; i>=tape->nInputs; i--)
+      {
+        if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+        calculateSensitivity(tape, work->value, deriv, i, width);
+      }
 
-      for(int i=outputID; i>=tape->nInputs; i--)
+      for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
       {
-        if(tape->instructions[i].operation==IFEND) i = tape->instructions[i].blockEnd;
-        calculateSensitivity(tape->instructions, i);
+        for(int k=indptr[iOutput]; k<indptr[iOutput+1]; k++) data[k] = deriv[(size_t)indices[k]*width+colors[iOutput]];
       }
+    }
+
+    if(deriv!=work->deriv) free(deriv);
+  }
+
+  // Forward-over-reverse sweep: the gradient[nInputs] and the products
+  // hessianVectors[nInputs][nVectors] of the Hessian with
+  // vectors[nInputs][nVectors] of the sum of the outputs weighted by
+  // weights[nOutputs] (all ones if NULL). All the vectors share a single
+  // forward and reverse sweep. The values are evaluated as well
+
+  void evaluateWorkspaceHessianVectors(const SAD_Tape *tape, SAD_Workspace *work, const double *weights,
+                                       const double *vectors, int nVectors, double *gradient, double *hessianVectors)
+  {
+    double *value = work->value;
+    size_t width = (nVectors<1) ? 1 : nVectors;
+    double *tangent = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+    double *adjoint = (double*)calloc(tape->tapeSize, sizeof(double));
+    double *adjointTangent = (double*)calloc((size_t)tape->tapeSize*width, sizeof(double));
+
+    evaluateWorkspaceTangents(tape, work, vectors, tangent, nVectors);
+    for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+    {
+      adjoint[getOutputID(tape, work, iOutput)] = (weights!=NULL) ? weights[iOutput] : 1.0;
+    }
 
-      for(int iInput=0; iInput<tape->nInputs; iInput++)
+    int lastID = getOutputID(tape, work, tape->nOutputs-1);
+    for(int i=lastID; i>=tape->nInputs; i--)
+    {
+      if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+      int op1 = tape->operand1[i];
+      int op2 = tape->operand2[i];
+      if(op1==-1 || isConditionalStatement(tape, i)) continue;
+
+      double d1, d2, d11, d12, d22;
+      double x2 = (op2!=-1) ? value[op2] : 0.0;
+      calculateInstructionPartials(tape, value, i, &d1, &d2);
+      calculateSecondPartials(tape->operation[i], value[op1], x2, value[i], &d11, &d12, &d22);
+
+      double yb = adjoint[i];
+      const double *ybd = adjointTangent + (size_t)i*width;
+      const double *x1d = tangent + (size_t)op1*width;
+      double *x1bd = adjointTangent + (size_t)op1*width;
+      adjoint[op1] += d1*yb;
+      if(op2!=-1)
+      {
+        const double *x2d = tangent + (size_t)op2*width;
+        double *x2bd = adjointTangent + (size_t)op2*width;
+        adjoint[op2] += d2*yb;
+        for(int k=0; k<nVectors; k++)
+        {
+          double t1 = yb*(d11*x1d[k] + d12*x2d[k]);
+          double t2 = yb*(d12*x1d[k] + d22*x2d[k]);
+          x1bd[k] += d1*ybd[k] + t1;
+          x2bd[k] += d2*ybd[k] + t2;
+        }
+      }
+      else
       {
-        tape->jacobian[iOutput*(tape->nInputs)+iInput] = tape->instructions[iInput].deriv;
+        for(int k=0; k<nVectors; k++) x1bd[k] += d1*ybd[k] + yb*d11*x1d[k];
+      }
+      int op3 = getAddend(tape, i);
+      if(op3!=-1)
+      {
+        double *x3bd = adjointTangent + (size_t)op3*width;
+        adjoint[op3] += yb;
+        for(int k=0; k<nVectors; k++) x3bd[k] += ybd[k];
       }
     }
+
+    memcpy(gradient, adjoint, tape->nInputs*sizeof(double));
+    memcpy(hessianVectors, adjointTangent, (size_t)tape->nInputs*nVectors*sizeof(double));
+    free(tangent);
+    free(adjoint);
+    free(adjointTangent);
+  }
+
+  // Dense hessian[nInputs][nInputs], with one sweep per chunk of chunkWidth
+  // inputs (SAD_DEFAULT_CHUNK_WIDTH if chunkWidth<=0)
+
+  void evaluateWorkspaceHessian(const SAD_Tape *tape, SAD_Workspace *work, const double *weights, double *gradient,
+                                double *hessian, int chunkWidth)
+  {
+    int nInputs = tape->nInputs;
+    int width = (chunkWidth<=0) ? SAD_DEFAULT_CHUNK_WIDTH : chunkWidth;
+    if(width>nInputs) width = (nInputs<1) ? 1 : nInputs;
+    double *vectors = (double*)malloc((size_t)nInputs*width*sizeof(double));
+    double *hessianVectors = (double*)malloc((size_t)nInputs*width*sizeof(double));
+
+    if(nInputs==0) evaluateWorkspaceOutputs(tape, work);
+    for(int beg=0; beg<nInputs; beg+=width)
+    {
+      int n = (beg+width<=nInputs) ? width : nInputs-beg;
+      memset(vectors, 0, (size_t)nInputs*width*sizeof(double));
+      for(int k=0; k<n; k++) vectors[(size_t)(beg+k)*width+k] = 1.0;
+
+      evaluateWorkspaceHessianVectors(tape, work, weights, vectors, width, gradient, hessianVectors);
+
+      for(int iInput=0; iInput<nInputs; iInput++)
+      {
+        for(int k=0; k<n; k++) hessian[(size_t)iInput*nInputs+beg+k] = hessianVectors[(size_t)iInput*width+k];
+      }
+    }
+
+    free(vectors);
+    free(hessianVectors);
+  }
+
+  // Sparse Hessian with the sparsity pattern indptr[nInputs+1], indices[nnz]
+  // (CSR) and a coloring of its columns colors[nInputs] with nColors colors,
+  // see hessianColoring in AD_Tape.py. A single sweep with one Hessian-vector
+  // product per color gives all the nonzeros, written to data[nnz]
+
+  void evaluateWorkspaceSparseHessian(const SAD_Tape *tape, SAD_Workspace *work, const double *weights, const int *indptr,
+                                      const int *indices, const int *colors, int nColors, double *gradient, double *data)
+  {
+    int nInputs = tape->nInputs;
+    int width = (nColors<1) ? 1 : nColors;
+    double *vectors = (double*)calloc((size_t)nInputs*width, sizeof(double));
+    double *hessianVectors = (double*)malloc((size_t)nInputs*width*sizeof(double));
+    for(int iInput=0; iInput<nInputs; iInput++) vectors[(size_t)iInput*width+colors[iInput]] = 1.0;
+
+    evaluateWorkspaceHessianVectors(tape, work, weights, vectors, width, gradient, hessianVectors);
+
+    for(int iInput=0; iInput<nInputs; iInput++)
+    {
+      for(int k=indptr[iInput]; k<indptr[iInput+1]; k++) data[k] = hessianVectors[(size_t)iInput*width+colors[indices[k]]];
+    }
+
+    free(vectors);
+    free(hessianVectors);
+  }
+
+  void setTapeInput(SAD_Tape tape, int iInput, double val)
+  {
+    assert(iInput<tape.nInputs);
+    tape.value[iInput] = val;
+  }
+
+  double getTapeOutput(SAD_Tape tape, int iOutput)
+  {
+    assert(iOutput<tape.nOutputs);
+    return tape.value[tape.effectiveTapeSize-tape.nOutputs+iOutput];
+  }
+
+  double getTapeJacobian(SAD_Tape tape, int iOutput, int iInput)
+  {
+    assert(iInput<tape.nInputs && iOutput<tape.nOutputs);
+    return tape.jacobian[iOutput*(tape.nInputs) + iInput];
+  }
+
+  void evaluateOutputs(SAD_Tape *tape)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceOutputs(tape, &work);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  void evaluateTapeOutputsAndJacobian(SAD_Tape *tape)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceOutputsAndJacobian(tape, &work, tape->jacobian, SAD_DEFAULT_CHUNK_WIDTH, JACOBIAN_AUTO);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  // Derivatives of the outputs along nDirections directions of the inputs,
+  // directions[nInputs][nDirections] -> outputTangents[nOutputs][nDirections]
+
+  void evaluateTapeTangents(SAD_Tape *tape, int nDirections, double *directions, double *outputTangents)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    double *tangent = (double*)malloc((size_t)tape->tapeSize*nDirections*sizeof(double));
+    evaluateWorkspaceTangents(tape, &work, directions, tangent, nDirections);
+    for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+    {
+      memcpy(outputTangents + (size_t)iOutput*nDirections, tangent + (size_t)getOutputID(tape, &work, iOutput)*nDirections,
+             nDirections*sizeof(double));
+    }
+    free(tangent);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  // Sparse jacobian at the inputs set with setTapeInput, see
+  // evaluateWorkspaceSparseJacobian (mode is JACOBIAN_FORWARD or JACOBIAN_REVERSE)
+
+  void evaluateTapeSparseJacobian(SAD_Tape *tape, const int *indptr, const int *indices, const int *colors, int nColors, int mode, double *data)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceSparseJacobian(tape, &work, indptr, indices, colors, nColors, mode, data);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  // Hessian-vector products, dense and sparse Hessians of the weighted sum of
+  // the outputs at the inputs set with setTapeInput (see
+  // evaluateWorkspaceHessianVectors)
+
+  void evaluateTapeHessianVectors(SAD_Tape *tape, const double *weights, int nVectors, const double *vectors,
+                                  double *gradient, double *hessianVectors)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceHessianVectors(tape, &work, weights, vectors, nVectors, gradient, hessianVectors);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  void evaluateTapeHessian(SAD_Tape *tape, const double *weights, double *gradient, double *hessian)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceHessian(tape, &work, weights, gradient, hessian, SAD_DEFAULT_CHUNK_WIDTH);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  void evaluateTapeSparseHessian(SAD_Tape *tape, const double *weights, const int *indptr, const int *indices,
+                                 const int *colors, int nColors, double *gradient, double *data)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceSparseHessian(tape, &work, weights, indptr, indices, colors, nColors, gradient, data);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  //----------------------------------------------------------------------------
+  // Output subsets: mask[tapeSize] marks the instructions needed by the
+  // outputs selected[nSelected] (on every branch), together with the
+  // conditionals and the instructions they depend on, which decide the
+  // branch. The values and jacobian rows of the selected outputs are then
+  // computed skipping all the other instructions
+  //----------------------------------------------------------------------------
+
+  void getOutputConeMask(const SAD_Tape *tape, int nSelected, const int *selected, int *mask)
+  {
+    for(int i=0; i<tape->tapeSize; i++)
+    {
+      mask[i] = (isConditionalStatement(tape, i) || tape->operation[i]==IFEND) ? 1 : 0;
+    }
+
+    // The outputs are the nOutputs instructions before the end of every
+    // conditional block without nested conditionals (or of the tape if
+    // there are no conditionals): the last conditional before i is such a
+    // block if i is beyond its end
+    int last = -1;
+    for(int i=tape->nInputs; i<=tape->tapeSize; i++)
+    {
+      if(i<tape->tapeSize && !isConditionalStatement(tape, i)) continue;
+      int end = -1;
+      if(last==-1 && i==tape->tapeSize) end = tape->tapeSize;
+      if(last!=-1 && (i==tape->tapeSize || i>tape->blockEnd[last])) end = tape->blockEnd[last];
+      for(int k=0; k<nSelected && end!=-1; k++)
+      {
+        if(end-tape->nOutputs+selected[k]>=0) mask[end-tape->nOutputs+selected[k]] = 1;
+      }
+      last = i;
+    }
+
+    // The operands precede the instructions using them, so a single
+    // backward pass marks all the dependencies
+    for(int i=tape->tapeSize-1; i>=tape->nInputs; i--)
+    {
+      if(!mask[i] || tape->operation[i]==IFEND) continue;
+      if(tape->operand1[i]!=-1) mask[tape->operand1[i]] = 1;
+      if(tape->operand2[i]!=-1) mask[tape->operand2[i]] = 1;
+      if(getThirdOperand(tape, i)!=-1) mask[getThirdOperand(tape, i)] = 1;
+    }
+  }
+
+  void evaluateWorkspaceMaskedOutputs(const SAD_Tape *tape, SAD_Workspace *work, const int *mask)
+  {
+    work->effectiveTapeSize = tape->tapeSize;
+
+    for(int i=tape->nInputs; i<work->effectiveTapeSize; i++)
+    {
+      if(!mask[i]) continue;
+      if(isConditionalStatement(tape, i))
+      {
+        if(conditionalIsTrue(tape, work->value, i))
+        {
+          work->effectiveTapeSize = tape->blockEnd[i];
+        }
+        else
+        {
+          i = tape->blockEnd[i];
+        }
+      }
+      else
+      {
+        calculateValue(tape, work->value, i);
+      }
+    }
+  }
+
+  // Rows jacobian[nSelected][nInputs] of the selected outputs, with one
+  // reverse sweep per chunk of chunkWidth of them (see evaluateWorkspaceJacobian;
+  // evaluateWorkspaceMaskedOutputs must have been called before)
+
+  void evaluateWorkspaceSubsetJacobian(const SAD_Tape *tape, SAD_Workspace *work, int nSelected, const int *selected,
+                                       const int *mask, double *jacobian, int chunkWidth)
+  {
+    int width = (chunkWidth<=0) ? SAD_DEFAULT_CHUNK_WIDTH : chunkWidth;
+    if(width>nSelected) width = (nSelected<1) ? 1 : nSelected;
+    double *deriv = work->deriv;
+    if(width>work->derivWidth) deriv = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+
+    for(int beg=0; beg<nSelected; beg+=width)
+    {
+      int n = (beg+width<=nSelected) ? width : nSelected-beg;
+      int lastID = tape->nInputs-1;
+      for(int k=0; k<n; k++)
+      {
+        if(getOutputID(tape, work, selected[beg+k])>lastID) lastID = getOutputID(tape, work, selected[beg+k]);
+      }
+
+      memset(deriv, 0, (size_t)(lastID+1)*width*sizeof(double));
+      for(int k=0; k<n; k++) deriv[(size_t)getOutputID(tape, work, selected[beg+k])*width+k] = 1.0;
+
+      for(int i=lastID; i>=tape->nInputs; i--)
+      {
+        if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+        if(mask[i]) calculateSensitivity(tape, work->value, deriv, i, width);
+      }
+
+      for(int k=0; k<n; k++)
+      {
+        for(int iInput=0; iInput<tape->nInputs; iInput++)
+        {
+          jacobian[(beg+k)*(tape->nInputs)+iInput] = deriv[(size_t)iInput*width+k];
+        }
+      }
+    }
+
+    if(deriv!=work->deriv) free(deriv);
+  }
+
+  // Values outputs[nSelected] and (unless jacobian is NULL) jacobian rows
+  // jacobian[nSelected][nInputs] of the selected outputs at the inputs set
+  // with setTapeInput. The mask is computed if NULL
+
+  void evaluateTapeOutputSubset(SAD_Tape *tape, int nSelected, const int *selected, const int *mask,
+                                double *outputs, double *jacobian)
+  {
+    int *coneMask = NULL;
+    if(mask==NULL)
+    {
+      coneMask = (int*)malloc(tape->tapeSize*sizeof(int));
+      getOutputConeMask(tape, nSelected, selected, coneMask);
+      mask = coneMask;
+    }
+
+    SAD_Workspace work = getTapeWorkspace(tape);
+    evaluateWorkspaceMaskedOutputs(tape, &work, mask);
+    for(int k=0; k<nSelected; k++) outputs[k] = work.value[getOutputID(tape, &work, selected[k])];
+    if(jacobian!=NULL) evaluateWorkspaceSubsetJacobian(tape, &work, nSelected, selected, mask, jacobian, SAD_DEFAULT_CHUNK_WIDTH);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+    free(coneMask);
+  }
+
+  //----------------------------------------------------------------------------
+  // Active inputs: the jacobian with respect to the inputs active[nActive]
+  // only, the other inputs being passive parameters (see the passive
+  // arguments of AD_Tape.compile). mask[tapeSize] marks the instructions
+  // depending on an active input, the only ones with nonzero derivatives, and
+  // the derivative sweeps skip all the others
+  //----------------------------------------------------------------------------
+
+  void getActiveMask(const SAD_Tape *tape, int nActive, const int *active, int *mask)
+  {
+    memset(mask, 0, tape->tapeSize*sizeof(int));
+    for(int k=0; k<nActive; k++) mask[active[k]] = 1;
+
+    // The condition of SELECT is not differentiated, and neither are the
+    // conditionals
+    for(int i=tape->nInputs; i<tape->tapeSize; i++)
+    {
+      if(isConditionalStatement(tape, i) || tape->operation[i]==IFEND) continue;
+      int op1 = tape->operand1[i];
+      int op2 = tape->operand2[i];
+      int op3 = getAddend(tape, i);
+      mask[i] = (op1!=-1 && mask[op1]) || (op2!=-1 && mask[op2]) || (op3!=-1 && mask[op3]);
+    }
+  }
+
+  // Reverse mode jacobian[nOutputs][nActive], see evaluateWorkspaceJacobian
+  // (evaluateWorkspaceOutputs must have been called before)
+
+  void evaluateWorkspaceActiveJacobian(const SAD_Tape *tape, SAD_Workspace *work, int nActive, const int *active,
+                                       const int *mask, double *jacobian, int chunkWidth)
+  {
+    int width = getChunkWidth(tape, chunkWidth);
+    double *deriv = work->deriv;
+    if(width>work->derivWidth) deriv = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+
+    for(int beg=0; beg<tape->nOutputs; beg+=width)
+    {
+      int n = (beg+width<=tape->nOutputs) ? width : tape->nOutputs-beg;
+      int lastID = getOutputID(tape, work, beg+n-1);
+
+      memset(deriv, 0, (size_t)(lastID+1)*width*sizeof(double));
+      for(int k=0; k<n; k++) deriv[(size_t)getOutputID(tape, work, beg+k)*width+k] = 1.0;
+
+      for(int i=lastID; i>=tape->nInputs; i--)
+      {
+        if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+        if(mask[i]) calculateSensitivity(tape, work->value, deriv, i, width);
+      }
+
+      for(int k=0; k<n; k++)
+      {
+        for(int j=0; j<nActive; j++)
+        {
+          jacobian[(beg+k)*nActive+j] = deriv[(size_t)active[j]*width+k];
+        }
+      }
+    }
+
+    if(deriv!=work->deriv) free(deriv);
+  }
+
+  // Forward mode jacobian[nOutputs][nActive], with one forward sweep per
+  // chunk of chunkWidth active inputs (the values are evaluated as well)
+
+  void evaluateWorkspaceActiveJacobianForward(const SAD_Tape *tape, SAD_Workspace *work, int nActive, const int *active,
+                                              const int *mask, double *jacobian, int chunkWidth)
+  {
+    int nInputs = tape->nInputs;
+    int width = (chunkWidth<=0) ? SAD_DEFAULT_CHUNK_WIDTH : chunkWidth;
+    if(width>nActive) width = (nActive<1) ? 1 : nActive;
+
+    double *tangent = work->deriv;
+    if(width>work->derivWidth) tangent = (double*)malloc((size_t)tape->tapeSize*width*sizeof(double));
+    double *seeds = (double*)malloc((size_t)nInputs*width*sizeof(double));
+    memset(tangent, 0, (size_t)tape->tapeSize*width*sizeof(double));
+
+    if(nActive==0) evaluateWorkspaceOutputs(tape, work);
+    for(int beg=0; beg<nActive; beg+=width)
+    {
+      int n = (beg+width<=nActive) ? width : nActive-beg;
+      memset(seeds, 0, (size_t)nInputs*width*sizeof(double));
+      for(int k=0; k<n; k++) seeds[(size_t)active[beg+k]*width+k] = 1.0;
+
+      evaluateWorkspaceMaskedTangents(tape, work, seeds, tangent, width, mask);
+
+      for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+      {
+        const double *yd = tangent + (size_t)getOutputID(tape, work, iOutput)*width;
+        for(int k=0; k<n; k++) jacobian[iOutput*nActive+beg+k] = yd[k];
+      }
+    }
+
+    free(seeds);
+    if(tangent!=work->deriv) free(tangent);
+  }
+
+  // Evaluates the outputs (see getTapeOutput) and jacobian[nOutputs][nActive]
+  // at the inputs set with setTapeInput, with the forward or the reverse mode
+  // (JACOBIAN_AUTO compares nActive with nOutputs). The mask is computed if NULL
+
+  void evaluateTapeActiveJacobian(SAD_Tape *tape, int nActive, const int *active, const int *mask, int mode, double *jacobian)
+  {
+    int *activeMask = NULL;
+    if(mask==NULL)
+    {
+      activeMask = (int*)malloc(tape->tapeSize*sizeof(int));
+      getActiveMask(tape, nActive, active, activeMask);
+      mask = activeMask;
+    }
+    if(mode==JACOBIAN_AUTO) mode = (nActive<=tape->nOutputs) ? JACOBIAN_FORWARD : JACOBIAN_REVERSE;
+
+    SAD_Workspace work = getTapeWorkspace(tape);
+    if(mode==JACOBIAN_FORWARD)
+    {
+      evaluateWorkspaceActiveJacobianForward(tape, &work, nActive, active, mask, jacobian, SAD_DEFAULT_CHUNK_WIDTH);
+    }
+    else
+    {
+      evaluateWorkspaceOutputs(tape, &work);
+      evaluateWorkspaceActiveJacobian(tape, &work, nActive, active, mask, jacobian, SAD_DEFAULT_CHUNK_WIDTH);
+    }
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+    free(activeMask);
+  }
+
+  //----------------------------------------------------------------------------
+  // Incremental evaluation: the state keeps the values of the last evaluation
+  // and an index of the instructions depending on every input (on any branch,
+  // including the conditionals): the instructions depending on input j are
+  // indices[indptr[j]:indptr[j+1]]. evaluateIncremental only re-evaluates the
+  // instructions of the last evaluated path depending on the inputs that
+  // changed (visiting only these, in tape order), and evaluates the whole
+  // tape again if the outcome of a conditional changes
+  //----------------------------------------------------------------------------
+
+  typedef struct
+  {
+    int *indptr;
+    int *indices;
+    double *value;
+    double *inputs;
+    char *onPath;
+    char *outcome;
+    char *dirty;
+    int *pending;
+    int effectiveTapeSize;
+    int isValid;
+    long long nEvaluated;
+    long long nFullEvaluations;
+  } SAD_Incremental;
+
+  int compareIDs(const void *a, const void *b)
+  {
+    return *(const int*)a - *(const int*)b;
+  }
+
+  SAD_Incremental createIncremental(const SAD_Tape *tape)
+  {
+    SAD_Incremental inc;
+    int n = tape->tapeSize;
+
+    // Users of every instruction (CSR), including the conditionals
+    int *usersPtr = (int*)calloc(n+1, sizeof(int));
+    for(int i=tape->nInputs; i<n; i++)
+    {
+      if(tape->operation[i]==IFEND) continue;
+      if(tape->operand1[i]!=-1) usersPtr[tape->operand1[i]+1]++;
+      if(tape->operand2[i]!=-1) usersPtr[tape->operand2[i]+1]++;
+      if(getThirdOperand(tape, i)!=-1) usersPtr[getThirdOperand(tape, i)+1]++;
+    }
+    for(int i=0; i<n; i++) usersPtr[i+1] += usersPtr[i];
+    int *users = (int*)malloc((usersPtr[n]+1)*sizeof(int));
+    int *fill = (int*)malloc((n+1)*sizeof(int));
+    memcpy(fill, usersPtr, (n+1)*sizeof(int));
+    for(int i=tape->nInputs; i<n; i++)
+    {
+      if(tape->operation[i]==IFEND) continue;
+      if(tape->operand1[i]!=-1) users[fill[tape->operand1[i]]++] = i;
+      if(tape->operand2[i]!=-1) users[fill[tape->operand2[i]]++] = i;
+      if(getThirdOperand(tape, i)!=-1) users[fill[getThirdOperand(tape, i)]++] = i;
+    }
+
+    // Dependents of every input, by a depth-first search over the users
+    int *stamp = (int*)malloc((n+1)*sizeof(int));
+    for(int i=0; i<n; i++) stamp[i] = -1;
+    int *stack = fill;
+    int capacity = n+1, size = 0;
+    inc.indptr = (int*)malloc((tape->nInputs+1)*sizeof(int));
+    inc.indices = (int*)malloc(capacity*sizeof(int));
+    inc.indptr[0] = 0;
+    for(int j=0; j<tape->nInputs; j++)
+    {
+      int top = 0;
+      stack[top++] = j;
+      while(top>0)
+      {
+        int i = stack[--top];
+        for(int k=usersPtr[i]; k<usersPtr[i+1]; k++)
+        {
+          int user = users[k];
+          if(stamp[user]==j) continue;
+          stamp[user] = j;
+          stack[top++] = user;
+          if(size==capacity)
+          {
+            capacity *= 2;
+            inc.indices = (int*)realloc(inc.indices, capacity*sizeof(int));
+          }
+          inc.indices[size++] = user;
+        }
+      }
+      inc.indptr[j+1] = size;
+      qsort(inc.indices+inc.indptr[j], size-inc.indptr[j], sizeof(int), compareIDs);
+    }
+    free(usersPtr);
+    free(users);
+    free(fill);
+    free(stamp);
+
+    inc.value = (double*)malloc(n*sizeof(double));
+    memcpy(inc.value, tape->value, n*sizeof(double));
+    inc.inputs = (double*)malloc((tape->nInputs+1)*sizeof(double));
+    inc.onPath = (char*)calloc(n+1, sizeof(char));
+    inc.outcome = (char*)calloc(n+1, sizeof(char));
+    inc.dirty = (char*)calloc(n+1, sizeof(char));
+    inc.pending = (int*)malloc((n+1)*sizeof(int));
+    inc.effectiveTapeSize = n;
+    inc.isValid = 0;
+    inc.nEvaluated = 0;
+    inc.nFullEvaluations = 0;
+    return inc;
+  }
+
+  void deleteIncremental(SAD_Incremental inc)
+  {
+    free(inc.indptr);
+    free(inc.indices);
+    free(inc.value);
+    free(inc.inputs);
+    free(inc.onPath);
+    free(inc.outcome);
+    free(inc.dirty);
+    free(inc.pending);
+  }
+
+  void evaluateIncrementalPath(const SAD_Tape *tape, SAD_Incremental *inc)
+  {
+    memset(inc->onPath, 0, tape->tapeSize*sizeof(char));
+    inc->effectiveTapeSize = tape->tapeSize;
+    inc->nEvaluated = 0;
+    for(int i=tape->nInputs; i<inc->effectiveTapeSize; i++)
+    {
+      inc->onPath[i] = 1;
+      inc->nEvaluated++;
+      if(isConditionalStatement(tape, i))
+      {
+        inc->outcome[i] = (char)conditionalIsTrue(tape, inc->value, i);
+        if(inc->outcome[i])
+        {
+          inc->effectiveTapeSize = tape->blockEnd[i];
+        }
+        else
+        {
+          i = tape->blockEnd[i];
+        }
+      }
+      else
+      {
+        calculateValue(tape, inc->value, i);
+      }
+    }
+    inc->nFullEvaluations++;
+  }
+
+  // Evaluates outputs[nOutputs] at inputs[nInputs]
+
+  void evaluateIncremental(const SAD_Tape *tape, SAD_Incremental *inc, const double *inputs, double *outputs)
+  {
+    int isValid = inc->isValid;
+    if(isValid)
+    {
+      // Union of the (sorted) dependents of the changed inputs, which is
+      // sorted already if a single input changed
+      int nPending = 0, nChanged = 0;
+      for(int j=0; j<tape->nInputs; j++)
+      {
+        if(inputs[j]==inc->inputs[j]) continue;
+        inc->value[j] = inputs[j];
+        nChanged++;
+        for(int k=inc->indptr[j]; k<inc->indptr[j+1]; k++)
+        {
+          int i = inc->indices[k];
+          if(inc->dirty[i]) continue;
+          inc->dirty[i] = 1;
+          inc->pending[nPending++] = i;
+        }
+      }
+      if(nChanged>1) qsort(inc->pending, nPending, sizeof(int), compareIDs);
+
+      // The dirty instructions are visited in tape order (the marks are
+      // cleared even after a conditional has changed)
+      inc->nEvaluated = 0;
+      for(int p=0; p<nPending; p++)
+      {
+        int i = inc->pending[p];
+        inc->dirty[i] = 0;
+        if(!isValid || !inc->onPath[i]) continue;
+        if(isConditionalStatement(tape, i))
+        {
+          if(conditionalIsTrue(tape, inc->value, i)!=inc->outcome[i]) isValid = 0;
+        }
+        else
+        {
+          calculateValue(tape, inc->value, i);
+          inc->nEvaluated++;
+        }
+      }
+    }
+
+    if(!isValid)
+    {
+      memcpy(inc->value, inputs, tape->nInputs*sizeof(double));
+      evaluateIncrementalPath(tape, inc);
+      inc->isValid = 1;
+    }
+
+    memcpy(inc->inputs, inputs, tape->nInputs*sizeof(double));
+    for(int k=0; k<tape->nOutputs; k++) outputs[k] = inc->value[inc->effectiveTapeSize-tape->nOutputs+k];
+  }
+
+  //----------------------------------------------------------------------------
+  // Profiling: the same sweeps as evaluateOutputs and the reverse mode of
+  // evaluateTapeOutputsAndJacobian, timed and with the number of instructions
+  // of each operation they went through. The statistics are accumulated over
+  // the calls (resetStats clears them). The instructions are counted by a
+  // separate walk along the evaluated path, so the timed sweeps are the
+  // regular ones
+  //----------------------------------------------------------------------------
+
+  #define SAD_MAX_OPERATIONS 64
+
+  typedef struct
+  {
+    long long nForwardSweeps;
+    long long nReverseSweeps;
+    double forwardTime;
+    double reverseTime;
+    long long forwardCounts[SAD_MAX_OPERATIONS];
+    long long reverseCounts[SAD_MAX_OPERATIONS];
+  } SAD_Stats;
+
+  void resetStats(SAD_Stats *stats)
+  {
+    memset(stats, 0, sizeof(SAD_Stats));
+  }
+
+  double getTime()
+  {
+#ifdef _WIN32
+    return (double)clock()/CLOCKS_PER_SEC;
+#else
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + 1e-9*t.tv_nsec;
+#endif
+  }
+
+  // Counts the instructions of the path of the last forward sweep (including
+  // the conditionals), and of a reverse sweep from instruction lastID
+
+  void countForwardInstructions(const SAD_Tape *tape, const SAD_Workspace *work, long long *counts)
+  {
+    int effectiveTapeSize = tape->tapeSize;
+    for(int i=tape->nInputs; i<effectiveTapeSize; i++)
+    {
+      counts[tape->operation[i]]++;
+      if(isConditionalStatement(tape, i))
+      {
+        if(conditionalIsTrue(tape, work->value, i)) effectiveTapeSize = tape->blockEnd[i];
+        else i = tape->blockEnd[i];
+      }
+    }
+  }
+
+  void countReverseInstructions(const SAD_Tape *tape, int lastID, long long *counts)
+  {
+    for(int i=lastID; i>=tape->nInputs; i--)
+    {
+      if(tape->operation[i]==IFEND) i = tape->blockEnd[i];
+      counts[tape->operation[i]]++;
+    }
+  }
+
+  void evaluateOutputsProfiled(SAD_Tape *tape, SAD_Stats *stats)
+  {
+    SAD_Workspace work = getTapeWorkspace(tape);
+    double start = getTime();
+    evaluateWorkspaceOutputs(tape, &work);
+    stats->forwardTime += getTime()-start;
+    stats->nForwardSweeps++;
+    countForwardInstructions(tape, &work, stats->forwardCounts);
+    tape->effectiveTapeSize = work.effectiveTapeSize;
+  }
+
+  // One reverse sweep per chunk of chunkWidth outputs (see evaluateWorkspaceJacobian)
+
+  void evaluateTapeOutputsAndJacobianProfiled(SAD_Tape *tape, int chunkWidth, SAD_Stats *stats)
+  {
+    evaluateOutputsProfiled(tape, stats);
+
+    SAD_Workspace work = getTapeWorkspace(tape);
+    double start = getTime();
+    evaluateWorkspaceJacobian(tape, &work, tape->jacobian, chunkWidth);
+    stats->reverseTime += getTime()-start;
+
+    int width = getChunkWidth(tape, chunkWidth);
+    for(int beg=0; beg<tape->nOutputs; beg+=width)
+    {
+      int n = (beg+width<=tape->nOutputs) ? width : tape->nOutputs-beg;
+      countReverseInstructions(tape, getOutputID(tape, &work, beg+n-1), stats->reverseCounts);
+      stats->nReverseSweeps++;
+    }
+  }
+
+  //----------------------------------------------------------------------------
+  // Batched evaluation: inputs[nPoints][nInputs] -> outputs[nPoints][nOutputs]
+  // and (unless jacobian is NULL) jacobian[nPoints][nOutputs][nInputs]. The
+  // points are split between nThreads threads (all the available processors
+  // if nThreads<=0), each with its own workspace. The jacobians are computed
+  // with chunks of chunkWidth outputs or inputs, in the given mode (see
+  // evaluateWorkspaceOutputsAndJacobian)
+  //----------------------------------------------------------------------------
+
+  typedef struct
+  {
+    const SAD_Tape *tape;
+    int beg;
+    int end;
+    const double *inputs;
+    double *outputs;
+    double *jacobian;
+    int chunkWidth;
+    int mode;
+  } SAD_BatchTask;
+
+  void *evaluateBatchTask(void *arg)
+  {
+    SAD_BatchTask *task = (SAD_BatchTask*)arg;
+    const SAD_Tape *tape = task->tape;
+    int nInputs = tape->nInputs, nOutputs = tape->nOutputs;
+    int width = 1;
+    if(task->jacobian!=NULL)
+    {
+      width = (task->chunkWidth<=0) ? SAD_DEFAULT_CHUNK_WIDTH : task->chunkWidth;
+      int nMax = (nInputs>nOutputs) ? nInputs : nOutputs;
+      if(width>nMax) width = (nMax<1) ? 1 : nMax;
+    }
+    SAD_Workspace work = createWorkspace(tape, width);
+
+    for(int p=task->beg; p<task->end; p++)
+    {
+      memcpy(work.value, task->inputs + (size_t)p*nInputs, nInputs*sizeof(double));
+      if(task->jacobian!=NULL)
+      {
+        evaluateWorkspaceOutputsAndJacobian(tape, &work, task->jacobian + (size_t)p*nOutputs*nInputs, width, task->mode);
+      }
+      else
+      {
+        evaluateWorkspaceOutputs(tape, &work);
+      }
+      for(int iOutput=0; iOutput<nOutputs; iOutput++)
+      {
+        task->outputs[(size_t)p*nOutputs+iOutput] = work.value[getOutputID(tape, &work, iOutput)];
+      }
+    }
+
+    deleteWorkspace(work);
+    return NULL;
+  }
+
+  int getNumberOfThreads(int nThreads, int nPoints)
+  {
+#ifdef SAD_NO_THREADS
+    nThreads = 1;
+#else
+    if(nThreads<=0) nThreads = (int)sysconf(_SC_NPROCESSORS_ONLN);
+#endif
+    if(nThreads>nPoints) nThreads = nPoints;
+    return (nThreads<1) ? 1 : nThreads;
+  }
+
+  void evaluateTapeBatch(SAD_Tape *tape, int nPoints, double *inputs, double *outputs, double *jacobian, int nThreads, int chunkWidth, int mode)
+  {
+    nThreads = getNumberOfThreads(nThreads, nPoints);
+    SAD_BatchTask *tasks = (SAD_BatchTask*)malloc(nThreads*sizeof(SAD_BatchTask));
+
+    for(int t=0; t<nThreads; t++)
+    {
+      tasks[t].tape     = tape;
+      tasks[t].beg      = (int)(((long long)nPoints*t)/nThreads);
+      tasks[t].end      = (int)(((long long)nPoints*(t+1))/nThreads);
+      tasks[t].inputs   = inputs;
+      tasks[t].outputs  = outputs;
+      tasks[t].jacobian = jacobian;
+      tasks[t].chunkWidth = chunkWidth;
+      tasks[t].mode     = mode;
+    }
+
+#ifdef SAD_NO_THREADS
+    evaluateBatchTask(&tasks[0]);
+#else
+    pthread_t *threads = (pthread_t*)malloc(nThreads*sizeof(pthread_t));
+    for(int t=1; t<nThreads; t++) pthread_create(&threads[t], NULL, evaluateBatchTask, &tasks[t]);
+    evaluateBatchTask(&tasks[0]);
+    for(int t=1; t<nThreads; t++) pthread_join(threads[t], NULL);
+    free(threads);
+#endif
+
+    free(tasks);
+  }
+
+  //----------------------------------------------------------------------------
+  // Checkpointed evaluation: the reverse sweep without the values and adjoints
+  // of the whole tape in memory. The tape is split into segments of
+  // segmentSize instructions, and the forward sweep keeps only a snapshot of
+  // the values that are live at the start of every segment (computed before
+  // it and used in or after it, leaving out the inputs and the constants,
+  // which are always available). The reverse sweep then recomputes one
+  // segment at a time from its snapshot, carrying the adjoints of the live
+  // values from segment to segment. This costs one extra forward sweep per
+  // reverse sweep, and the memory is the sum of the snapshots plus the values
+  // and adjoints of a single segment. The constants are read from tape->value,
+  // which is never written (so a memory-mapped binary tape stays on disk).
+  // Short segments make the segment buffers small and the snapshots many,
+  // long segments the other way round: createCheckpoints picks the longest
+  // segments (a power of two, or the whole tape) whose memory fits into memoryBudget bytes, or
+  // the ones using the least memory if none does (or if memoryBudget<=0)
+  //----------------------------------------------------------------------------
+
+  typedef struct
+  {
+    int segmentSize;
+    int nSegments;
+    long long snapshotValues;         // values stored in all the snapshots
+    long long forwardInstructions;    // instructions evaluated by the forward sweep
+    long long recomputedInstructions; // instructions evaluated again by the reverse sweeps
+    double memory;                    // bytes used by the checkpointed evaluation
+    double plainMemory;               // bytes of values and adjoints of the plain evaluation
+  } SAD_CheckpointStats;
+
+  typedef struct
+  {
+    int segmentSize;
+    int nSegments;
+    int width;
+    int effectiveTapeSize;
+    int *livePtr;          // live values at the start of segment s: live[livePtr[s]:livePtr[s+1]],
+    int *live;             // sorted (segment nSegments holds the values live at the end)
+    int *entry;            // first instruction of each segment reached by the forward sweep
+    double *snapshot;      // values of live
+    double *inputValue;
+    double *inputDeriv;
+    double *segmentValue;
+    double *segmentDeriv;
+    double *liveDeriv;
+    double *nextLiveDeriv;
+    SAD_CheckpointStats stats;
+  } SAD_Checkpoints;
+
+  int getSegmentBegin(const SAD_Tape *tape, const SAD_Checkpoints *cp, int s)
+  {
+    return (s<cp->nSegments) ? tape->nInputs + s*cp->segmentSize : tape->tapeSize;
+  }
+
+  // lastUse[i]: last instruction using instruction i as an operand, tapeSize
+  // for the candidate outputs (the instructions before the end of the tape
+  // and before the end of every conditional block), -1 if unused
+
+  void getLastUses(const SAD_Tape *tape, int *lastUse)
+  {
+    for(int i=0; i<tape->tapeSize; i++) lastUse[i] = -1;
+    for(int i=tape->nInputs; i<tape->tapeSize; i++)
+    {
+      if(tape->operand1[i]!=-1) lastUse[tape->operand1[i]] = i;
+      if(tape->operand2[i]!=-1) lastUse[tape->operand2[i]] = i;
+      if(getThirdOperand(tape, i)!=-1) lastUse[tape->blockEnd[i]] = i;
+    }
+    for(int i=tape->nInputs; i<=tape->tapeSize; i++)
+    {
+      if(i<tape->tapeSize && !isConditionalStatement(tape, i)) continue;
+      int end = (i<tape->tapeSize) ? tape->blockEnd[i] : tape->tapeSize;
+      for(int k=end-tape->nOutputs; k<end; k++)
+      {
+        if(k>=0) lastUse[k] = tape->tapeSize;
+      }
+    }
+  }
+
+  int isLiveValue(const SAD_Tape *tape, const int *lastUse, int i)
+  {
+    return i>=tape->nInputs && lastUse[i]>i && tape->operation[i]!=CONST && tape->operation[i]!=IFEND &&
+           !isConditionalStatement(tape, i);
+  }
+
+  // Range [*first, *last] of the segment starts at which instruction i is live
+
+  void getLiveSegments(const SAD_Tape *tape, const int *lastUse, int segmentSize, int nSegments, int i, int *first, int *last)
+  {
+    *first = (i-tape->nInputs)/segmentSize + 1;
+    *last = (lastUse[i]>=tape->tapeSize) ? nSegments : (lastUse[i]-tape->nInputs)/segmentSize;
+  }
+
+  // Number of live values of the segments of segmentSize instructions
+  // (in total and the largest at a single segment start), and the bytes used
+
+  double getCheckpointMemory(const SAD_Tape *tape, const int *lastUse, int segmentSize, int width,
+                             long long *totalLive, int *maxLive)
+  {
+    int nSegments = (tape->tapeSize-tape->nInputs+segmentSize-1)/segmentSize;
+    int *count = (int*)calloc(nSegments+2, sizeof(int));
+    for(int i=tape->nInputs; i<tape->tapeSize; i++)
+    {
+      if(!isLiveValue(tape, lastUse, i)) continue;
+      int first, last;
+      getLiveSegments(tape, lastUse, segmentSize, nSegments, i, &first, &last);
+      if(first>last) continue;
+      count[first]++;
+      count[last+1]--;
+    }
+    *totalLive = 0;
+    *maxLive = 0;
+    for(int s=0, n=0; s<=nSegments; s++)
+    {
+      n += count[s];
+      *totalLive += n;
+      if(n>*maxLive) *maxLive = n;
+    }
+    free(count);
+
+    return (double)(*totalLive)*(sizeof(double)+sizeof(int)) + (2.0*nSegments+2)*sizeof(int) +
+           (double)segmentSize*(1+width)*sizeof(double) + 2.0*(*maxLive)*width*sizeof(double) +
+           (double)tape->nInputs*(1+width)*sizeof(double);
+  }
+
+  // Checkpoints for reverse sweeps carrying width adjoints (outputs) at once
+
+  SAD_Checkpoints createCheckpoints(const SAD_Tape *tape, double memoryBudget, int width)
+  {
+    SAD_Checkpoints cp;
+    int nInstructions = tape->tapeSize - tape->nInputs;
+    int *lastUse = (int*)malloc((tape->tapeSize+1)*sizeof(int));
+    getLastUses(tape, lastUse);
+    if(width<1) width = 1;
+
+    int segmentSize = 1, bestSize = 1, maxLive;
+    long long totalLive;
+    double bestMemory = -1.0;
+    for(int size=16; ; size*=2)
+    {
+      if(size>=nInstructions) size = (nInstructions>1) ? nInstructions : 1;
+      double memory = getCheckpointMemory(tape, lastUse, size, width, &totalLive, &maxLive);
+      if(bestMemory<0 || memory<bestMemory)
+      {
+        bestSize = size;
+        bestMemory = memory;
+      }
+      if(memoryBudget>0 && memory<=memoryBudget) segmentSize = size;
+      if(size>=nInstructions) break;
+    }
+    if(segmentSize==1) segmentSize = bestSize;
+
+    cp.segmentSize = segmentSize;
+    cp.nSegments = (nInstructions+segmentSize-1)/segmentSize;
+    cp.width = width;
+    cp.effectiveTapeSize = tape->tapeSize;
+    double memory = getCheckpointMemory(tape, lastUse, segmentSize, width, &totalLive, &maxLive);
+
+    cp.livePtr = (int*)calloc(cp.nSegments+2, sizeof(int));
+    cp.live = (int*)malloc((totalLive+1)*sizeof(int));
+    for(int i=tape->nInputs; i<tape->tapeSize; i++)
+    {
+      if(!isLiveValue(tape, lastUse, i)) continue;
+      int first, last;
+      getLiveSegments(tape, lastUse, segmentSize, cp.nSegments, i, &first, &last);
+      for(int s=first; s<=last; s++) cp.livePtr[s+1]++;
+    }
+    for(int s=0; s<=cp.nSegments; s++) cp.livePtr[s+1] += cp.livePtr[s];
+    int *fill = (int*)malloc((cp.nSegments+1)*sizeof(int));
+    memcpy(fill, cp.livePtr, (cp.nSegments+1)*sizeof(int));
+    for(int i=tape->nInputs; i<tape->tapeSize; i++)
+    {
+      if(!isLiveValue(tape, lastUse, i)) continue;
+      int first, last;
+      getLiveSegments(tape, lastUse, segmentSize, cp.nSegments, i, &first, &last);
+      for(int s=first; s<=last; s++) cp.live[fill[s]++] = i;
+    }
+    free(fill);
+    free(lastUse);
+
+    cp.entry         = (int*)malloc((cp.nSegments+1)*sizeof(int));
+    cp.snapshot      = (double*)calloc(totalLive+1, sizeof(double));
+    cp.inputValue    = (double*)calloc(tape->nInputs+1, sizeof(double));
+    cp.inputDeriv    = (double*)calloc((size_t)(tape->nInputs+1)*width, sizeof(double));
+    cp.segmentValue  = (double*)calloc(segmentSize, sizeof(double));
+    cp.segmentDeriv  = (double*)calloc((size_t)segmentSize*width, sizeof(double));
+    cp.liveDeriv     = (double*)calloc((size_t)(maxLive+1)*width, sizeof(double));
+    cp.nextLiveDeriv = (double*)calloc((size_t)(maxLive+1)*width, sizeof(double));
+
+    cp.stats.segmentSize = segmentSize;
+    cp.stats.nSegments = cp.nSegments;
+    cp.stats.snapshotValues = totalLive;
+    cp.stats.forwardInstructions = 0;
+    cp.stats.recomputedInstructions = 0;
+    cp.stats.memory = memory;
+    cp.stats.plainMemory = (double)tape->tapeSize*(1+width)*sizeof(double);
+    return cp;
+  }
+
+  void deleteCheckpoints(SAD_Checkpoints cp)
+  {
+    free(cp.livePtr);
+    free(cp.live);
+    free(cp.entry);
+    free(cp.snapshot);
+    free(cp.inputValue);
+    free(cp.inputDeriv);
+    free(cp.segmentValue);
+    free(cp.segmentDeriv);
+    free(cp.liveDeriv);
+    free(cp.nextLiveDeriv);
+  }
+
+  // Position of instruction i among the live values of segment s
+
+  int findLiveValue(const SAD_Checkpoints *cp, int s, int i)
+  {
+    int lo = cp->livePtr[s], hi = cp->livePtr[s+1]-1;
+    while(lo<hi)
+    {
+      int mid = (lo+hi)/2;
+      if(cp->live[mid]<i) lo = mid+1;
+      else hi = mid;
+    }
+    return lo - cp->livePtr[s];
+  }
+
+  // Value of instruction i seen from segment s
+
+  double getCheckpointValue(const SAD_Tape *tape, const SAD_Checkpoints *cp, int s, int i)
+  {
+    int beg = getSegmentBegin(tape, cp, s);
+    if(i<tape->nInputs) return cp->inputValue[i];
+    if(i>=beg) return cp->segmentValue[i-beg];
+    if(tape->operation[i]==CONST) return tape->value[i];
+    return cp->snapshot[cp->livePtr[s] + findLiveValue(cp, s, i)];
+  }
+
+  // Adjoints of instruction i seen from segment s (NULL for constants)
+
+  double *getCheckpointDeriv(const SAD_Tape *tape, SAD_Checkpoints *cp, int s, int i)
+  {
+    int beg = getSegmentBegin(tape, cp, s);
+    if(i<tape->nInputs) return cp->inputDeriv + (size_t)i*cp->width;
+    if(i>=beg) return cp->segmentDeriv + (size_t)(i-beg)*cp->width;
+    if(tape->operation[i]==CONST) return NULL;
+    return cp->liveDeriv + (size_t)findLiveValue(cp, s, i)*cp->width;
+  }
+
+  // Evaluates segment s from instruction i on (up to *effectiveTapeSize,
+  // which the true conditionals reduce), counting the evaluated instructions
+  // in *nEvaluated, and returns the instruction reached
+
+  int evaluateCheckpointSegment(const SAD_Tape *tape, SAD_Checkpoints *cp, int s, int i, int *effectiveTapeSize, long long *nEvaluated)
+  {
+    int beg = getSegmentBegin(tape, cp, s), end = getSegmentBegin(tape, cp, s+1);
+    memcpy(cp->segmentValue, tape->value+beg, (end-beg)*sizeof(double));
+    for(; i<end && i<*effectiveTapeSize; i++)
+    {
+      int op1 = tape->operand1[i];
+      int op2 = tape->operand2[i];
+      if(isConditionalStatement(tape, i))
+      {
+        if(compareValues(tape->operation[i], getCheckpointValue(tape, cp, s, op1), getCheckpointValue(tape, cp, s, op2)))
+        {
+          *effectiveTapeSize = tape->blockEnd[i];
+        }
+        else
+        {
+          i = tape->blockEnd[i];
+        }
+      }
+      else if(op1!=-1)
+      {
+        double x2 = (op2!=-1) ? getCheckpointValue(tape, cp, s, op2) : 0.0;
+        int op3 = getThirdOperand(tape, i);
+        double c = (op3!=-1) ? getCheckpointValue(tape, cp, s, op3) : 0.0;
+        cp->segmentValue[i-beg] = operationValue(tape->operation[i], getCheckpointValue(tape, cp, s, op1), x2, c);
+        (*nEvaluated)++;
+      }
+    }
+    return i;
+  }
+
+  // Forward sweep: evaluates the outputs at inputs[nInputs] into
+  // outputs[nOutputs], storing the snapshots
+
+  void evaluateCheckpointedOutputs(const SAD_Tape *tape, SAD_Checkpoints *cp, const double *inputs, double *outputs)
+  {
+    int i = tape->nInputs;
+    cp->effectiveTapeSize = tape->tapeSize;
+    memcpy(cp->inputValue, inputs, tape->nInputs*sizeof(double));
+
+    for(int s=0; s<cp->nSegments; s++)
+    {
+      int beg = getSegmentBegin(tape, cp, s);
+      cp->entry[s] = (i>beg) ? i : beg;
+      i = evaluateCheckpointSegment(tape, cp, s, cp->entry[s], &(cp->effectiveTapeSize), &(cp->stats.forwardInstructions));
+
+      // The snapshot of the next segment: the values live at its start were
+      // computed in this segment or were already live at the start of it
+      double *next = cp->snapshot + cp->livePtr[s+1];
+      for(int k=cp->livePtr[s+1], p=cp->livePtr[s]; k<cp->livePtr[s+2]; k++)
+      {
+        int id = cp->live[k];
+        if(id>=beg)
+        {
+          next[k-cp->livePtr[s+1]] = cp->segmentValue[id-beg];
+        }
+        else
+        {
+          while(cp->live[p]<id) p++;
+          next[k-cp->livePtr[s+1]] = cp->snapshot[p];
+        }
+      }
+    }
+
+    for(int iOutput=0; iOutput<tape->nOutputs; iOutput++)
+    {
+      outputs[iOutput] = getCheckpointValue(tape, cp, cp->nSegments, cp->effectiveTapeSize-tape->nOutputs+iOutput);
+    }
+  }
+
+  // Reverse sweeps: fills jacobian[nOutputs][nInputs] in chunks of
+  // cp->width outputs, recomputing every segment once per chunk
+  // (evaluateCheckpointedOutputs must have been called before)
+
+  void evaluateCheckpointedJacobian(const SAD_Tape *tape, SAD_Checkpoints *cp, double *jacobian)
+  {
+    int width = cp->width;
+    int nSegments = cp->nSegments;
+
+    for(int beg=0; beg<tape->nOutputs; beg+=width)
+    {
+      int n = (beg+width<=tape->nOutputs) ? width : tape->nOutputs-beg;
+      int firstOutputID = cp->effectiveTapeSize-tape->nOutputs;
+
+      memset(cp->inputDeriv, 0, (size_t)tape->nInputs*width*sizeof(double));
+      memset(cp->liveDeriv, 0, (size_t)(cp->livePtr[nSegments+1]-cp->livePtr[nSegments])*width*sizeof(double));
+      for(int k=0; k<n; k++)
+      {
+        double *deriv = getCheckpointDeriv(tape, cp, nSegments, firstOutputID+beg+k);
+        if(deriv!=NULL) deriv[k] += 1.0;
+      }
+
+      int pos = firstOutputID+beg+n-1;
+      for(int s=nSegments-1; s>=0; s--)
+      {
+        int segmentBeg = getSegmentBegin(tape, cp, s), segmentEnd = getSegmentBegin(tape, cp, s+1);
+        int nLive = cp->livePtr[s+1]-cp->livePtr[s];
+        int active = pos>=segmentBeg && cp->entry[s]<segmentEnd;
+        if(active)
+        {
+          int effectiveTapeSize = cp->effectiveTapeSize;
+          evaluateCheckpointSegment(tape, cp, s, cp->entry[s], &effectiveTapeSize, &(cp->stats.recomputedInstructions));
+          memset(cp->segmentDeriv, 0, (size_t)(segmentEnd-segmentBeg)*width*sizeof(double));
+        }
+
+        // Adjoints of the values live at the end of the segment go to the
+        // segment or to the values live at its start
+        memset(cp->nextLiveDeriv, 0, (size_t)nLive*width*sizeof(double));
+        for(int k=cp->livePtr[s+1], p=cp->livePtr[s]; k<cp->livePtr[s+2]; k++)
+        {
+          int id = cp->live[k];
+          const double *xb = cp->liveDeriv + (size_t)(k-cp->livePtr[s+1])*width;
+          double *yb;
+          if(id>=segmentBeg)
+          {
+            if(!active) continue;
+            yb = cp->segmentDeriv + (size_t)(id-segmentBeg)*width;
+          }
+          else
+          {
+            while(cp->live[p]<id) p++;
+            yb = cp->nextLiveDeriv + (size_t)(p-cp->livePtr[s])*width;
+          }
+          for(int w=0; w<width; w++) yb[w] += xb[w];
+        }
+        double *swap = cp->liveDeriv;
+        cp->liveDeriv = cp->nextLiveDeriv;
+        cp->nextLiveDeriv = swap;
+        if(!active) continue;
+
+        int i;
+        for(i=(pos<segmentEnd) ? pos : segmentEnd-1; i>=segmentBeg; i--)
+        {
+          if(tape->operation[i]==IFEND)
+          {
+            i = tape->blockEnd[i];
+            if(i<segmentBeg) break;
+          }
+          int op1 = tape->operand1[i];
+          int op2 = tape->operand2[i];
+          if(op1==-1) continue;
+
+          double d1, d2;
+          double x1 = getCheckpointValue(tape, cp, s, op1);
+          double x2 = (op2!=-1) ? getCheckpointValue(tape, cp, s, op2) : 0.0;
+          if(tape->operation[i]==SELECT)
+          {
+            d1 = (getCheckpointValue(tape, cp, s, tape->blockEnd[i])>0) ? 1.0 : 0.0;
+            d2 = 1.0 - d1;
+          }
+          else
+          {
+            calculatePartials(tape->operation[i], x1, x2, cp->segmentValue[i-segmentBeg], &d1, &d2);
+          }
+
+          const double *yb = cp->segmentDeriv + (size_t)(i-segmentBeg)*width;
+          double *x1b = getCheckpointDeriv(tape, cp, s, op1);
+          if(x1b!=NULL) for(int w=0; w<width; w++) x1b[w] += d1 * yb[w];
+          if(op2!=-1)
+          {
+            double *x2b = getCheckpointDeriv(tape, cp, s, op2);
+            if(x2b!=NULL) for(int w=0; w<width; w++) x2b[w] += d2 * yb[w];
+          }
+          if(getAddend(tape, i)!=-1)
+          {
+            double *x3b = getCheckpointDeriv(tape, cp, s, getAddend(tape, i));
+            if(x3b!=NULL) for(int w=0; w<width; w++) x3b[w] += yb[w];
+          }
+        }
+        pos = i;
+      }
+
+      for(int k=0; k<n; k++)
+      {
+        for(int iInput=0; iInput<tape->nInputs; iInput++)
+        {
+          jacobian[(beg+k)*(tape->nInputs)+iInput] = cp->inputDeriv[(size_t)iInput*width+k];
+        }
+      }
+    }
+  }
+
+  // Outputs and (unless jacobian is NULL) jacobian at inputs[nInputs] within
+  // memoryBudget bytes (see createCheckpoints), with the statistics of the
+  // evaluation written to stats (if not NULL)
+
+  void evaluateTapeCheckpointed(const SAD_Tape *tape, double memoryBudget, int chunkWidth, const double *inputs,
+                                double *outputs, double *jacobian, SAD_CheckpointStats *stats)
+  {
+    SAD_Checkpoints cp = createCheckpoints(tape, memoryBudget, (jacobian!=NULL) ? getChunkWidth(tape, chunkWidth) : 1);
+    evaluateCheckpointedOutputs(tape, &cp, inputs, outputs);
+    if(jacobian!=NULL) evaluateCheckpointedJacobian(tape, &cp, jacobian);
+    if(stats!=NULL) *stats = cp.stats;
+    deleteCheckpoints(cp);
   }
 
 #ifdef __cplusplus
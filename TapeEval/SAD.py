@@ -1,108 +1,650 @@
+import os
+import hashlib
+import tempfile
+import threading
+import subprocess
 import ctypes as C
 import numpy as np
+from pySAD.AD_Tape import operationsList, isBinaryTapeFile, readBinaryTape, jacobianColoring, hessianColoring
 
-def convertToCtypes(data):
-    int_t = (int, np.int32, np.int64)
-    float_t = (float, np.float32, np.float64)
-    array_t = (np.ndarray)
-    if isinstance(data, int_t):
-        return C.c_int(data)
-    if isinstance(data, float_t):
-        return C.c_double(data)
-    if isinstance(data, array_t):
-        if isinstance(data.ravel()[0], int_t):
-            return data.ctypes.data_as(C.POINTER(C.c_int))
-        if isinstance(data.ravel()[0], float_t):
-            return data.ctypes.data_as(C.POINTER(C.c_double))
+IP = C.POINTER(C.c_int)
+DP = C.POINTER(C.c_double)
+
+# ctypes types of the arguments of the library subroutines: scalars are passed
+# by value, arrays (which must be contiguous, as they are passed without a
+# copy) by pointer, according to their dtype
+
+arrayTypes = {np.dtype(np.float64): DP, np.dtype(np.intc): IP}
 
 def getCtypesType(data):
-    int_t = (int, np.int32, np.int64)
-    float_t = (float, np.float32, np.float64)
-    array_t = (np.ndarray)
-    if isinstance(data, int_t):
+    if isinstance(data, np.ndarray):
+        if data.dtype not in arrayTypes or not data.flags.c_contiguous:
+            raise ValueError("arrays must be contiguous float64 or int32 arrays, got %s" % data.dtype)
+        return arrayTypes[data.dtype]
+    if isinstance(data, (bool, int, np.integer)):
         return C.c_int
-    if isinstance(data, float_t):
+    if isinstance(data, (float, np.floating)):
         return C.c_double
-    if isinstance(data, array_t):
-        if isinstance(data.ravel()[0], int_t):
-            return C.POINTER(C.c_int)
-        if isinstance(data.ravel()[0], float_t):
-            return C.POINTER(C.c_double)
+    raise ValueError("unsupported argument type %s" % type(data).__name__)
+
+def convertToCtypes(data, dataType=None):
+    dataType = getCtypesType(data) if dataType is None else dataType
+    if isinstance(data, np.ndarray):
+        return data.ctypes.data_as(dataType)
+    return dataType(data)
+
+# The generic library built from SAD.c, used when no libName is given. It is
+# built into a user cache directory (the package may be read-only), under a
+# name given by a hash of the sources and of the build command, so that it is
+# rebuilt whenever SAD.c or SAD.h change. An explicit libName is rebuilt
+# whenever the sources are newer than it
+
+libraryDirectory = os.path.dirname(os.path.abspath(__file__))
+cacheDirectory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join("~", ".cache")), "pySAD")
+
+def buildLibrary(libName=None, compiler="cc", flags="-O3 -fPIC -shared", directory=None):
+    sources = [os.path.join(libraryDirectory, name) for name in ["SAD.c", "SAD.h"]]
+    if libName is None:
+        h = hashlib.sha256(("%s %s"%(compiler, flags)).encode())
+        for name in sources:
+            with open(name, "rb") as f:
+                h.update(f.read())
+        directory = os.path.expanduser(cacheDirectory if directory is None else directory)
+        os.makedirs(directory, exist_ok=True)
+        libName = os.path.join(directory, "libSAD-%s.so"%h.hexdigest()[:16])
+        if os.path.exists(libName):
+            return libName
+    elif os.path.exists(libName) and os.path.getmtime(libName)>=max(os.path.getmtime(name) for name in sources):
+        return libName
+
+    # Compiled under a temporary name (unique across processes and threads)
+    # and renamed, so that concurrent builds never load a partial library
+    handle, temporaryName = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(libName) + ".",
+                                             dir=os.path.dirname(os.path.abspath(libName)))
+    os.close(handle)
+    try:
+        subprocess.run([compiler] + flags.split() + [sources[0], "-o", temporaryName, "-lm", "-lpthread"], check=True)
+        os.replace(temporaryName, libName)
+    except BaseException:
+        if os.path.exists(temporaryName):
+            os.remove(temporaryName)
+        raise
+    return libName
+
+# Jacobian modes (jacobianModesEnum in SAD.h)
+jacobianModes = {"auto": 0, "reverse": 1, "forward": 2}
+
+# Errors of the C tape file readers (tapeFileErrorsEnum in SAD.h)
+tapeFileErrors = {1: "cannot be opened", 2: "is not a valid tape file (truncated or corrupt)",
+                  3: "has an unsupported format (byte order or version)"}
+
+class SAD_CheckpointStats(C.Structure):
+
+    _fields_ = \
+    [
+        ("segmentSize",            C.c_int),
+        ("nSegments",              C.c_int),
+        ("snapshotValues",         C.c_longlong),
+        ("forwardInstructions",    C.c_longlong),
+        ("recomputedInstructions", C.c_longlong),
+        ("memory",                 C.c_double),
+        ("plainMemory",            C.c_double)
+    ]
+
+# Profiling statistics of SAD_Stats (see evaluateProfiled)
 
-class SAD_Instruction(C.Structure):
+SAD_MAX_OPERATIONS = 64
+
+class SAD_Stats(C.Structure):
+
+    _fields_ = \
+    [
+        ("nForwardSweeps", C.c_longlong),
+        ("nReverseSweeps", C.c_longlong),
+        ("forwardTime",    C.c_double),
+        ("reverseTime",    C.c_double),
+        ("forwardCounts",  C.c_longlong*SAD_MAX_OPERATIONS),
+        ("reverseCounts",  C.c_longlong*SAD_MAX_OPERATIONS)
+    ]
+
+# State of the incremental evaluation (see evaluateIncremental)
+
+class SAD_Incremental(C.Structure):
 
     _fields_ = \
     [
-        ("blockEnd",     C.c_int),
-        ("operand1",     C.c_int),
-        ("operand2",     C.c_int),
-        ("operation",    C.c_int),
-        ("value",     C.c_double),
-        ("deriv",     C.c_double)
+        ("indptr",            IP),
+        ("indices",           IP),
+        ("value",             DP),
+        ("inputs",            DP),
+        ("onPath",            C.c_void_p),
+        ("outcome",           C.c_void_p),
+        ("dirty",             C.c_void_p),
+        ("pending",           IP),
+        ("effectiveTapeSize", C.c_int),
+        ("isValid",           C.c_int),
+        ("nEvaluated",        C.c_longlong),
+        ("nFullEvaluations",  C.c_longlong)
     ]
 
 class SAD_Tape(C.Structure):
 
     _fields_ = \
     [
-        ("effectiveTapeSize",               C.c_int),
-        ("tapeSize",                        C.c_int),
-        ("nInputs",                         C.c_int),
-        ("nOutputs",                        C.c_int),
-        ("jacobian",          C.POINTER(C.c_double)),
-        ("instructions", C.POINTER(SAD_Instruction))
+        ("effectiveTapeSize", C.c_int),
+        ("tapeSize",          C.c_int),
+        ("nInputs",           C.c_int),
+        ("nOutputs",          C.c_int),
+        ("jacobian",          DP),
+        ("blockEnd",          IP),
+        ("operand1",          IP),
+        ("operand2",          IP),
+        ("operation",         IP),
+        ("value",             DP),
+        ("deriv",             DP),
+        ("mapping",           C.c_void_p),
+        ("mappingSize",       C.c_size_t)
     ]
 
-    def __init__(self, filename=None, libName="./libSAD.so", subroutineName="evaluateTape"):
-        
+    def __init__(self, filename=None, libName=None, subroutineName="evaluateTape", tape=None, kernel=None):
+
+        # libName is a library including SAD.h (with the subroutine called by
+        # evaluate), the generic library built from SAD.c if None
+
         self.alloc = False
+        self.evaluateKernel = None
+        self.incremental = None
+        self.activeInputs = None
 
-        libSAD = C.CDLL(libName)
+        libSAD = C.CDLL(buildLibrary() if libName is None else libName)
 
         self.deleteTape = libSAD.__getattr__("deleteTape")
         self.deleteTape.restype = None
         self.deleteTape.argtypes = [SAD_Tape]
 
         self.readTapeFromFile = libSAD.__getattr__("readTapeFromFile")
-        self.readTapeFromFile.restype = None
+        self.readTapeFromFile.restype = C.c_int
         self.readTapeFromFile.argtypes = [C.POINTER(SAD_Tape), C.c_char_p]
         
-        self.evaluateTape = libSAD.__getattr__(subroutineName)
-        self.evaluateTape.restype = None
-        self.evaluateTape.argtypes = [SAD_Tape]
+        self.evaluateTapeBatch = libSAD.__getattr__("evaluateTapeBatch")
+        self.evaluateTapeBatch.restype = None
+        self.evaluateTapeBatch.argtypes = [C.POINTER(SAD_Tape), C.c_int, DP, DP, DP, C.c_int, C.c_int, C.c_int]
+
+        self.evaluateTapeSparseJacobian = libSAD.__getattr__("evaluateTapeSparseJacobian")
+        self.evaluateTapeSparseJacobian.restype = None
+        self.evaluateTapeSparseJacobian.argtypes = [C.POINTER(SAD_Tape), IP, IP, IP, C.c_int, C.c_int, DP]
+
+        self.evaluateTapeHessianVectors = libSAD.__getattr__("evaluateTapeHessianVectors")
+        self.evaluateTapeHessianVectors.restype = None
+        self.evaluateTapeHessianVectors.argtypes = [C.POINTER(SAD_Tape), DP, C.c_int, DP, DP, DP]
+
+        self.evaluateTapeHessian = libSAD.__getattr__("evaluateTapeHessian")
+        self.evaluateTapeHessian.restype = None
+        self.evaluateTapeHessian.argtypes = [C.POINTER(SAD_Tape), DP, DP, DP]
+
+        self.evaluateTapeSparseHessian = libSAD.__getattr__("evaluateTapeSparseHessian")
+        self.evaluateTapeSparseHessian.restype = None
+        self.evaluateTapeSparseHessian.argtypes = [C.POINTER(SAD_Tape), DP, IP, IP, IP, C.c_int, DP, DP]
+
+        self.evaluateTapeCheckpointed = libSAD.__getattr__("evaluateTapeCheckpointed")
+        self.evaluateTapeCheckpointed.restype = None
+        self.evaluateTapeCheckpointed.argtypes = [C.POINTER(SAD_Tape), C.c_double, C.c_int, DP, DP, DP, C.POINTER(SAD_CheckpointStats)]
+
+        self.evaluateOutputsProfiled = libSAD.__getattr__("evaluateOutputsProfiled")
+        self.evaluateOutputsProfiled.restype = None
+        self.evaluateOutputsProfiled.argtypes = [C.POINTER(SAD_Tape), C.POINTER(SAD_Stats)]
+
+        self.evaluateTapeOutputsAndJacobianProfiled = libSAD.__getattr__("evaluateTapeOutputsAndJacobianProfiled")
+        self.evaluateTapeOutputsAndJacobianProfiled.restype = None
+        self.evaluateTapeOutputsAndJacobianProfiled.argtypes = [C.POINTER(SAD_Tape), C.c_int, C.POINTER(SAD_Stats)]
+
+        self.stats = SAD_Stats()
+
+        self.getOutputConeMask = libSAD.__getattr__("getOutputConeMask")
+        self.getOutputConeMask.restype = None
+        self.getOutputConeMask.argtypes = [C.POINTER(SAD_Tape), C.c_int, IP, IP]
+
+        self.evaluateTapeOutputSubset = libSAD.__getattr__("evaluateTapeOutputSubset")
+        self.evaluateTapeOutputSubset.restype = None
+        self.evaluateTapeOutputSubset.argtypes = [C.POINTER(SAD_Tape), C.c_int, IP, IP, DP, DP]
+
+        self.getActiveMask = libSAD.__getattr__("getActiveMask")
+        self.getActiveMask.restype = None
+        self.getActiveMask.argtypes = [C.POINTER(SAD_Tape), C.c_int, IP, IP]
+
+        self.evaluateTapeActiveJacobian = libSAD.__getattr__("evaluateTapeActiveJacobian")
+        self.evaluateTapeActiveJacobian.restype = None
+        self.evaluateTapeActiveJacobian.argtypes = [C.POINTER(SAD_Tape), C.c_int, IP, IP, C.c_int, DP]
+
+        self.createIncremental = libSAD.__getattr__("createIncremental")
+        self.createIncremental.restype = SAD_Incremental
+        self.createIncremental.argtypes = [C.POINTER(SAD_Tape)]
+
+        self.deleteIncremental = libSAD.__getattr__("deleteIncremental")
+        self.deleteIncremental.restype = None
+        self.deleteIncremental.argtypes = [SAD_Incremental]
+
+        self.evaluateIncrementalOutputs = libSAD.__getattr__("evaluateIncremental")
+        self.evaluateIncrementalOutputs.restype = None
+        self.evaluateIncrementalOutputs.argtypes = [C.POINTER(SAD_Tape), C.POINTER(SAD_Incremental), DP, DP]
+
+        self.libSAD = libSAD
+        self.subroutineName = subroutineName
+        self.subroutines = {}
 
         if filename is not None: self.readFromFile(filename)
+        if tape is not None: self.setTape(tape)
+        if kernel is not None: self.loadKernel(kernel)
+
+    def setTape(self, tape):
+
+        # Point the C tape directly at the instruction buffers of an AD_Tape
+        # (no copy is made, so the AD_Tape must not grow afterwards). The
+        # values computed by the C evaluator are written into tape.instructions.value
+
+        self.bindArrays(tape.nInputs, tape.nOutputs, tape.instructions.getArrays())
+        self.activeInputs = tape.activeInputs
+
+    def bindArrays(self, nInputs, nOutputs, arrays):
+
+        self.resetIncremental()
+        if self.alloc:
+            self.deleteTape(self)
+            self.alloc = False
+
+        tapeSize = len(arrays["value"])
+        self.buffers = dict(arrays)
+        self.buffers["deriv"] = np.zeros(tapeSize)
+        self.buffers["jacobian"] = np.zeros(nOutputs*nInputs)
+        self.tapeSize = tapeSize
+        self.effectiveTapeSize = tapeSize
+        self.nInputs = nInputs
+        self.nOutputs = nOutputs
+        for name in ["blockEnd", "operand1", "operand2", "operation"]:
+            setattr(self, name, self.buffers[name].ctypes.data_as(IP))
+        for name in ["value", "deriv", "jacobian"]:
+            setattr(self, name, self.buffers[name].ctypes.data_as(DP))
+        self.mapping = None
+        self.mappingSize = 0
+
+    def getArrays(self):
+
+        # numpy views of the instruction arrays (also for tapes read by the C reader)
+        arrays = {}
+        for name in ["blockEnd", "operand1", "operand2", "operation", "value"]:
+            arrays[name] = np.ctypeslib.as_array(getattr(self, name), shape=(self.tapeSize,))
+        return arrays
+
+    def loadKernel(self, libName):
+
+        # Loads a kernel generated by AD_Tape.generateC, which is then used
+        # by evaluateBatch in place of the tape interpreter
+        kernel = C.CDLL(libName)
+        nInputs = C.c_int.in_dll(kernel, "SAD_kernelInputs").value
+        nOutputs = C.c_int.in_dll(kernel, "SAD_kernelOutputs").value
+        if self.tapeSize>0 and (nInputs!=self.nInputs or nOutputs!=self.nOutputs):
+            raise ValueError("the kernel %s has %d inputs and %d outputs, the tape %d and %d"
+                             %(libName, nInputs, nOutputs, self.nInputs, self.nOutputs))
+        self.nInputs = nInputs
+        self.nOutputs = nOutputs
+        self.kernel = kernel
+        self.evaluateKernel = kernel.SAD_evaluateKernel
+        self.evaluateKernel.restype = None
+        self.evaluateKernel.argtypes = [C.c_int, DP, DP, DP]
 
     def __del__(self):
+        self.resetIncremental()
         if self.alloc:
             self.deleteTape(self)
 
-    def readFromFile(self, filename):
-        self.readTapeFromFile(self, filename.encode())
-        self.alloc = True
+    def readFromFile(self, filename, useCReader=False):
+
+        # Binary tapes are memory-mapped (copy-on-write) from python and bound
+        # without a copy unless useCReader, text tapes are parsed by the C
+        # reader (all the inputs of a tape read from a file are active)
+        self.activeInputs = None
+        if not useCReader and isBinaryTapeFile(filename):
+            nInputs, nOutputs, arrays = readBinaryTape(filename)
+            self.bindArrays(nInputs, nOutputs, arrays)
+        else:
+            self.resetIncremental()
+            if self.alloc: self.deleteTape(self)
+            self.alloc = False
+            error = self.readTapeFromFile(self, filename.encode())
+            if error!=0:
+                if error==1:
+                    raise OSError("%s %s"%(filename, tapeFileErrors[error]))
+                raise ValueError("%s %s"%(filename, tapeFileErrors[error]))
+            self.alloc = True
+
+    def getSubroutine(self, name, argtypes):
+
+        # A separate function object per signature, so that calls with
+        # different argument types do not share (and overwrite) argtypes
+        key = (name, tuple(argtypes))
+        if key not in self.subroutines:
+            subroutine = self.libSAD[name]
+            subroutine.restype = None
+            subroutine.argtypes = [SAD_Tape] + list(argtypes)
+            self.subroutines[key] = subroutine
+        return self.subroutines[key]
+
+    def prepare(self, *args, nScalarOutputs=0, subroutineName=None):
+
+        # Binds the arguments of the subroutine once and returns an
+        # AD_EvalCall, whose calls run the subroutine without any conversion
+        # or allocation (see AD_EvalCall)
+        return SAD_Call(self, self.subroutineName if subroutineName is None else subroutineName, args, nScalarOutputs)
 
     def evaluate(self, *args, nScalarOutputs=None):
-        
-        if len(self.evaluateTape.argtypes)==1:
-            for arg in args:
-                self.evaluateTape.argtypes.append(getCtypesType(arg))
-            if nScalarOutputs is not None:
-                DP = C.POINTER(C.c_double)
-                self.evaluateTape.argtypes.extend([DP for i in range(nScalarOutputs)])
-        
-        functionArgs = [self]
-        for arg in args:
-            functionArgs.append(convertToCtypes(arg))
-        if nScalarOutputs is not None:
-            outputs = [np.array([0.0]) for i in range(nScalarOutputs)]
-            for i in range(nScalarOutputs):
-                functionArgs.append(convertToCtypes(outputs[i]))
 
-        #print(self.evaluateTape.argtypes)
-        #print(functionArgs)
-        
-        self.evaluateTape(*functionArgs)
-        
+        argtypes = [getCtypesType(arg) for arg in args] + [DP]*(nScalarOutputs or 0)
+        subroutine = self.getSubroutine(self.subroutineName, argtypes)
+        outputs = np.zeros(nScalarOutputs or 0)
+        functionArgs = [convertToCtypes(arg, argtype) for arg, argtype in zip(args, argtypes)]
+        functionArgs += [outputs[i:i+1].ctypes.data_as(DP) for i in range(len(outputs))]
+
+        subroutine(self, *functionArgs)
+
         if nScalarOutputs is not None:
-            rtn = [float(outputs[i][0]) for i in range(nScalarOutputs)]
-            return rtn
+            return outputs.tolist()
+
+    def evaluateBatch(self, inputs, jacobian=True, nThreads=0, chunkWidth=0, mode="auto"):
+
+        # inputs: (nPoints, nInputs) array. Returns the (nPoints, nOutputs)
+        # outputs and, if jacobian is True, the (nPoints, nOutputs, nActive)
+        # jacobians (see activeColumns). The points are evaluated by nThreads threads (all the
+        # processors if nThreads<=0) and the GIL is released during the call.
+        # The jacobians are computed in the "forward" or "reverse" mode, with
+        # sweeps over chunks of chunkWidth inputs or outputs ("auto" picks the
+        # mode needing the fewest sweeps). With a kernel loaded, the points
+        # are split between nThreads calls of the kernel instead
+
+        inputs = np.ascontiguousarray(np.atleast_2d(inputs), dtype=np.float64)
+        nPoints = inputs.shape[0]
+        outputs = np.empty((nPoints, self.nOutputs))
+        jac = np.empty((nPoints, self.nOutputs, self.nInputs)) if jacobian else None
+        if self.evaluateKernel is not None:
+            self.evaluateKernelBatch(inputs, outputs, jac, nThreads)
+        else:
+            self.evaluateTapeBatch(self, nPoints, inputs.ctypes.data_as(DP), outputs.ctypes.data_as(DP),
+                                   jac.ctypes.data_as(DP) if jacobian else None, nThreads, chunkWidth, jacobianModes[mode])
+        if jacobian:
+            return outputs, self.activeColumns(jac)
+        return outputs
+
+    def evaluateCheckpointed(self, inputs, memoryBudget=0, jacobian=True, chunkWidth=0):
+
+        # Evaluates the outputs and (reverse mode) jacobian at a single point
+        # keeping only snapshots of the values, within memoryBudget bytes if
+        # possible (see createCheckpoints in SAD.h). Returns the outputs, the
+        # jacobian (if jacobian is True) and a dict with the statistics
+
+        inputs = np.ascontiguousarray(inputs, dtype=np.float64)
+        outputs = np.empty(self.nOutputs)
+        jac = np.empty((self.nOutputs, self.nInputs)) if jacobian else None
+        stats = SAD_CheckpointStats()
+        self.evaluateTapeCheckpointed(self, memoryBudget, chunkWidth, inputs.ctypes.data_as(DP), outputs.ctypes.data_as(DP),
+                                      jac.ctypes.data_as(DP) if jacobian else None, C.byref(stats))
+        stats = {name: getattr(stats, name) for name, _ in SAD_CheckpointStats._fields_}
+        if jacobian:
+            return outputs, self.activeColumns(jac), stats
+        return outputs, stats
+
+    def outputConeMask(self, outputs):
+
+        # Mask of the instructions needed by the given outputs, which can be
+        # reused by evaluateSubset
+        outputs = np.ascontiguousarray(np.atleast_1d(outputs), dtype=np.int32)
+        mask = np.empty(self.tapeSize, dtype=np.int32)
+        self.getOutputConeMask(self, len(outputs), outputs.ctypes.data_as(IP), mask.ctypes.data_as(IP))
+        return mask
+
+    def evaluateSubset(self, inputs, outputs, jacobian=True, mask=None):
+
+        # Evaluates the values and (if jacobian is True) the jacobian rows of
+        # the given outputs (a list of output indices) at a single point,
+        # skipping the instructions outside of their cones (see
+        # evaluateTapeOutputSubset in SAD.h)
+
+        outputs = np.ascontiguousarray(np.atleast_1d(outputs), dtype=np.int32)
+        if mask is None:
+            mask = self.outputConeMask(outputs)
+        values = np.empty(len(outputs))
+        jac = np.empty((len(outputs), self.nInputs)) if jacobian else None
+        value = np.ctypeslib.as_array(self.value, shape=(self.tapeSize,))
+        value[:self.nInputs] = inputs
+        self.evaluateTapeOutputSubset(self, len(outputs), outputs.ctypes.data_as(IP), mask.ctypes.data_as(IP),
+                                      values.ctypes.data_as(DP), jac.ctypes.data_as(DP) if jacobian else None)
+        if jacobian:
+            return values, self.activeColumns(jac)
+        return values
+
+    def activeInputIDs(self, active=None):
+
+        # IDs of the active inputs: the given ones, or those of the AD_Tape
+        # set with setTape (all the inputs if no argument was passive)
+        if active is None:
+            active = self.activeInputs if self.activeInputs is not None else np.arange(self.nInputs)
+        active = np.asarray(active)
+        if active.dtype==bool:
+            active = np.flatnonzero(active)
+        return np.ascontiguousarray(active, dtype=np.int32)
+
+    def activeColumns(self, jac):
+
+        # The dense jacobians have a column per active input of the AD_Tape
+        # set with setTape, like those of AD_Tape (they are computed with
+        # respect to all the inputs and sliced)
+        if self.activeInputs is None:
+            return jac
+        return np.ascontiguousarray(jac[..., self.activeInputs])
+
+    def activeMask(self, active=None):
+
+        # Mask of the instructions depending on the active inputs, which can
+        # be reused by evaluateActiveJacobian
+        active = self.activeInputIDs(active)
+        mask = np.empty(self.tapeSize, dtype=np.int32)
+        self.getActiveMask(self, len(active), active.ctypes.data_as(IP), mask.ctypes.data_as(IP))
+        return mask
+
+    def evaluateActiveJacobian(self, inputs, active=None, mask=None, mode="auto"):
+
+        # Returns the outputs and the (nOutputs, nActive) jacobian with
+        # respect to the active inputs only (see evaluateTapeActiveJacobian in
+        # SAD.h); active holds their IDs or a mask of the inputs
+
+        active = self.activeInputIDs(active)
+        if mask is None:
+            mask = self.activeMask(active)
+        jac = np.empty((self.nOutputs, len(active)))
+        value = np.ctypeslib.as_array(self.value, shape=(self.tapeSize,))
+        value[:self.nInputs] = inputs
+        self.evaluateTapeActiveJacobian(self, len(active), active.ctypes.data_as(IP), mask.ctypes.data_as(IP),
+                                        jacobianModes[mode], jac.ctypes.data_as(DP))
+        outputs = value[self.effectiveTapeSize-self.nOutputs:self.effectiveTapeSize].copy()
+        return outputs, jac
+
+    def evaluateIncremental(self, inputs):
+
+        # Stateful evaluation of the outputs, re-evaluating only the
+        # instructions depending on the inputs changed since the last call
+        # (see evaluateIncremental in SAD.h). The state is created on the first
+        # call, and self.incremental.nEvaluated holds the number of
+        # instructions evaluated by the last call
+
+        if self.incremental is None:
+            self.incremental = self.createIncremental(self)
+        inputs = np.ascontiguousarray(inputs, dtype=np.float64)
+        outputs = np.empty(self.nOutputs)
+        self.evaluateIncrementalOutputs(self, C.byref(self.incremental), inputs.ctypes.data_as(DP), outputs.ctypes.data_as(DP))
+        return outputs
+
+    def resetIncremental(self):
+        if getattr(self, "incremental", None) is not None:
+            self.deleteIncremental(self.incremental)
+            self.incremental = None
+
+    def evaluateProfiled(self, inputs, jacobian=True, chunkWidth=0):
+
+        # Evaluates the outputs and (reverse mode, in chunks of chunkWidth
+        # outputs) the jacobian at a single point, adding the time and the
+        # instructions of every sweep to the statistics (see getStats)
+
+        value = np.ctypeslib.as_array(self.value, shape=(self.tapeSize,))
+        value[:self.nInputs] = inputs
+        if not jacobian:
+            self.evaluateOutputsProfiled(self, C.byref(self.stats))
+            return self.getOutputs(value)
+        self.evaluateTapeOutputsAndJacobianProfiled(self, chunkWidth, C.byref(self.stats))
+        jac = np.ctypeslib.as_array(self.jacobian, shape=(self.nOutputs, self.nInputs))
+        return self.getOutputs(value), self.activeColumns(jac).copy()
+
+    def getStats(self):
+
+        # Statistics accumulated by evaluateProfiled: for the forward and the
+        # reverse sweeps, their number, total time in seconds and the number
+        # of instructions of each operation they went through
+        names = {code: name for name, code in operationsList.items()}
+        stats = {}
+        for sweep in ["forward", "reverse"]:
+            counts = getattr(self.stats, sweep+"Counts")
+            stats[sweep] = {"sweeps": getattr(self.stats, "n"+sweep.capitalize()+"Sweeps"),
+                            "time": getattr(self.stats, sweep+"Time"),
+                            "instructions": {names[code]: counts[code] for code in names if counts[code]>0}}
+        return stats
+
+    def resetStats(self):
+        self.stats = SAD_Stats()
+
+    def jacobianColoring(self):
+        return jacobianColoring(self.nInputs, self.nOutputs, self.getArrays())
+
+    def evaluateSparseJacobian(self, inputs, coloring=None, mode="auto"):
+
+        # Returns the outputs and the jacobian in CSR format (data, indices,
+        # indptr), see AD_Tape.evaluateSparseJacobian
+
+        if coloring is None:
+            coloring = self.jacobianColoring()
+        if mode=="auto":
+            mode = "forward" if coloring["nColumnColors"]<=coloring["nRowColors"] else "reverse"
+        colors, nColors = (coloring["columnColors"], coloring["nColumnColors"]) if mode=="forward" else \
+                          (coloring["rowColors"], coloring["nRowColors"])
+
+        indptr = np.ascontiguousarray(coloring["indptr"], dtype=np.int32)
+        indices = np.ascontiguousarray(coloring["indices"], dtype=np.int32)
+        colors = np.ascontiguousarray(colors, dtype=np.int32)
+        data = np.empty(len(indices))
+        value = np.ctypeslib.as_array(self.value, shape=(self.tapeSize,))
+        value[:self.nInputs] = inputs
+        self.evaluateTapeSparseJacobian(self, indptr.ctypes.data_as(IP), indices.ctypes.data_as(IP), colors.ctypes.data_as(IP),
+                                        nColors, jacobianModes[mode], data.ctypes.data_as(DP))
+        outputs = value[self.effectiveTapeSize-self.nOutputs:self.effectiveTapeSize].copy()
+        return outputs, (data, indices, indptr)
+
+    def setInputsAndWeights(self, inputs, weights):
+
+        # Sets the inputs and returns the values and a pointer to the weights
+        # of the outputs (NULL for all ones; the pointer keeps the array alive)
+        value = np.ctypeslib.as_array(self.value, shape=(self.tapeSize,))
+        value[:self.nInputs] = inputs
+        if weights is None:
+            return value, None
+        return value, np.ascontiguousarray(weights, dtype=np.float64).ctypes.data_as(DP)
+
+    def getOutputs(self, value):
+        return value[self.effectiveTapeSize-self.nOutputs:self.effectiveTapeSize].copy()
+
+    def evaluateHessianVector(self, inputs, vectors, weights=None):
+
+        # Returns the outputs, the gradient and the products of the Hessian
+        # with vectors (nInputs, nVectors) of the sum of the outputs weighted
+        # by weights (all ones by default), see AD_Tape.evaluateHessianVector
+
+        vectors = np.asarray(vectors, dtype=np.float64)
+        vectors2D = np.ascontiguousarray(vectors.reshape(self.nInputs, -1))
+        gradient = np.empty(self.nInputs)
+        hessianVectors = np.empty_like(vectors2D)
+        value, weights = self.setInputsAndWeights(inputs, weights)
+        self.evaluateTapeHessianVectors(self, weights, vectors2D.shape[1], vectors2D.ctypes.data_as(DP),
+                                        gradient.ctypes.data_as(DP), hessianVectors.ctypes.data_as(DP))
+        return self.getOutputs(value), gradient, hessianVectors.reshape(vectors.shape)
+
+    def evaluateHessian(self, inputs, weights=None):
+
+        gradient = np.empty(self.nInputs)
+        hessian = np.empty((self.nInputs, self.nInputs))
+        value, weights = self.setInputsAndWeights(inputs, weights)
+        self.evaluateTapeHessian(self, weights, gradient.ctypes.data_as(DP), hessian.ctypes.data_as(DP))
+        return self.getOutputs(value), gradient, hessian
+
+    def hessianColoring(self):
+        return hessianColoring(self.nInputs, self.nOutputs, self.getArrays())
+
+    def evaluateSparseHessian(self, inputs, weights=None, coloring=None):
+
+        # Returns the outputs, the gradient and the Hessian in CSR format
+        # (data, indices, indptr), see AD_Tape.evaluateSparseHessian
+
+        if coloring is None:
+            coloring = self.hessianColoring()
+        indptr = np.ascontiguousarray(coloring["indptr"], dtype=np.int32)
+        indices = np.ascontiguousarray(coloring["indices"], dtype=np.int32)
+        colors = np.ascontiguousarray(coloring["colors"], dtype=np.int32)
+        gradient = np.empty(self.nInputs)
+        data = np.empty(len(indices))
+        value, weights = self.setInputsAndWeights(inputs, weights)
+        self.evaluateTapeSparseHessian(self, weights, indptr.ctypes.data_as(IP), indices.ctypes.data_as(IP), colors.ctypes.data_as(IP),
+                                       coloring["nColors"], gradient.ctypes.data_as(DP), data.ctypes.data_as(DP))
+        return self.getOutputs(value), gradient, (data, indices, indptr)
+
+    def evaluateKernelBatch(self, inputs, outputs, jacobian, nThreads):
+
+        # The GIL is released by ctypes, so the threads run concurrently
+        nPoints = inputs.shape[0]
+        nThreads = os.cpu_count() if nThreads<=0 else nThreads
+        nThreads = max(1, min(nThreads, nPoints))
+        bounds = [(nPoints*t)//nThreads for t in range(nThreads+1)]
+        def task(beg, end):
+            self.evaluateKernel(end-beg, inputs[beg:end].ctypes.data_as(DP), outputs[beg:end].ctypes.data_as(DP),
+                                jacobian[beg:end].ctypes.data_as(DP) if jacobian is not None else None)
+        threads = [threading.Thread(target=task, args=(bounds[t], bounds[t+1])) for t in range(1, nThreads)]
+        for thread in threads: thread.start()
+        task(bounds[0], bounds[1])
+        for thread in threads: thread.join()
+
+#------------------------------------------------------------------------------
+# Class SAD_Call: a subroutine call with the arguments bound once. The arrays
+# are passed by pointer, so the inputs are changed by writing into them in
+# place and the array outputs are read from them after every call. The scalar
+# arguments are held in ctypes objects, updated by the positional arguments
+# of the call (if given), and the scalar outputs are written into the
+# outputs array, which is returned by every call
+#------------------------------------------------------------------------------
+
+class SAD_Call:
+
+    def __init__(self, tape, subroutineName, args, nScalarOutputs=0):
+
+        argtypes = [getCtypesType(arg) for arg in args] + [DP]*nScalarOutputs
+        self.subroutine = tape.getSubroutine(subroutineName, argtypes)
+        self.tape = tape
+        self.arrays = [arg for arg in args if isinstance(arg, np.ndarray)]
+        self.outputs = np.zeros(nScalarOutputs)
+
+        self.scalars = []
+        self.args = [tape]
+        for arg, argtype in zip(args, argtypes):
+            self.args.append(convertToCtypes(arg, argtype))
+            if not isinstance(arg, np.ndarray):
+                self.scalars.append(self.args[-1])
+        self.args += [self.outputs[i:i+1].ctypes.data_as(DP) for i in range(nScalarOutputs)]
+        self.args = tuple(self.args)
+
+    def __call__(self, *scalars):
+        for scalar, value in zip(self.scalars, scalars):
+            scalar.value = value
+        self.subroutine(*self.args)
+        return self.outputs
@@ -1 +1,3 @@
 from pySAD.TapeEval.SAD import SAD_Tape as AD_EvalTape
+from pySAD.TapeEval.SAD import SAD_Call as AD_EvalCall
+from pySAD.TapeEval.SAD import buildLibrary
@@ -0,0 +1,59 @@
+import os
+import sys
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+from simpleFunction import simpleFunction
+
+'''
+AD_Tape.evaluateBatch compared with AD_Tape.evaluate point by point, on
+batches whose points take different branches of the conditionals: the
+nested conditionals of simpleFunction, and a function with a conditional
+around SELECT instructions, before and after optimize (which fuses some of
+its instructions into FMA). The inputs are away from the singularities of
+the functions, and the batches are evaluated with the floating point errors
+raised
+'''
+
+def branches(x=[4], y=[], **kwargs):
+
+    a = sad.where(x>0.0, x*y + 1.0, sad.exp(x))
+    if y>0.5:
+        if x[0]>0.0:
+            b = sad.sqrt(x*x + y)
+        else:
+            b = x*y
+    else:
+        b = a/(1.0 + sad.exp(-x))
+    return [a*b, sad.dot(a, b)]
+
+def checkBatch(name, tape, points, chunkSize=65536):
+
+    with np.errstate(all="raise"):
+        outputs = tape.evaluateBatch(points, chunkSize=chunkSize)
+    reference = np.array([tape.evaluate(point) for point in points])
+    error = np.abs(outputs - reference).max()
+    print("%-24s %4d points, max. error %.2e"%(name, len(points), error))
+    assert np.allclose(outputs, reference, rtol=1e-15, atol=1e-15), "%s: batch differs from evaluate"%name
+
+rng = np.random.default_rng(0)
+
+# simpleFunction: x>1, or x<=1 and z>0, or x<=1 and z<=0
+
+tape = sad.AD_Tape()
+tape.compile(simpleFunction, kwargs={})
+points = rng.uniform(-2.0, 2.0, size=(1000, 3))
+points[:, 2] = np.sign(points[:, 2])*(0.5 + np.abs(points[:, 2]))   # away from z=0
+checkBatch("simpleFunction", tape, points)
+checkBatch("simpleFunction (chunks)", tape, points, chunkSize=64)
+
+tape = sad.AD_Tape()
+tape.compile(branches, kwargs={})
+points = rng.uniform(-1.0, 1.5, size=(1000, 5))
+checkBatch("branches", tape, points)
+tape.optimize()
+checkBatch("branches (optimized)", tape, points)
+
+print("Batch evaluation OK")
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import ctypes as C
+import numpy as np
+import pySAD as sad
+
+'''
+Benchmarks of tape recording, serialization and evaluation on parameterized
+workloads. For every workload the time of AD_Tape.compile, AD_Tape.write, the
+C text reader (readTapeFromFile), AD_Tape.evaluate and the C
+evaluateTapeOutputsAndJacobian, and the peak memory of the compilation are
+written to a JSON file, which can be compared with the results of another
+commit:
+
+python benchmarks.py --output new.json --compare old.json
+'''
+
+#------------------------------------------------------------------------------
+# Workloads: functions to compile, with their parameters
+#------------------------------------------------------------------------------
+
+def calcLayerNN(prev, weights, biases):
+
+    curr = sad.matmul(weights, prev) + biases
+    curr = curr / (1.0 + sad.exp(-curr))
+    return curr
+
+def makeNN(nNodes):
+
+    # calcNN of tests/NeuralNetwork for the given number of nodes per layer
+
+    nNodes = np.array(nNodes)
+
+    def calcNN(inputs=[nNodes[0]], theta=[sum(nNodes[1:]+sum(nNodes[:-1]*nNodes[1:]))], **kwargs):
+        beg = 0
+        nodes = inputs
+        for i in range(len(nNodes)-1):
+            biases = theta[beg:beg+nNodes[i+1]]
+            beg += nNodes[i+1]
+            weights = theta[beg:beg+nNodes[i+1]*nNodes[i]]
+            weights.resize((nNodes[i+1], nNodes[i]))
+            beg += nNodes[i+1]*nNodes[i]
+            nodes = calcLayerNN(nodes, weights, biases)
+        return nodes
+
+    return calcNN
+
+def makeConditionals(depth):
+
+    # Conditionals nested depth levels deep, each branch doing some work
+
+    def conditionals(x=[], y=[], **kwargs):
+        a = x*y
+        for level in range(depth):
+            if a>0.0:
+                a = sad.sin(a)*y + x
+            else:
+                a = sad.exp(a)*x - y
+        return [a]
+
+    return conditionals
+
+def makeChain(length, size):
+
+    # A long chain of elementwise operations on arrays
+
+    def chain(x=[size], y=[size], **kwargs):
+        a = x
+        for k in range(length):
+            a = sad.tanh(a*y + 0.5) - x/(1.0 + a*a)
+        return [a]
+
+    return chain
+
+def getWorkloads(quick):
+
+    workloads = []
+    widths = [8, 32] if quick else [8, 32, 128]
+    depths = [2, 4] if quick else [2, 4, 8]
+    for width in widths:
+        for depth in depths:
+            workloads.append(("mlp", {"width": width, "depth": depth}, makeNN([4] + [width]*depth + [1])))
+    for depth in ([2, 4] if quick else [2, 4, 6, 8]):
+        workloads.append(("conditionals", {"depth": depth}, makeConditionals(depth)))
+    for length in ([10, 100] if quick else [10, 100, 1000]):
+        workloads.append(("chain", {"length": length, "size": 16}, makeChain(length, 16)))
+    return workloads
+
+#------------------------------------------------------------------------------
+# Timing
+#------------------------------------------------------------------------------
+
+def timeCall(function, repeat):
+
+    # Best time of repeat calls
+    best = float("inf")
+    for k in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter()-start)
+    return best
+
+def benchmark(name, params, function, repeat, directory):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tape = sad.AD_Tape()
+    tape.compile(function)
+    compileTime = time.perf_counter() - start
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    filename = os.path.join(directory, "%s.txt" % name)
+    writeTime = timeCall(lambda: tape.write(filename), repeat)
+    readTime = timeCall(lambda: sad.AD_EvalTape(filename=filename), repeat)
+
+    inputs = np.random.default_rng(0).normal(size=tape.nInputs)
+    evaluateTime = timeCall(lambda: tape.evaluate(inputs), repeat)
+
+    # C evaluation of the outputs and the jacobian at a single point
+    evalTape = sad.AD_EvalTape(filename=filename)
+    evaluateOutputsAndJacobian = evalTape.libSAD["evaluateTapeOutputsAndJacobian"]
+    evaluateOutputsAndJacobian.restype = None
+    evaluateOutputsAndJacobian.argtypes = [C.POINTER(type(evalTape))]
+    np.ctypeslib.as_array(evalTape.value, shape=(evalTape.tapeSize,))[:tape.nInputs] = inputs
+    jacobianTime = timeCall(lambda: evaluateOutputsAndJacobian(evalTape), repeat)
+    os.remove(filename)
+
+    return {"workload": name, "params": params, "instructions": len(tape.instructions),
+            "nInputs": tape.nInputs, "nOutputs": tape.nOutputs, "nTraces": tape.nTraces,
+            "compile": compileTime, "write": writeTime, "read": readTime, "evaluate": evaluateTime,
+            "evaluateOutputsAndJacobian": jacobianTime, "peakMemory": peakMemory}
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def getKey(result):
+    return result["workload"] + "".join("_%s%s" % (key, value) for key, value in sorted(result["params"].items()))
+
+def compare(results, filename):
+
+    # Ratios new/old of the timings and of the peak memory
+    with open(filename) as fp:
+        old = {getKey(result): result for result in json.load(fp)["results"]}
+    fields = ["compile", "write", "read", "evaluate", "evaluateOutputsAndJacobian", "peakMemory"]
+    print("\n%-28s" % "new/old" + "".join("%12s" % field[:11] for field in fields))
+    for result in results:
+        key = getKey(result)
+        if key in old:
+            print("%-28s" % key + "".join("%12.2f" % (result[field]/max(old[key][field], 1e-12)) for field in fields))
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="pySAD benchmarks")
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="JSON file of earlier results to compare with")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of every timing (the best is kept)")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads")
+    args = parser.parse_args()
+
+    directory = os.path.dirname(os.path.abspath(args.output))
+    results = []
+    print("%-28s %12s %10s %10s %10s %10s %10s %12s" % ("workload", "instructions", "compile", "write", "read",
+                                                      "evaluate", "C jacobian", "peak memory"))
+    for name, params, function in getWorkloads(args.quick):
+        result = benchmark(name, params, function, args.repeat, directory)
+        results.append(result)
+        print("%-28s %12d %10.4f %10.4f %10.4f %10.4f %10.6f %12d" % (getKey(result), result["instructions"],
+              result["compile"], result["write"], result["read"], result["evaluate"],
+              result["evaluateOutputsAndJacobian"], result["peakMemory"]))
+
+    with open(args.output, "w") as fp:
+        json.dump({"commit": getCommit(), "python": platform.python_version(), "numpy": np.__version__,
+                   "platform": platform.platform(), "results": results}, fp, indent=2)
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,81 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+from simpleFunction import simpleFunction
+
+'''
+Round trip of a tape through the binary format (AD_Tape.writeBinary) and the
+readers: AD_Tape.readBinary, AD_EvalTape with the python (memory-mapped) and
+the C reader, compared with the original tape and with a text tape. Truncated
+files, files with a bad magic number and files of another version must be
+rejected with an error by both readers
+'''
+
+def checkTape(name, evaluate, points, reference):
+
+    outputs = np.array([evaluate(point) for point in points])
+    error = np.abs(outputs - reference).max()
+    print("%-28s max. error %.2e"%(name, error))
+    assert np.allclose(outputs, reference, rtol=1e-14, atol=1e-14), "%s: outputs differ from the original tape"%name
+
+def checkRejected(name, filename, exception):
+
+    for reader, read in [("python", lambda: sad.AD_EvalTape(filename=filename)),
+                         ("C", lambda: sad.AD_EvalTape().readFromFile(filename, useCReader=True))]:
+        try:
+            read()
+        except exception as error:
+            print("%-28s rejected by the %s reader: %s"%(name, reader, error))
+        else:
+            raise AssertionError("%s: accepted by the %s reader"%(name, reader))
+
+tape = sad.AD_Tape()
+tape.compile(simpleFunction, kwargs={})
+rng = np.random.default_rng(0)
+points = rng.uniform(-2.0, 2.0, size=(100, 3))
+points[:, 2] = np.sign(points[:, 2])*(0.5 + np.abs(points[:, 2]))   # away from z=0
+reference = np.array([tape.evaluate(point) for point in points])
+
+directory = tempfile.mkdtemp()
+try:
+    filename = os.path.join(directory, "tape.bin")
+    tape.writeBinary(filename)
+
+    readTape = sad.AD_Tape()
+    readTape.readBinary(filename)
+    checkTape("AD_Tape.readBinary", readTape.evaluate, points, reference)
+
+    for name, useCReader in [("AD_EvalTape (python reader)", False), ("AD_EvalTape (C reader)", True)]:
+        evalTape = sad.AD_EvalTape()
+        evalTape.readFromFile(filename, useCReader=useCReader)
+        assert (evalTape.nInputs, evalTape.nOutputs) == (tape.nInputs, tape.nOutputs)
+        checkTape(name, lambda point: evalTape.evaluateBatch(point, jacobian=False)[0], points, reference)
+
+    textFilename = os.path.join(directory, "tape.txt")
+    tape.write(textFilename)
+    evalTape = sad.AD_EvalTape(filename=textFilename)
+    checkTape("AD_EvalTape (text)", lambda point: evalTape.evaluateBatch(point, jacobian=False)[0], points, reference)
+
+    # Corrupt copies of the binary tape
+    data = open(filename, "rb").read()
+    corrupt = os.path.join(directory, "corrupt.bin")
+    open(corrupt, "wb").write(data[:len(data)-8])
+    checkRejected("truncated", corrupt, ValueError)
+    open(corrupt, "wb").write(data[:40])
+    checkRejected("truncated header", corrupt, ValueError)
+    open(corrupt, "wb").write(b"SADTAPF\0" + data[8:])
+    checkRejected("bad magic", corrupt, ValueError)
+    version = np.frombuffer(data, dtype=np.int32, count=1, offset=12)[0]
+    open(corrupt, "wb").write(data[:12] + np.int32(version + 1).tobytes() + data[16:])
+    checkRejected("wrong version", corrupt, ValueError)
+    checkRejected("missing file", os.path.join(directory, "missing.bin"), OSError)
+finally:
+    shutil.rmtree(directory)
+
+print("Binary tapes OK")
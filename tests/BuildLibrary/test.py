@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import threading
+import ctypes as C
+import pySAD as sad
+
+'''
+Builds of the generic library (sad.buildLibrary) into a cache directory by
+concurrent threads: they all get the same library, which loads, nothing is
+left behind but the library, and nothing is written into the package
+'''
+
+packageDirectory = os.path.join(sad.__path__[0], "TapeEval")
+packageFiles = sorted(os.listdir(packageDirectory))
+
+directory = tempfile.mkdtemp()
+try:
+    names, errors = [], []
+    def task():
+        try:
+            names.append(sad.buildLibrary(directory=os.path.join(directory, "cache")))
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=task) for k in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert errors==[], errors
+    assert len(set(names))==1 and os.path.dirname(names[0])==os.path.join(directory, "cache")
+    assert os.listdir(os.path.join(directory, "cache"))==[os.path.basename(names[0])]
+    C.CDLL(names[0]).evaluateTapeBatch
+    print("built", names[0])
+
+    # Built again only if missing, also under an explicit name
+    mtime = os.path.getmtime(names[0])
+    assert sad.buildLibrary(directory=os.path.join(directory, "cache"))==names[0] and os.path.getmtime(names[0])==mtime
+    libName = os.path.join(directory, "libExplicit.so")
+    assert sad.buildLibrary(libName)==libName and os.path.exists(libName)
+    assert sorted(os.listdir(directory))==["cache", "libExplicit.so"]
+finally:
+    shutil.rmtree(directory)
+
+assert sorted(os.listdir(packageDirectory))==packageFiles
+print("Library builds OK")
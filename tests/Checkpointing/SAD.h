@@ -0,0 +1 @@
+../../TapeEval/SAD.h
\ No newline at end of file
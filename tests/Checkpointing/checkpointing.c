@@ -0,0 +1,64 @@
+#include "SAD.h"
+#include <stdio.h>
+#include <time.h>
+
+// Memory vs recomputation trade-off of the checkpointed reverse sweep
+// (create the tape with heatEquation.py first):
+//   gcc -O3 checkpointing.c -o checkpointing -lm -lpthread
+//   ./checkpointing heatEquation.sad
+
+double seconds()
+{
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + 1e-9*t.tv_nsec;
+}
+
+int main(int argc, char **argv)
+{
+  SAD_Tape tape;
+  readTapeFromFile(&tape, (argc>1) ? argv[1] : "heatEquation.sad");
+  int nInputs = tape.nInputs, nOutputs = tape.nOutputs;
+
+  double *inputs    = (double*)malloc(nInputs*sizeof(double));
+  double *outputs   = (double*)malloc(nOutputs*sizeof(double));
+  double *jacobian  = (double*)malloc((size_t)nOutputs*nInputs*sizeof(double));
+  double *reference = (double*)malloc((size_t)nOutputs*nInputs*sizeof(double));
+  for(int i=0; i<nInputs; i++) inputs[i] = 0.5 + 0.4*sin(0.3*i);
+
+  // Plain evaluation: values and adjoints of the whole tape
+
+  double t0 = seconds();
+  SAD_Workspace work = createWorkspace(&tape, SAD_DEFAULT_CHUNK_WIDTH);
+  memcpy(work.value, inputs, nInputs*sizeof(double));
+  evaluateWorkspaceOutputs(&tape, &work);
+  evaluateWorkspaceJacobian(&tape, &work, reference, SAD_DEFAULT_CHUNK_WIDTH);
+  deleteWorkspace(work);
+  double plainTime = seconds() - t0;
+
+  printf("%d instructions, %d inputs, %d outputs\n\n", tape.tapeSize, nInputs, nOutputs);
+  printf("%12s %10s %10s %12s %12s %10s %10s\n", "budget [kB]", "segment", "segments", "memory [kB]", "recomputed", "time [s]", "error");
+
+  double budgets[] = {0.0, 64e3, 256e3, 1e6, 4e6, 1e12};
+  for(int b=0; b<6; b++)
+  {
+    SAD_CheckpointStats stats;
+    t0 = seconds();
+    evaluateTapeCheckpointed(&tape, budgets[b], SAD_DEFAULT_CHUNK_WIDTH, inputs, outputs, jacobian, &stats);
+    double time = seconds() - t0;
+
+    double error = 0.0;
+    for(size_t k=0; k<(size_t)nOutputs*nInputs; k++) error = fmax(error, fabs(jacobian[k]-reference[k]));
+    printf("%12.0f %10d %10d %12.1f %12.2f %10.4f %10.1e\n", budgets[b]/1e3, stats.segmentSize, stats.nSegments,
+           stats.memory/1e3, (double)stats.recomputedInstructions/stats.forwardInstructions, time, error);
+  }
+  printf("%12s %10s %10s %12.1f %12s %10.4f\n", "plain", "", "", (double)tape.tapeSize*(1+SAD_DEFAULT_CHUNK_WIDTH)*sizeof(double)/1e3,
+         "", plainTime);
+
+  free(inputs);
+  free(outputs);
+  free(jacobian);
+  free(reference);
+  deleteTape(tape);
+  return 0;
+}
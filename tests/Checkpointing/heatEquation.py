@@ -0,0 +1,32 @@
+import pySAD as sad
+import numpy as np
+
+'''
+Explicit time stepping of a 1-D nonlinear heat equation, recorded as a
+single tape (nSteps steps on nPoints points). The tape grows linearly with
+nSteps, while only the nPoints values of the current step are live between
+the steps, which is the case checkpointing is made for
+'''
+
+nPoints = 50
+nSteps = 1000
+
+'''
+u: initial temperatures
+k: diffusivity
+'''
+
+def heatEquation(u=[nPoints], k=[], **kwargs):
+
+    for step in range(nSteps):
+
+        v = u*1.0
+        v[1:-1] = u[1:-1] + 0.1*k*(u[2:] - 2.0*u[1:-1] + u[:-2]) - 0.001*sad.sin(u[1:-1])
+        u = v
+
+    return [u, sad.dot(u, u)]
+
+tape = sad.AD_Tape()
+tape.compile(heatEquation, kwargs={})
+tape.writeBinary("heatEquation.sad")
+print("%d instructions" % len(tape.instructions))
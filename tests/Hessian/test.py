@@ -0,0 +1,75 @@
+import os
+import sys
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+sys.path.append(os.path.join(testsDirectory, "NeuralNetwork"))
+from simpleFunction import simpleFunction
+from NeuralNetwork import calcNN
+
+'''
+Hessians of the weighted sum of the outputs (AD_Tape.evaluateHessian,
+AD_Tape.evaluateSparseHessian and the C evaluateTapeHessian and
+evaluateTapeSparseHessian) compared with central finite differences of the
+gradient, on simpleFunction (on both sides of its conditionals) and on
+the neural network of tests/NeuralNetwork
+'''
+
+def finiteDifferenceHessian(tape, inputs, weights, h=1e-5):
+
+    # Central differences of the gradient of the weighted sum of the outputs
+    hessian = np.zeros((tape.nInputs, tape.nInputs))
+    for j in range(tape.nInputs):
+        xp = np.array(inputs, dtype=np.float64)
+        xm = np.array(inputs, dtype=np.float64)
+        xp[j] += h
+        xm[j] -= h
+        gp = weights @ tape.evaluateJacobian(xp)[1]
+        gm = weights @ tape.evaluateJacobian(xm)[1]
+        hessian[:, j] = (gp - gm)/(2.0*h)
+    return hessian
+
+def toDense(csr, n):
+
+    data, indices, indptr = csr
+    dense = np.zeros((n, n))
+    for i in range(n):
+        dense[i, indices[indptr[i]:indptr[i+1]]] = data[indptr[i]:indptr[i+1]]
+    return dense
+
+def checkHessians(name, tape, inputs, weights):
+
+    evalTape = sad.AD_EvalTape(tape=tape)
+    reference = finiteDifferenceHessian(tape, inputs, weights)
+    scale = max(1.0, np.abs(reference).max())
+
+    outputs, gradient, hessian = tape.evaluateHessian(inputs, weights)
+    hessians = {"python dense":  hessian,
+                "python sparse": toDense(tape.evaluateSparseHessian(inputs, weights)[2], tape.nInputs),
+                "C dense":       evalTape.evaluateHessian(inputs, weights)[2],
+                "C sparse":      toDense(evalTape.evaluateSparseHessian(inputs, weights)[2], tape.nInputs)}
+
+    assert np.allclose(gradient, weights @ tape.evaluateJacobian(inputs)[1], rtol=1e-12, atol=1e-12)
+    for method, hessian in hessians.items():
+        error = np.abs(hessian - reference).max()/scale
+        print("%-16s %-14s max. error %.2e"%(name, method, error))
+        assert error<1e-6, "%s: %s Hessian differs from finite differences"%(name, method)
+        assert np.allclose(hessian, hessian.T, rtol=1e-12, atol=1e-12)
+
+# simpleFunction, at points on every branch
+
+tape = sad.AD_Tape()
+tape.compile(simpleFunction, kwargs={})
+for point in [[0.4, 2.0, -3.0], [0.4, 2.0, 3.0], [1.5, 0.7, -2.0]]:
+    checkHessians("simpleFunction", tape, point, np.ones(1))
+
+# Neural network, with a weight on its output
+
+tape = sad.AD_Tape()
+tape.compile(calcNN, kwargs={})
+rng = np.random.default_rng(0)
+checkHessians("calcNN", tape, rng.uniform(-1.0, 1.0, size=tape.nInputs), np.array([-1.2]))
+
+print("Hessians OK")
@@ -0,0 +1,67 @@
+import os
+import sys
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+sys.path.append(os.path.join(testsDirectory, "NeuralNetwork"))
+from simpleFunction import simpleFunction
+from NeuralNetwork import calcNN
+
+'''
+Incremental evaluation (AD_Tape.evaluateIncremental and the C
+evaluateIncremental) along sequences of inputs changing a few of them at a
+time, compared with full evaluations: on simpleFunction, with changes that
+flip its conditionals (and must fall back to a full evaluation) and changes
+that do not, and on the neural network of tests/NeuralNetwork
+'''
+
+def checkIncremental(name, tape, points, flips):
+
+    # flips[k] tells whether a conditional changes its outcome at points[k]
+    evalTape = sad.AD_EvalTape(tape=tape)
+    for k, point in enumerate(points):
+        nFull = tape.incrementalState["nFullEvaluations"] if tape.incrementalState is not None else 0
+        nFullC = evalTape.incremental.nFullEvaluations if evalTape.incremental is not None else 0
+
+        outputs = tape.evaluateIncremental(point)
+        cOutputs = evalTape.evaluateIncremental(point)
+        reference = tape.evaluate(point)
+        assert np.allclose(outputs, reference, rtol=0.0, atol=0.0), "%s: outputs differ at point %d"%(name, k)
+        assert np.allclose(cOutputs, reference, rtol=1e-15, atol=1e-15), "%s: C outputs differ at point %d"%(name, k)
+
+        isFull = tape.incrementalState["nFullEvaluations"]>nFull
+        assert isFull==(k==0 or flips[k]), "%s: unexpected full evaluation at point %d"%(name, k)
+        assert (evalTape.incremental.nFullEvaluations>nFullC)==isFull, "%s: C full evaluations differ at point %d"%(name, k)
+        print("%-14s point %2d: %3d of %d instructions evaluated%s"%(name, k, tape.incrementalState["nEvaluated"],
+              len(tape.instructions), " (full)" if isFull else ""))
+
+# simpleFunction: x crosses 1.0 and z crosses 0.0 (the conditionals), or not
+
+tape = sad.AD_Tape()
+tape.compile(simpleFunction, kwargs={})
+points = [[0.4, 2.0, -3.0],
+          [0.4, 2.5, -3.0],
+          [0.4, 2.5,  3.0],
+          [0.6, 2.5,  3.0],
+          [1.5, 2.5,  3.0],
+          [1.5, 2.0,  3.0],
+          [1.5, 2.0, -1.0],
+          [0.4, 2.0, -1.0],
+          [0.4, 2.0, -1.0]]
+flips = [False, False, True, False, True, False, False, True, False]
+checkIncremental("simpleFunction", tape, np.array(points), flips)
+
+# Neural network: one input or one parameter changed at a time
+
+tape = sad.AD_Tape()
+tape.compile(calcNN, kwargs={})
+rng = np.random.default_rng(0)
+points = [rng.uniform(-1.0, 1.0, size=tape.nInputs)]
+for k in range(10):
+    points.append(points[-1].copy())
+    points[-1][rng.integers(tape.nInputs)] += 0.1
+checkIncremental("calcNN", tape, np.array(points), [False]*len(points))
+
+print("Incremental evaluation OK")
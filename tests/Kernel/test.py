@@ -0,0 +1,69 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+from simpleFunction import simpleFunction
+
+'''
+Kernels generated by AD_Tape.generateC (straight-line C code with the
+conditionals as branches) compared with the tape interpreter
+(AD_EvalTape.evaluateBatch without a kernel): outputs and jacobians on
+batches whose points take every branch of nested conditionals, evaluated by
+one and several threads, with and without the jacobians
+'''
+
+def nested(x=[3], y=[], **kwargs):
+
+    a = sad.where(x>0.0, x*y, sad.sin(x))
+    if y>0.0:
+        if x[0]>0.5:
+            b = sad.exp(-a*a) + x*y
+        else:
+            b = a*a*y
+    else:
+        if x[1]>0.0:
+            b = sad.sqrt(x*x + 1.0)/(1.0 + y*y)
+        else:
+            b = a - y
+    return [b, sad.dot(a, b)]
+
+def checkKernel(name, tape, points, directory):
+
+    libName = os.path.join(directory, "lib%s.so"%name)
+    tape.generateC(os.path.join(directory, "%s.c"%name), libName=libName)
+    kernelTape = sad.AD_EvalTape(tape=tape, kernel=libName)
+    reference, referenceJacobian = sad.AD_EvalTape(tape=tape).evaluateBatch(points)
+
+    for nThreads in [1, 4]:
+        outputs, jacobian = kernelTape.evaluateBatch(points, nThreads=nThreads)
+        error = max(np.abs(outputs - reference).max(), np.abs(jacobian - referenceJacobian).max())
+        print("%-16s %d thread(s) max. error %.2e"%(name, nThreads, error))
+        assert np.allclose(outputs, reference, rtol=1e-13, atol=1e-13), "%s: kernel outputs differ"%name
+        assert np.allclose(jacobian, referenceJacobian, rtol=1e-13, atol=1e-13), "%s: kernel jacobians differ"%name
+    outputs = kernelTape.evaluateBatch(points, jacobian=False)
+    assert np.allclose(outputs, reference, rtol=1e-13, atol=1e-13)
+
+rng = np.random.default_rng(0)
+directory = tempfile.mkdtemp()
+try:
+    tape = sad.AD_Tape()
+    tape.compile(simpleFunction, kwargs={})
+    points = rng.uniform(-2.0, 2.0, size=(500, 3))
+    points[:, 2] = np.sign(points[:, 2])*(0.5 + np.abs(points[:, 2]))   # away from z=0
+    checkKernel("simpleFunction", tape, points, directory)
+
+    tape = sad.AD_Tape()
+    tape.compile(nested, kwargs={})
+    points = rng.uniform(-1.0, 1.0, size=(500, 4))
+    checkKernel("nested", tape, points, directory)
+    tape.optimize()
+    checkKernel("nestedOptimized", tape, points, directory)
+finally:
+    shutil.rmtree(directory)
+
+print("Kernels OK")
@@ -43,6 +43,8 @@ def calcNN(inputs=[nNodes[0]], theta=[sum(nNodes[1:]+sum(nNodes[:-1]*nNodes[1:])
 
     return nodes
 
-tape = sad.AD_Tape()
-tape.compile(calcNN, kwargs={})
-tape.write("nnTape.txt", readable=True)
+if __name__=="__main__":
+
+    tape = sad.AD_Tape()
+    tape.compile(calcNN, kwargs={})
+    tape.write("nnTape.txt", readable=True)
@@ -0,0 +1,61 @@
+import os
+import sys
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+sys.path.append(os.path.join(testsDirectory, "NeuralNetwork"))
+from simpleFunction import simpleFunction
+from NeuralNetwork import calcNN
+
+'''
+AD_Tape.optimize: the outputs and jacobians of the optimized tapes (in
+python and with the C evaluator) are compared with those of the same tapes
+before optimization, on simpleFunction (on both sides of its conditionals),
+on a function made of the patterns optimize folds, forwards and fuses, and
+on the neural network of tests/NeuralNetwork
+'''
+
+def patterns(x=[6], y=[], **kwargs):
+
+    one = sad.exp(0.0*y)                    # constant subexpression
+    a = x*one + 1.0/(1.0 + sad.exp(-x))     # forwarded product, sigmoid
+    b = x*x + y                             # square, multiply-add
+    c = 1.0/x[:3] + x[3:]*sad.sigmoid(x[3:])
+    d = sad.where(x>0.2, x*y, sad.sin(x))
+    unused = sad.cos(x)*y                   # dead code
+    return [a, b, c, d, sad.dot(x, x[::-1]) + y*2.0]
+
+def checkOptimize(name, function, points=None):
+
+    tape = sad.AD_Tape()
+    tape.compile(function, kwargs={})
+    optimized = sad.AD_Tape()
+    optimized.compile(function, kwargs={})
+    result = optimized.optimize()
+    print("%-14s %d -> %d instructions"%(name, result["before"], result["after"]))
+    if points is None:
+        # Random points in [-1, 1]
+        points = rng.uniform(-1.0, 1.0, size=(10, tape.nInputs))
+
+    batchOutputs = optimized.evaluateBatch(points)
+    evalTape = sad.AD_EvalTape(tape=optimized)
+    cOutputs, cJacobians = evalTape.evaluateBatch(points)
+    for k, point in enumerate(points):
+        outputs, jacobian = tape.evaluateJacobian(point)
+        for mode in ["forward", "reverse"]:
+            optOutputs, optJacobian = optimized.evaluateJacobian(point, mode=mode)
+            assert np.allclose(optOutputs, outputs, rtol=1e-13, atol=1e-13), "%s: outputs differ"%name
+            assert np.allclose(optJacobian, jacobian, rtol=1e-12, atol=1e-12), "%s: %s jacobian differs"%(name, mode)
+        assert np.allclose(batchOutputs[k], outputs, rtol=1e-13, atol=1e-13), "%s: batch outputs differ"%name
+        assert np.allclose(cOutputs[k], outputs, rtol=1e-13, atol=1e-13), "%s: C outputs differ"%name
+        assert np.allclose(cJacobians[k], jacobian, rtol=1e-12, atol=1e-12), "%s: C jacobian differs"%name
+
+rng = np.random.default_rng(0)
+
+checkOptimize("simpleFunction", simpleFunction, np.array([[0.4, 2.0, -3.0], [0.4, 2.0, 3.0], [1.5, 0.7, -2.0]]))
+checkOptimize("patterns", patterns, rng.uniform(-1.5, 1.5, size=(10, 7)))
+checkOptimize("calcNN", calcNN)
+
+print("Optimize OK")
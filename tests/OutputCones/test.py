@@ -0,0 +1,85 @@
+import itertools
+import numpy as np
+import pySAD as sad
+
+'''
+Output cones (AD_Tape.outputCones) and the evaluation of subsets of the
+outputs (AD_Tape.evaluateSubset and evaluateSubsetJacobian, the C
+evaluateSubset), on a function with nested conditionals and SELECT
+instructions, at points on every branch: the values and jacobian rows of every
+subset of the outputs match the full evaluation, also when the instructions
+outside of the cones hold NaNs, and the cones of the outputs that do not need
+some instructions leave them out
+'''
+
+def conditional(x=[4], y=[], **kwargs):
+
+    a = sad.exp(x[0]*y)
+    b = sad.sin(x[1])
+    c = sad.where(x[2]>0.0, x[2]*x[3], -x[3])
+    if y>0.0:
+        if x[0]>x[1]:
+            outputs = [a + b, c, b*b]
+        else:
+            outputs = [a*b, c + 1.0, b]
+    else:
+        outputs = [a, sad.sqrt(c*c + 1.0), x[3]*y]
+    return outputs
+
+def checkSubset(tape, evalTape, cones, point, outputs):
+
+    reference, referenceJacobian = tape.evaluateJacobian(point)
+    mask = tape.outputConeMask(outputs, cones)
+
+    # The instructions outside of the cones are not evaluated (the constants
+    # are held by the tape, so they are kept)
+    value = tape.instructions.value
+    saved = value.copy()
+    poisoned = ~mask & (tape.instructions.operation!=sad.operationsList["CONST"])
+    value[poisoned] = np.nan
+    try:
+        values = tape.evaluateSubset(point, outputs, cones)
+        subsetValues, jacobian = tape.evaluateSubsetJacobian(point, outputs, cones)
+    finally:
+        value[:] = saved
+    assert np.allclose(values, reference[outputs], rtol=1e-15, atol=1e-15), "subset %s at %s"%(outputs, point)
+    assert np.allclose(subsetValues, reference[outputs], rtol=1e-15, atol=1e-15)
+    assert np.allclose(jacobian, referenceJacobian[outputs], rtol=1e-15, atol=1e-15), "subset %s at %s"%(outputs, point)
+
+    cValues, cJacobian = evalTape.evaluateSubset(point, outputs)
+    assert np.allclose(cValues, reference[outputs], rtol=1e-14, atol=1e-14), "C subset %s at %s"%(outputs, point)
+    assert np.allclose(cJacobian, referenceJacobian[outputs], rtol=1e-14, atol=1e-14)
+    cMask = evalTape.outputConeMask(outputs)
+    assert np.array_equal(evalTape.evaluateSubset(point, outputs, jacobian=False, mask=cMask), cValues)
+    return mask
+
+tape = sad.AD_Tape()
+tape.compile(conditional, kwargs={})
+evalTape = sad.AD_EvalTape(tape=tape)
+cones = tape.outputCones()
+assert len(cones["indptr"])==tape.nOutputs+1 and len(cones["control"])>0
+
+points = [[0.9, 0.2, 0.5, 0.3, 0.7], [0.1, 0.8, -0.5, 0.3, 0.7], [0.5, 0.4, 0.5, -0.3, -0.7], [0.5, 0.4, -0.5, -0.3, -0.7]]
+subsets = [list(subset) for n in range(1, tape.nOutputs+1) for subset in itertools.combinations(range(tape.nOutputs), n)]
+for point in points:
+    point = np.array(point)
+    for outputs in subsets:
+        checkSubset(tape, evalTape, cones, point, outputs)
+    checkSubset(tape, evalTape, cones, point, [2, 0])
+print("%d subsets at %d points OK"%(len(subsets) + 1, len(points)))
+
+# The cone of the last output (b*b, b or x[3]*y) does not contain the EXP of
+# a, the one of the second output (c, c+1 or sqrt(c*c+1)) not the SIN of b,
+# the control cone does not contain the instructions of c
+
+operation = tape.instructions.operation
+for output, excluded in [(2, "EXP"), (1, "SIN")]:
+    mask = tape.outputConeMask([output], cones)
+    ids = np.flatnonzero(operation==sad.operationsList[excluded])
+    assert len(ids)>0 and not mask[ids].any(), "%s in the cone of output %d"%(excluded, output)
+    cMask = evalTape.outputConeMask([output])
+    assert np.array_equal(cMask.astype(bool), mask), "C and python cones of output %d differ"%output
+    print("output %d: %d of %d instructions"%(output, mask.sum(), len(operation)))
+assert not np.isin(np.flatnonzero(operation==sad.operationsList["SELECT"]), cones["control"]).any()
+
+print("Output cones OK")
@@ -0,0 +1,87 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+sys.path.append(os.path.join(testsDirectory, "NeuralNetwork"))
+from simpleFunction import simpleFunction
+from NeuralNetwork import calcNN
+
+'''
+Passive arguments (AD_Tape.compile(passive=...)): the dense jacobians of
+AD_Tape and of AD_EvalTape (evaluateBatch with and without a kernel,
+evaluateSubset, evaluateCheckpointed, evaluateProfiled and
+evaluateActiveJacobian) have a column per active input only, equal to the
+columns of the jacobians of the tape compiled without passive arguments, on
+simpleFunction (with a passive argument in its conditionals) and on the
+neural network of tests/NeuralNetwork with passive inputs
+'''
+
+def checkPassive(name, function, passive, points, directory):
+
+    tape = sad.AD_Tape()
+    tape.compile(function, kwargs={}, passive=passive)
+    reference = sad.AD_Tape()
+    reference.compile(function, kwargs={})
+    active = tape.activeInputIDs()
+    assert len(active)<tape.nInputs and np.array_equal(tape.activeInputs, np.isin(np.arange(tape.nInputs), active))
+    nActive = len(active)
+
+    libName = os.path.join(directory, "lib%s.so"%name)
+    tape.generateC(os.path.join(directory, "%s.c"%name), libName=libName)
+    evalTape = sad.AD_EvalTape(tape=tape)
+    kernelTape = sad.AD_EvalTape(tape=tape, kernel=libName)
+
+    outputs, batchJacobians = evalTape.evaluateBatch(points)
+    kernelOutputs, kernelJacobians = kernelTape.evaluateBatch(points)
+    assert batchJacobians.shape==kernelJacobians.shape==(len(points), tape.nOutputs, nActive)
+    allOutputs = list(range(tape.nOutputs))
+    for p, point in enumerate(points):
+        referenceOutputs, referenceJacobian = reference.evaluateJacobian(point)
+        referenceJacobian = referenceJacobian[:, active]
+        jacobians = {"AD_Tape":               tape.evaluateJacobian(point)[1],
+                     "AD_Tape subset":        tape.evaluateSubsetJacobian(point, allOutputs)[1],
+                     "evaluateBatch":         batchJacobians[p],
+                     "evaluateBatch kernel":  kernelJacobians[p],
+                     "evaluateSubset":        evalTape.evaluateSubset(point, allOutputs)[1],
+                     "evaluateCheckpointed":  evalTape.evaluateCheckpointed(point)[1],
+                     "evaluateProfiled":      evalTape.evaluateProfiled(point)[1],
+                     "evaluateActiveJacobian": evalTape.evaluateActiveJacobian(point)[1]}
+        assert np.allclose(outputs[p], referenceOutputs, rtol=1e-13, atol=1e-13)
+        assert np.allclose(kernelOutputs[p], referenceOutputs, rtol=1e-13, atol=1e-13)
+        for method, jacobian in jacobians.items():
+            assert jacobian.shape==(tape.nOutputs, nActive), "%s: %s jacobian of shape %s"%(name, method, jacobian.shape)
+            assert np.allclose(jacobian, referenceJacobian, rtol=1e-13, atol=1e-13), "%s: %s jacobian differs"%(name, method)
+    print("%-16s %d of %d inputs active, %d jacobians OK"%(name, nActive, tape.nInputs, len(jacobians)*len(points)))
+
+    # Active inputs given explicitly override those of the tape
+    outputs, jacobian = evalTape.evaluateActiveJacobian(points[0], active=np.arange(tape.nInputs))
+    assert np.allclose(jacobian, reference.evaluateJacobian(points[0])[1], rtol=1e-13, atol=1e-13)
+
+rng = np.random.default_rng(0)
+directory = tempfile.mkdtemp()
+try:
+    points = rng.uniform(-2.0, 2.0, size=(10, 3))
+    points[:, 2] = np.sign(points[:, 2])*(0.5 + np.abs(points[:, 2]))   # away from z=0
+    checkPassive("simpleFunction", simpleFunction, ["z"], points, directory)
+
+    tape = sad.AD_Tape()
+    tape.compile(calcNN, kwargs={})
+    checkPassive("calcNN", calcNN, ["inputs"], rng.uniform(-1.0, 1.0, size=(4, tape.nInputs)), directory)
+finally:
+    shutil.rmtree(directory)
+
+# Unknown passive arguments are rejected
+
+try:
+    sad.AD_Tape().compile(simpleFunction, kwargs={}, passive=["w"])
+except ValueError as error:
+    print("rejected:", error)
+else:
+    raise AssertionError("unknown passive argument accepted")
+
+print("Passive inputs OK")
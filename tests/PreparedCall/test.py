@@ -0,0 +1,99 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+from simpleFunction import simpleFunction
+
+'''
+Prepared calls (AD_EvalTape.prepare) of the subroutines of a library
+including SAD.h: the evaluateTape subroutine of tests/SimpleFunction and a
+subroutine taking an int and arrays. The calls must give the results of
+AD_EvalTape.evaluate and AD_Tape.evaluateJacobian, return the same outputs
+array every time, see the arrays bound at prepare written in place, keep the
+scalars of the previous call when called without arguments, and not interfere
+with each other nor with evaluate
+'''
+
+# A single translation unit (SAD.h defines its functions)
+
+source = r"""
+#include "evaluateTape.c"
+
+void evaluatePoints(SAD_Tape tape, int nPoints, double *points, double *outputs)
+{
+  for (int p = 0; p < nPoints; p++)
+  {
+    for (int i = 0; i < tape.nInputs; i++)
+      setTapeInput(tape, i, points[p*tape.nInputs+i]);
+    evaluateOutputs(&tape);
+    outputs[p] = getTapeOutput(tape, 0);
+  }
+}
+"""
+
+def checkClose(name, value, reference):
+    assert np.allclose(value, reference, rtol=1e-14, atol=1e-14), "%s: %s instead of %s"%(name, value, reference)
+
+directory = tempfile.mkdtemp()
+try:
+    sourceName = os.path.join(directory, "calls.c")
+    open(sourceName, "w").write(source)
+    libName = os.path.join(directory, "libCalls.so")
+    subprocess.run(["cc", "-O2", "-fPIC", "-shared", "-I" + os.path.join(testsDirectory, "SimpleFunction"),
+                    sourceName, "-o", libName, "-lm"], check=True)
+
+    tape = sad.AD_Tape()
+    tape.compile(simpleFunction, kwargs={})
+    evalTape = sad.AD_EvalTape(libName=libName, subroutineName="evaluateTape", tape=tape)
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-2.0, 2.0, size=(20, 3))
+    points[:, 2] = np.sign(points[:, 2])*(0.5 + np.abs(points[:, 2]))   # away from z=0
+
+    # Scalar arguments replaced by every call, the jacobian written in place
+
+    jac_b = np.zeros((1, 3))
+    call = evalTape.prepare(0.0, 0.0, 1.0, jac_b, nScalarOutputs=1)
+    outputs = call.outputs
+    for point in points:
+        b = call(*point)
+        assert b is outputs
+        reference, jacobian = tape.evaluateJacobian(point)
+        checkClose("prepared call", b, reference)
+        checkClose("prepared call jacobian", jac_b, jacobian)
+        referenceJacobian = np.zeros((1, 3))
+        checkClose("evaluate", evalTape.evaluate(*point, referenceJacobian, nScalarOutputs=1), b)
+        checkClose("evaluate jacobian", referenceJacobian, jac_b)
+
+    # Without arguments, the scalars of the last call are kept
+    jac_b[:] = 0.0
+    checkClose("call without arguments", call(), tape.evaluate(points[-1]))
+    checkClose("call without arguments jacobian", jac_b, tape.evaluateJacobian(points[-1])[1])
+    print("evaluateTape: %d prepared calls OK"%len(points))
+
+    # A subroutine with another signature: the points are written in place
+    # into the array bound at prepare
+
+    batch = np.zeros((4, 3))
+    batchOutputs = np.zeros(4)
+    pointsCall = evalTape.prepare(len(batch), batch, batchOutputs, subroutineName="evaluatePoints")
+    for beg in range(0, len(points), len(batch)):
+        batch[:] = points[beg:beg+len(batch)]
+        assert len(pointsCall())==0
+        checkClose("evaluatePoints", batchOutputs, [tape.evaluate(point)[0] for point in batch])
+    pointsCall(2)
+    checkClose("evaluatePoints (2 points)", batchOutputs[:2], [tape.evaluate(point)[0] for point in batch[:2]])
+
+    # The first prepared call is not affected by the other one
+    checkClose("prepared call", call(*points[0]), tape.evaluate(points[0]))
+    checkClose("prepared call jacobian", jac_b, tape.evaluateJacobian(points[0])[1])
+    print("evaluatePoints: prepared calls OK")
+finally:
+    shutil.rmtree(directory)
+
+print("Prepared calls OK")
@@ -0,0 +1,80 @@
+import numpy as np
+import pySAD as sad
+
+'''
+The reductions sad.sum, sad.prod, sad.mean and sad.norm over all the entries,
+one axis (also negative) and tuples of axes of a 2D input: their values match
+numpy, their jacobians (AD_Tape.evaluateJacobian and the C evaluateBatch)
+match central finite differences, and they are recorded as balanced trees
+(the outputs are log2(n) instructions away from the inputs). sad.sum(x) and
+sad.sum(x, axis=(0, 1)) are the same instruction, returned as two outputs
+'''
+
+def reductions(x=[3, 4], **kwargs):
+    return [sad.sum(x), sad.sum(x, axis=0), sad.sum(x, axis=-1), sad.sum(x, axis=(0, 1)),
+            sad.prod(x), sad.prod(x, axis=0), sad.prod(x, axis=1),
+            sad.mean(x), sad.mean(x, axis=0), sad.mean(x, axis=(1,)),
+            sad.norm(x), sad.norm(x, axis=0), sad.norm(x, axis=1)]
+
+def reference(inputs):
+
+    # The function evaluated with numpy (the reductions are numpy's then)
+    outputs = reductions(x=np.reshape(inputs, (3, 4)))
+    return np.concatenate([np.ravel(output) for output in outputs])
+
+def finiteDifferenceJacobian(inputs, h=1e-6):
+
+    jacobian = np.zeros((len(reference(inputs)), len(inputs)))
+    for j in range(len(inputs)):
+        xp = np.array(inputs, dtype=np.float64)
+        xm = np.array(inputs, dtype=np.float64)
+        xp[j] += h
+        xm[j] -= h
+        jacobian[:, j] = (reference(xp) - reference(xm))/(2.0*h)
+    return jacobian
+
+def depth(tape):
+
+    # Longest chain of instructions from the inputs to the outputs
+    t = tape.instructions
+    operand1, operand2 = t.operand1.tolist(), t.operand2.tolist()
+    depths = [0]*len(t)
+    for i in range(tape.nInputs, len(t)):
+        if operand1[i]!=-1:
+            depths[i] = 1 + max(depths[operand1[i]], depths[operand2[i]] if operand2[i]!=-1 else 0)
+    return max(depths[len(t)-tape.nOutputs:])
+
+tape = sad.AD_Tape()
+tape.compile(reductions, kwargs={})
+evalTape = sad.AD_EvalTape(tape=tape)
+assert tape.nInputs==12 and tape.nOutputs==len(reference(np.ones(12)))
+
+rng = np.random.default_rng(0)
+points = rng.uniform(0.5, 1.5, size=(20, 12)) * rng.choice([-1.0, 1.0], size=(20, 12))
+maxError = 0.0
+for point in points:
+    outputs, jacobian = tape.evaluateJacobian(point)
+    assert np.allclose(outputs, reference(point), rtol=1e-14, atol=1e-14), "values differ from numpy at %s"%point
+    error = np.abs(jacobian - finiteDifferenceJacobian(point)).max()
+    assert error<1e-8, "jacobian differs from finite differences at %s"%point
+    maxError = max(maxError, error)
+cOutputs, cJacobians = evalTape.evaluateBatch(points)
+assert np.allclose(cOutputs, [reference(point) for point in points], rtol=1e-14, atol=1e-14)
+assert np.allclose(cJacobians, [tape.evaluateJacobian(point)[1] for point in points], rtol=1e-14, atol=1e-14)
+print("%d outputs at %d points, jacobians max. error %.2e"%(tape.nOutputs, len(points), maxError))
+
+# Balanced trees, for even and odd numbers of entries (plus the copy of the
+# outputs at the end of the tape)
+
+for n in [2, 13, 16, 100]:
+    for name, function in [("sum", sad.sum), ("prod", sad.prod)]:
+        def reduce(x=[n], **kwargs):
+            return [function(x)]
+        tape = sad.AD_Tape()
+        tape.compile(reduce, kwargs={})
+        assert depth(tape)<=int(np.ceil(np.log2(n))) + 1, "%s of %d entries: depth %d"%(name, n, depth(tape))
+        x = rng.uniform(0.9, 1.1, size=n)
+        assert np.isclose(tape.evaluate(x)[0], np.sum(x) if name=="sum" else np.prod(x), rtol=1e-14)
+    print("%3d entries: depth %d"%(n, depth(tape)))
+
+print("Reductions OK")
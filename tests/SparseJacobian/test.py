@@ -0,0 +1,85 @@
+import os
+import sys
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "NeuralNetwork"))
+from NeuralNetwork import calcNN
+
+'''
+Sparse jacobians (AD_Tape.evaluateSparseJacobian and the C
+evaluateTapeSparseJacobian, in the forward and the reverse mode) compared with
+the dense jacobians, on a banded function with a conditional (at points on
+both of its branches) and on the neural network of tests/NeuralNetwork. The
+colorings must not give the same color to two columns (rows) with a nonzero in
+a common row (column), and the sparsity patterns must contain the nonzeros of
+the dense jacobians
+'''
+
+def banded(x=[8], y=[], **kwargs):
+
+    a = x[1:]*x[:-1] + sad.sin(x[1:])
+    if y>0.0:
+        b = a*y
+    else:
+        b = sad.exp(a)
+    return [b, x[0]*y]
+
+def toDense(csr, nRows, nColumns):
+
+    data, indices, indptr = csr
+    dense = np.zeros((nRows, nColumns))
+    for i in range(nRows):
+        dense[i, indices[indptr[i]:indptr[i+1]]] = data[indptr[i]:indptr[i+1]]
+    return dense
+
+def checkColoring(name, tape, coloring):
+
+    pattern = toDense((np.ones(len(coloring["indices"])), coloring["indices"], coloring["indptr"]),
+                      tape.nOutputs, tape.nInputs)>0
+    for colors, nColors, columns in [(coloring["columnColors"], coloring["nColumnColors"], pattern),
+                                     (coloring["rowColors"], coloring["nRowColors"], pattern.T)]:
+        assert colors.min()>=0 and colors.max()<nColors
+        for color in range(nColors):
+            assert columns[:, colors==color].sum(axis=1).max(initial=0)<=1, "%s: invalid coloring"%name
+    print("%-8s %d columns in %d colors, %d rows in %d colors"
+          %(name, tape.nInputs, coloring["nColumnColors"], tape.nOutputs, coloring["nRowColors"]))
+    return pattern
+
+def checkSparseJacobians(name, tape, inputs, coloring, pattern):
+
+    evalTape = sad.AD_EvalTape(tape=tape)
+    outputs, reference = tape.evaluateJacobian(inputs)
+    assert not np.any((reference!=0) & ~pattern), "%s: nonzero outside of the sparsity pattern"%name
+    cOutputs, cJacobian = evalTape.evaluateBatch(inputs)
+    assert np.allclose(cJacobian[0], reference, rtol=1e-13, atol=1e-13)
+
+    for method, evaluate in [("python", tape.evaluateSparseJacobian), ("C", evalTape.evaluateSparseJacobian)]:
+        for mode in ["auto", "forward", "reverse"]:
+            sparseOutputs, csr = evaluate(inputs, coloring, mode=mode)
+            assert np.array_equal(csr[1], coloring["indices"]) and np.array_equal(csr[2], coloring["indptr"])
+            jacobian = toDense(csr, tape.nOutputs, tape.nInputs)
+            error = np.abs(jacobian - reference).max()
+            print("%-8s %-6s %-7s max. error %.2e"%(name, method, mode, error))
+            assert np.allclose(sparseOutputs, outputs, rtol=1e-13, atol=1e-13)
+            assert np.allclose(jacobian, reference, rtol=1e-13, atol=1e-13), \
+                   "%s: %s %s sparse jacobian differs from the dense one"%(name, method, mode)
+
+rng = np.random.default_rng(0)
+
+tape = sad.AD_Tape()
+tape.compile(banded, kwargs={})
+coloring = tape.jacobianColoring()
+pattern = checkColoring("banded", tape, coloring)
+assert coloring["nColumnColors"]<tape.nInputs
+for y in [0.7, -0.7]:
+    checkSparseJacobians("banded", tape, np.append(rng.uniform(-1.0, 1.0, size=8), y), coloring, pattern)
+
+tape = sad.AD_Tape()
+tape.compile(calcNN, kwargs={})
+coloring = tape.jacobianColoring()
+pattern = checkColoring("calcNN", tape, coloring)
+checkSparseJacobians("calcNN", tape, rng.uniform(-1.0, 1.0, size=tape.nInputs), coloring, pattern)
+
+print("Sparse jacobians OK")
@@ -0,0 +1,152 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pySAD as sad
+
+testsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(testsDirectory, "SimpleFunction"))
+from simpleFunction import simpleFunction
+
+'''
+AD_TapeCache in a temporary directory: a miss traces the function and stores
+its tape, a hit reads it back without tracing, the passive arguments of a hit
+are those of the call, the least recently used entries are evicted beyond
+maxSize, the kernels are cached with the tapes, and the entries evicted
+between the lookup and the read or stored by concurrent threads are handled
+without errors nor temporary files left behind
+'''
+
+def small(x=[2], y=[], **kwargs):
+    return [sad.sin(x)*y]
+
+def medium(x=[4], y=[], **kwargs):
+    return [sad.exp(x*y) + x, sad.dot(x, x)*y]
+
+def large(x=[8], y=[4], **kwargs):
+    return [sad.dot(x, x)*y, sad.cos(y)]
+
+# Counts the traced functions and the generated kernels
+
+counts = {"compile": 0, "generateC": 0}
+def counted(method):
+    def wrapper(*args, **kwargs):
+        counts[method.__name__] += 1
+        return method(*args, **kwargs)
+    return wrapper
+sad.AD_Tape.compile = counted(sad.AD_Tape.compile)
+sad.AD_Tape.generateC = counted(sad.AD_Tape.generateC)
+
+def checkSame(name, tape, function):
+
+    reference = sad.AD_Tape()
+    reference.compile(function, kwargs={})
+    counts["compile"] -= 1
+    inputs = np.random.default_rng(0).uniform(0.5, 1.0, size=(10, tape.nInputs))
+    assert np.array_equal(tape.evaluateBatch(inputs), reference.evaluateBatch(inputs)), "%s: cached tape differs"%name
+
+def entries(directory):
+    return sorted(os.listdir(directory))
+
+directory = tempfile.mkdtemp()
+try:
+    # Miss then hit, the hit without tracing
+
+    cache = sad.AD_TapeCache(directory)
+    tape = cache.compile(simpleFunction, kwargs={})
+    assert (cache.hits, cache.misses, counts["compile"]) == (0, 1, 1)
+    tape = cache.compile(simpleFunction, kwargs={})
+    assert (cache.hits, cache.misses, counts["compile"]) == (1, 1, 1)
+    checkSame("simpleFunction", tape, simpleFunction)
+    otherCache = sad.AD_TapeCache(directory)        # another process
+    otherCache.compile(simpleFunction, kwargs={})
+    assert (otherCache.hits, counts["compile"]) == (1, 1)
+    print("hit and miss OK:", entries(directory))
+
+    # The passive arguments are not part of the key: a hit recomputes them
+
+    tape = cache.compile(medium, kwargs={}, passive=["x"])
+    assert tape.activeInputs.tolist() == [False]*4 + [True]
+    tape = cache.compile(medium, kwargs={}, passive=["y"])
+    assert tape.activeInputs.tolist() == [True]*4 + [False] and cache.hits==2
+    tape = cache.compile(medium, kwargs={})
+    assert tape.activeInputs is None and cache.hits==3
+    print("passive arguments OK")
+
+    # Kernels, generated on the first call only
+
+    tape = cache.compile(small, kwargs={}, kernel=True)
+    tape = cache.compile(small, kwargs={}, kernel=True)
+    assert counts["generateC"]==1 and os.path.exists(tape.kernelName)
+    evalTape = sad.AD_EvalTape(tape=tape, kernel=tape.kernelName)
+    outputs, jacobian = evalTape.evaluateBatch(np.array([[0.3, 0.4, 2.0]]))
+    assert np.allclose(outputs, tape.evaluate([0.3, 0.4, 2.0]))
+    assert not any(name.endswith(".c") for name in entries(directory))
+    print("kernels OK:", entries(directory))
+
+    # Least recently used eviction: the cache holds two of the three tapes,
+    # the first one being used again before the third one is stored
+
+    cache.clear()
+    assert entries(directory)==[]
+    sizes = {}
+    for function in [small, medium, large]:
+        filename = os.path.join(directory, "size.sad")
+        tape = sad.AD_Tape()
+        tape.compile(function, kwargs={})
+        tape.writeBinary(filename)
+        sizes[function.__name__] = os.path.getsize(filename)
+        os.remove(filename)
+    cache = sad.AD_TapeCache(directory, maxSize=sizes["small"] + sizes["large"])
+    keys = {function.__name__: sad.functionHash(function, {}, False) + ".sad" for function in [small, medium, large]}
+    cache.compile(small, kwargs={})
+    os.utime(os.path.join(directory, keys["small"]), (1, 1))
+    cache.compile(medium, kwargs={})
+    os.utime(os.path.join(directory, keys["medium"]), (2, 2))
+    cache.compile(small, kwargs={})                # used again, now the most recent
+    cache.compile(large, kwargs={})
+    assert entries(directory)==sorted([keys["small"], keys["large"]]), entries(directory)
+
+    # An entry larger than maxSize is kept (it has just been used)
+    cache.maxSize = 1
+    cache.compile(medium, kwargs={})
+    assert entries(directory)==[keys["medium"]]
+    print("eviction OK")
+
+    # An entry evicted (by another process) between the lookup and the read
+    # is a miss
+
+    readBinary = sad.AD_Tape.readBinary
+    def evictedRead(self, filename):
+        os.remove(filename)
+        return readBinary(self, filename)
+    sad.AD_Tape.readBinary = evictedRead
+    try:
+        misses = cache.misses
+        tape = cache.compile(medium, kwargs={})
+    finally:
+        sad.AD_Tape.readBinary = readBinary
+    assert cache.misses==misses+1 and entries(directory)==[keys["medium"]]
+    checkSame("medium", tape, medium)
+
+    # Threads storing the same entry (each one renames its own temporary file)
+
+    cache = sad.AD_TapeCache(tempfile.mkdtemp(dir=directory))
+    errors = []
+    def task():
+        try:
+            checkSame("large", cache.compile(large, kwargs={}, kernel=True), large)
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=task) for k in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors==[], errors
+    assert entries(cache.directory)==sorted([keys["large"], keys["large"].replace(".sad", ".so")]), entries(cache.directory)
+    print("races OK")
+finally:
+    shutil.rmtree(directory)
+
+print("Tape cache OK")
@@ -0,0 +1,89 @@
+import numpy as np
+import pySAD as sad
+
+'''
+sad.where (SELECT instructions) with every comparison, on arrays, scalars and
+constants: the tape has no branches, its values match the function evaluated
+with numpy, its jacobians (AD_Tape.evaluateJacobian and the C evaluateBatch)
+match central finite differences away from the switching points, and at the
+switching points the selected value and its derivatives are those of the
+branch numpy.where selects
+'''
+
+def selects(x=[4], y=[], **kwargs):
+
+    a = sad.where(x>0.2, x*y, sad.sin(x))
+    b = sad.where(x<=y, x*x, 0.0)
+    c = sad.where(x[0]>=x[1], sad.exp(x[0]), y)
+    d = sad.where(x[2]<x[3], x[2]*x[3], x[3])
+    e = sad.where(x!=y, x*y, 2.0*y)
+    f = sad.where(x==0.5, y, -x)
+    return [a, b, c, d, e, f]
+
+def reference(inputs):
+
+    # The function evaluated with numpy (sad.where is numpy.where then)
+    outputs = selects(x=inputs[:4], y=inputs[4])
+    return np.concatenate([np.ravel(output) for output in outputs])
+
+def finiteDifferenceJacobian(inputs, h=1e-6):
+
+    jacobian = np.zeros((len(reference(inputs)), len(inputs)))
+    for j in range(len(inputs)):
+        xp = np.array(inputs, dtype=np.float64)
+        xm = np.array(inputs, dtype=np.float64)
+        xp[j] += h
+        xm[j] -= h
+        jacobian[:, j] = (reference(xp) - reference(xm))/(2.0*h)
+    return jacobian
+
+def margin(inputs):
+
+    # Distance to the closest switching point
+    x, y = inputs[:4], inputs[4]
+    return np.abs(np.concatenate([x - 0.2, x - y, [x[0] - x[1], x[2] - x[3]], x - 0.5])).min()
+
+tape = sad.AD_Tape()
+tape.compile(selects, kwargs={})
+evalTape = sad.AD_EvalTape(tape=tape)
+nSelects = sum(operation==sad.operationsList["SELECT"] for operation in tape.instructions.operation)
+conditionals = [sad.operationsList[name] for name in sad.conditionalOperations]
+assert tape.nTraces==1 and not any(operation in conditionals for operation in tape.instructions.operation)
+print("%d outputs, %d SELECT instructions, no branches"%(tape.nOutputs, nSelects))
+
+rng = np.random.default_rng(0)
+points = rng.uniform(-1.0, 1.0, size=(400, 5))
+points = points[[margin(point)>1e-3 for point in points]]
+maxError = 0.0
+for point in points:
+    outputs, jacobian = tape.evaluateJacobian(point)
+    assert np.allclose(outputs, reference(point), rtol=1e-15, atol=1e-15)
+    error = np.abs(jacobian - finiteDifferenceJacobian(point)).max()
+    assert error<1e-8, "jacobian differs from finite differences at %s"%point
+    maxError = max(maxError, error)
+cOutputs, cJacobians = evalTape.evaluateBatch(points)
+assert np.allclose(cOutputs, [reference(point) for point in points], rtol=1e-14, atol=1e-14)
+assert np.allclose(cJacobians, [tape.evaluateJacobian(point)[1] for point in points], rtol=1e-14, atol=1e-14)
+print("%d points, jacobians max. error %.2e"%(len(points), maxError))
+
+# At the switching points the branch numpy.where selects is differentiated:
+# x[0]=0.2 (not >0.2), x[1]=y (<=y and not !=y) and x[3]=0.5 (==0.5) at the
+# first point, x[0]=x[1] (>=), x[2]=x[3] (not <) and x[2]=x[3]=0.5 at the
+# second one. The outputs are a[0:4], b[4:8], c[8], d[9], e[10:14], f[14:18]
+
+switchingPoints = [([0.2, 0.7, 0.3, 0.5, 0.7], [(0, 0, np.cos(0.2)), (0, 4, 0.0), (5, 1, 1.4), (5, 4, 0.0),
+                                                (11, 1, 0.0), (11, 4, 2.0), (17, 3, 0.0), (17, 4, 1.0)]),
+                   ([0.7, 0.7, 0.5, 0.5, -0.1], [(8, 0, np.exp(0.7)), (8, 1, 0.0), (8, 4, 0.0), (9, 2, 0.0),
+                                                 (9, 3, 1.0), (16, 2, 0.0), (16, 4, 1.0), (17, 3, 0.0)])]
+for point, derivatives in switchingPoints:
+    point = np.array(point)
+    outputs, jacobian = tape.evaluateJacobian(point)
+    assert np.array_equal(outputs, reference(point)), "values at the switching point %s"%point
+    cOutputs, cJacobian = evalTape.evaluateBatch(point)
+    assert np.allclose(cOutputs[0], outputs, rtol=1e-15, atol=1e-15)
+    assert np.allclose(cJacobian[0], jacobian, rtol=1e-15, atol=1e-15)
+    for row, column, derivative in derivatives:
+        assert np.isclose(jacobian[row, column], derivative, rtol=1e-15, atol=1e-15), \
+               "derivative of output %d with respect to input %d at %s"%(row, column, point)
+
+print("SELECT OK")